@@ -0,0 +1,314 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# database.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import select
+
+from threading import Lock, Thread, Event
+from ctypes import byref
+
+from libwrapper import LibWrapperException
+from inotify import Inotify
+from stylus import StylusCatalog
+
+# Files that make up a libwacom database
+DATA_FILE_SUFFIXES = ('.tablet', '.stylus')
+
+# Where libwacom looks for its system database
+SYSTEM_DATABASE_DIRS = ['/usr/share/libwacom', '/usr/local/share/libwacom']
+
+
+class Database():
+
+	'''
+	One libwacom database (a directory with .tablet files and a
+	libwacom.stylus file), plus the set of vendor:model it describes.
+
+	Databases are loaded once per path and shared by the whole process (see
+	Database.get()). None is the path of the system database.
+
+	A Database is reference counted: it is created with one reference, for
+	its creator, and destroyed when the last one is released. The shared
+	table holds one, and every DatabaseStack one for each of its databases,
+	so a database replaced after a reload is destroyed once no stack uses
+	it any more.
+	'''
+
+	_databases = {}         # path: Database
+	_databases_lock = Lock()
+
+	def __init__(self, lw, path = None):
+		self._lw = lw
+		self._path = path
+		self._refs = 1
+		self._usbids = set()    # (vendor, model) of every match in the database
+		if path is None:
+			self._db = lw.libwacom_database_new()
+		else:
+			self._db = lw.libwacom_database_new_for_path(path)
+		try:
+			self._load_usbids()
+		except:
+			self.destroy()
+			raise
+
+	# Returns the shared Database for "path", loading it the first time,
+	# with a reference for the caller (see release()).
+	# Raises LibWrapperException if libwacom fails.
+	@classmethod
+	def get(cls, lw, path = None):
+		cls._databases_lock.acquire()
+		try:
+			database = cls._databases.get(path)
+			if database is None:
+				database = cls(lw, path)
+				database._refs = database._refs + 1
+				cls._databases[path] = database
+			else:
+				database._refs = database._refs + 1
+			return database
+		finally:
+			cls._databases_lock.release()
+
+	# Forgets the shared Database for "path", so the next get() loads it again.
+	# The Database itself is only destroyed once nobody else uses it.
+	@classmethod
+	def discard(cls, path = None):
+		cls._databases_lock.acquire()
+		database = cls._databases.pop(path, None)
+		cls._databases_lock.release()
+		if database is not None:
+			database.release()
+
+	# Makes "database" the shared one for "path", eg. after reloading it.
+	# The previous one is only destroyed once nobody else uses it.
+	@classmethod
+	def replace(cls, path, database):
+		database.acquire()
+		cls._databases_lock.acquire()
+		previous = cls._databases.get(path)
+		cls._databases[path] = database
+		cls._databases_lock.release()
+		if previous is not None and previous is not database:
+			previous.release()
+
+	def acquire(self):
+		self._databases_lock.acquire()
+		self._refs = self._refs + 1
+		self._databases_lock.release()
+
+	# Releases a reference. The last one destroys the database.
+	def release(self):
+		self._databases_lock.acquire()
+		self._refs = self._refs - 1
+		last = self._refs == 0
+		self._databases_lock.release()
+		if last:
+			self.destroy()
+
+	def _load_usbids(self):
+		error = self._lw.libwacom_error_new()
+		try:
+			for device_p in self._lw.iter_devices_from_database(self._db, error):
+				for match_p in self._lw.iter_matches(device_p):
+					self._usbids.add((self._lw.libwacom_match_get_vendor_id(match_p),
+					                  self._lw.libwacom_match_get_product_id(match_p)))
+		finally:
+			self._lw.libwacom_error_free(byref(error))
+
+	def destroy(self):
+		if bool(self._db):
+			self._lw.libwacom_database_destroy(self._db)
+		self._db = None
+
+	def get_path(self):
+		return self._path
+
+	# Returns the WacomDeviceDatabase *
+	def get_db(self):
+		return self._db
+
+	def get_usbids(self):
+		return frozenset(self._usbids)
+
+	def has_model(self, vendor, model):
+		return (vendor, model) in self._usbids
+
+
+class DatabaseStack():
+
+	'''
+	A list of databases in priority order, eg. site overrides, then user
+	definitions, then the system database, looked up as if they were one.
+
+	The merged index tells, for each vendor:model, the first database in the
+	stack that describes it. So a model is probed once, in the right
+	database, and a node whose model is in no database at all is not probed.
+
+	A stack holds a reference to each of its databases until release() is
+	called, which its owner has to do once it stops using it.
+	'''
+
+	def __init__(self, databases):
+		self._databases = list(databases)
+		self._index = {}        # (vendor, model): Database
+		for database in self._databases:
+			database.acquire()
+		for database in reversed(self._databases):
+			for usbid in database.get_usbids():
+				self._index[usbid] = database
+
+	# "paths" in priority order, None for the system database.
+	# Raises LibWrapperException if libwacom fails.
+	@classmethod
+	def load(cls, lw, paths):
+		databases = []
+		try:
+			for path in paths:
+				databases.append(Database.get(lw, path))
+			return cls(databases)
+		finally:
+			for database in databases:
+				database.release()
+
+	# Releases the databases. The stack can't be used any more.
+	def release(self):
+		databases, self._databases = self._databases, []
+		self._index = {}
+		for database in databases:
+			database.release()
+
+	def get_databases(self):
+		return list(self._databases)
+
+	def get_paths(self):
+		return [database.get_path() for database in self._databases]
+
+	# Returns the Database that describes vendor:model, or None
+	def get_database(self, vendor, model):
+		return self._index.get((vendor, model))
+
+	# Returns the database of last resort, the one to create generic devices
+	def get_fallback(self):
+		return self._databases[-1]
+
+	# Returns the Databases to probe, in order, for a node whose ids are
+	# "usbid" ((vendor, model), or None if unknown)
+	def get_candidates(self, usbid):
+		if usbid is None:
+			return self.get_databases()
+		database = self._index.get(usbid)
+		return [database] if database is not None else []
+
+
+class DatabaseWatcher():
+
+	'''
+	Watches the directories of a DatabaseStack and, when its data files
+	change, loads the stack again in the background.
+
+	The new stack is passed to "listener(stack)", in the watcher thread,
+	which then owns it (see DatabaseStack.release()). The databases that
+	didn't change are reused, and the ones that did replace the shared ones
+	(see Database.get()) together with their StylusCatalog.
+
+	Changes usually come in bursts (a package upgrade rewrites many files),
+	so the reload waits until the directories have been quiet for "delay"
+	seconds.
+	'''
+
+	def __init__(self, lw, stack, listener, delay = 1.0):
+		self._lw = lw
+		self._stack = DatabaseStack(stack.get_databases())     # our own, see stop()
+		self._listener = listener
+		self._delay = delay
+		self._inotify = None
+		self._dirs = {}         # watched directory: database path (None for the system one)
+		self._stop = Event()
+		self._thread = None
+
+	# Raises LibWrapperException if the directories can't be watched
+	def start(self):
+		if self._thread is not None:
+			return
+		self._inotify = Inotify()
+		for path in self._stack.get_paths():
+			dirs = [path] if path is not None else [d for d in SYSTEM_DATABASE_DIRS if os.path.isdir(d)]
+			for directory in dirs:
+				self._inotify.add_watch(directory)
+				self._dirs[directory] = path
+
+		self._stop.clear()
+		self._thread = Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		if self._thread is None:
+			return
+		self._stop.set()
+		self._thread.join(self._delay + 1)
+		self._thread = None
+		self._inotify.close()
+		self._inotify = None
+		self._stack.release()
+
+	def _run(self):
+		fd = self._inotify.fileno()
+		changed = set()         # database paths with changes
+		while not self._stop.is_set():
+			try:
+				ready, _, _ = select.select([fd], [], [], self._delay if changed else 1.0)
+			except select.error:
+				continue
+			if ready:
+				for (directory, mask, name) in self._inotify.read_events():
+					if name.endswith(DATA_FILE_SUFFIXES) and directory in self._dirs:
+						changed.add(self._dirs[directory])
+			elif changed:
+				self._reload(changed)
+				changed = set()
+
+	# Loads every changed database (and its StylusCatalog) first, and only
+	# installs them once all have loaded, so a failure leaves the shared
+	# ones untouched
+	def _reload(self, changed):
+		databases = []
+		loaded = []             # our references to the databases loaded here
+		catalogs = []           # and their StylusCatalogs
+		try:
+			for database in self._stack.get_databases():
+				path = database.get_path()
+				if path in changed:
+					database = Database(self._lw, path)
+					loaded.append(database)
+					catalogs.append(StylusCatalog.load(self._lw, database.get_db()))
+				databases.append(database)
+		except LibWrapperException:
+			# Probably half written. The next change will try again.
+			for database in loaded:
+				database.release()
+			return
+
+		for (database, catalog) in zip(loaded, catalogs):
+			Database.replace(database.get_path(), database)
+			StylusCatalog.replace(database.get_path(), catalog)
+		previous, self._stack = self._stack, DatabaseStack(databases)
+		previous.release()
+		for database in loaded:
+			database.release()
+		self._listener(DatabaseStack(databases))
@@ -15,11 +15,24 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from error import GsException, GsError
+import glob
+
+from threading import Lock, local
 
-from libwacom import LibWacom, LibWrapperException, WacomFallbackFlags, WacomDevice
+from error import GsException, GsError
+from identity import get_node_identity, get_node_usbid, get_usbid_identity, is_stable_identity
+from database import DatabaseStack, DatabaseWatcher
+from stylus import StylusCatalog, get_supported_styli
+from layout import DeviceLayout
+from pipeline import ScanNode
+from xinput import XiPropertyBackend
+
+from libwacom import LibWacom, LibWrapperException, LibWacomError, WacomErrorPool, WacomFallbackFlags, WacomErrorCode, WacomDevice
 from ctypes import byref
 
+# Error codes that just mean "not a Wacom device" when probing a node
+PROBE_MISSES = (WacomErrorCode.WERROR_NONE, WacomErrorCode.WERROR_INVALID_PATH, WacomErrorCode.WERROR_UNKNOWN_MODEL)
+
 class DeviceBroker():
 
 	'''
@@ -32,23 +45,47 @@ class DeviceBroker():
 
 	DeviceBroker instantiates a full WacomDatabase which retrieves... [TODO]
 
+	Device properties (the ones xsetwacom would get/set) are read and written
+	in-process through XInput2 by an XiPropertyBackend (see xinput.py), which
+	is only connected to the X server the first time it is needed.
+
 	[TODO]: a whole lot of work has yet to be done here. We still have to 
-	translate wacom-properties.h, wacom-util.h and Xwacom.h, and then implement
+	translate wacom-util.h and Xwacom.h, and then implement the rest of
 	xsetwacom.c, all from the "xf86-input-wacom" project.
 	'''
 
-	def __init__(self, database = None):
+	# Discovery can be run stage by stage (see pipeline.py)
+	STAGED = True
+
+	# "databases" is the path of a libwacom database, or a list of them in
+	# priority order (see DatabaseStack). The system database always comes 
+	# last, so the others only have to hold their overrides.
+	def __init__(self, databases = None):
 
 		self._lw = LibWacom()
-		self._db = None
-		self._error = None
+		self._databases = None     # DatabaseStack
+		self._errors = None        # WacomErrorPool, one error per concurrent call
+		self._descriptions = {}    # (vendor, model, match): DeviceDescription
+		self._layouts = {}         # (vendor, model): DeviceLayout
+		self._xi = None            # XiPropertyBackend set by set_property_backend()
+		self._xi_local = local()   # XiPropertyBackend of each thread, see _get_property_backend()
+		self._styli = None         # StylusCatalog, shared by the whole process
+		self._watcher = None       # DatabaseWatcher, see watch_databases()
+		self._reloaded = None      # DatabaseStack waiting to be swapped in
+		self._reloaded_lock = Lock()
+
+		if databases is None:
+			paths = []
+		elif isinstance(databases, basestring):
+			paths = [databases]
+		else:
+			paths = [path for path in databases if path is not None]
 
 		try:
-			self._error = self._lw.libwacom_error_new()
-			if database is None:
-				self._db = self._lw.libwacom_database_new()
-			else:
-				self._db = self._lw.libwacom_database_new_for_path(database)
+			self._errors = WacomErrorPool(self._lw)
+			self._databases = DatabaseStack.load(self._lw, paths + [None])
+			self._styli = StylusCatalog.merge([StylusCatalog.get(self._lw, database.get_db(), database.get_path())
+			                                   for database in self._databases.get_databases()])
 		except LibWrapperException as lwe:
 			raise GsError("Couldn't create a Scanner.", str(lwe))
 
@@ -56,67 +93,535 @@ class DeviceBroker():
 
 		# TODO: check what has happened with any device created by LibWacom. 
 		# We need to make sure that they are uninitialized. 
-		if bool(self._db):
-			self._lw.libwacom_database_destroy(self._db)
-		if bool(self._error):
-			self._lw.libwacom_error_free(byref(self._error))
+		# Databases are shared by every broker (see Database.get()): they are
+		# only released here, and destroyed once nobody else uses them.
+		self.stop_watching()
+		if self._errors is not None:
+			self._errors.destroy()
+		if self._databases is not None:
+			self._databases.release()
+		if self._reloaded is not None:
+			self._reloaded.release()
+
+	def get_database_paths(self):
+		return self._databases.get_paths()
+
+	# Reloads the databases in the background whenever their files change.
+	# The new ones are swapped in before the next find_*() call, so a scan
+	# never sees two different databases. "listener()" is called, from the
+	# watcher thread, once they are ready.
+	# Raises GsError if the database directories can't be watched.
+	def watch_databases(self, listener = None):
+		if self._watcher is not None:
+			return
+		def on_reloaded(stack):
+			self._reloaded_lock.acquire()
+			previous, self._reloaded = self._reloaded, stack
+			self._reloaded_lock.release()
+			# Reloaded again before the previous one was swapped in
+			if previous is not None:
+				previous.release()
+			if listener is not None:
+				listener()
+		try:
+			self._watcher = DatabaseWatcher(self._lw, self._databases, on_reloaded)
+			self._watcher.start()
+		except LibWrapperException as lwe:
+			self._watcher = None
+			raise GsError("Couldn't watch the libwacom databases", str(lwe))
+
+	def stop_watching(self):
+		if self._watcher is not None:
+			self._watcher.stop()
+			self._watcher = None
+
+	# Swaps in the databases reloaded by the watcher, if any. Only the cached
+	# descriptions of models now resolved by another database are dropped;
+	# they are read again next time those devices are found, and the registry
+	# sets CHANGED the ones whose description actually differs.
+	def _swap_databases(self):
+		self._reloaded_lock.acquire()
+		stack, self._reloaded = self._reloaded, None
+		self._reloaded_lock.release()
+		if stack is None:
+			return
+
+		old = self._databases
+		self._databases = stack
+		self._styli = StylusCatalog.merge([StylusCatalog.get(self._lw, database.get_db(), database.get_path())
+		                                   for database in stack.get_databases()])
+		for key in list(self._descriptions):
+			if old.get_database(key[0], key[1]) is not stack.get_database(key[0], key[1]):
+				del self._descriptions[key]
+		for key in list(self._layouts):
+			if old.get_database(key[0], key[1]) is not stack.get_database(key[0], key[1]):
+				del self._layouts[key]
+		old.release()
 
 	# TODO: free any device_p created in here
 	def find_by_path(self, path):
+		self._swap_databases()
 		try:
-			device_p = self._lw.libwacom_new_from_path(self._db, path, WacomFallbackFlags.WFALLBACK_GENERIC, self._error)
+			# The database that describes the model, or the last one to get a
+			# generic device for an unknown model.
+			candidates = self._databases.get_candidates(get_node_usbid(path)) or [self._databases.get_fallback()]
+			device_p = None
+			for database in candidates:
+				fallback = WacomFallbackFlags.WFALLBACK_GENERIC if database is candidates[-1] else WacomFallbackFlags.WFALLBACK_NONE
+				with self._errors.error() as error:
+					device_p, code = self._lw.libwacom_probe_path(database.get_db(), path, fallback, error)
+					if not bool(device_p) and code not in PROBE_MISSES:
+						raise LibWacomError(error.contents)
+				if bool(device_p):
+					break
 			if not bool(device_p):
 				return None
 			else:
-				return self._create_device(device_p, path)
+				return self._create_device(device_p, path, get_node_identity(path))
 		except LibWrapperException as lwe:
 			raise GsError("Error while trying to find a device at %s" % (path), str(lwe))
 
 	# TODO: free any device_p created in here
 	def find_by_usbid(self, vendor, model):
-		try:		
-			error = self._lw.libwacom_error_new()
-			device_p = self._lw.libwacom_new_from_usbid(self._db, vendor, model, self._error)
+		self._swap_databases()
+		# No database describes it, libwacom would just say so
+		database = self._databases.get_database(vendor, model)
+		if database is None:
+			return None
+		try:
+			with self._errors.error() as error:
+				device_p = self._lw.libwacom_new_from_usbid(database.get_db(), vendor, model, error)
 			if not bool(device_p):
 				return None
 			else:
-				return self._create_device(device_p, "/dev/null")       # TODO: find path
+				return self._create_device(device_p, "/dev/null", get_usbid_identity(vendor, model))       # TODO: find path
 		except LibWrapperException as lwe:
 			raise GsError("Error while trying to find a device at %s:%s" % (hex(vendor), hex(model)), str(lwe))
 
 	# probe each /dev/input/mouse* and see which one is a Wacom device. 
+	# Nodes that belong to the same physical device (see identity.py) are 
+	# probed only once and returned as a single Device with several paths.
+	# This is the enumerate, prefilter, probe and describe stages of a scan
+	# (see pipeline.py) in a row.
 	# TODO: free any device_p created in here
 	def find_all(self):
-		path = ""
+		return self.find_nodes(self.enumerate_nodes())
+
+	# Same as find_all(), but only looks at the nodes "paths"
+	def find_nodes(self, paths):
 		devices = []
+		for node in self.prefilter_nodes(paths):
+			device_p = self.probe_node(node)
+			if bool(device_p):
+				devices.append(self.describe_node(node, device_p))
+		return devices
+
+	# Returns the nodes that may be tablets (scan stage "enumerate")
+	def enumerate_nodes(self):
+		self._swap_databases()
+		return sorted(glob.glob('/dev/input/mouse*'))
+
+	# Groups "paths" by physical device and returns a ScanNode for each one
+	# whose model is in some database; the rest are not even probed (scan
+	# stage "prefilter").
+	def prefilter_nodes(self, paths):
+		nodes = []
+		by_identity = {}    # identity: ScanNode
+		for path in paths:
+			identity = get_node_identity(path)
+			if identity is not None and identity in by_identity:
+				by_identity[identity].add_path(path)
+				continue
+			usbid = get_node_usbid(path)
+			node = ScanNode(path, identity, usbid, self._databases.get_candidates(usbid))
+			if identity is not None:
+				by_identity[identity] = node
+			nodes.append(node)
+		return [node for node in nodes if node.candidates]
+
+	# Probes "node" in the databases that describe it, which return a status
+	# instead of raising if it is not a tablet (scan stage "probe").
+	# Returns the WacomDevice *, NULL if it is not a tablet.
+	# Raises GsError if libwacom fails.
+	def probe_node(self, node):
+		device_p = None
 		try:
-			for path in glob.glob('/dev/input/mouse*'):
-				device_p = self._lw.libwacom_new_from_path(self._db, path, WacomFallbackFlags.WFALLBACK_NONE, self._error)
+			for database in node.candidates:
+				with self._errors.error() as error:
+					device_p, code = self._lw.libwacom_probe_path(database.get_db(), node.path, WacomFallbackFlags.WFALLBACK_NONE, error)
+					if not bool(device_p) and code not in PROBE_MISSES:
+						raise LibWacomError(error.contents)
 				if bool(device_p):
-					devices.append(self._create_device(device_p, path))
+					break
 		except LibWrapperException as lwe:
-			raise GsError("Error while trying to find a device at %s" % (path), str(lwe))
+			raise GsError("Error while trying to find a device at %s" % (node.path), str(lwe))
+		return device_p
+
+	# Returns the Device of a probed node, with all its paths (scan stage
+	# "describe"). Raises GsError if libwacom fails.
+	def describe_node(self, node, device_p):
+		try:
+			device = self._create_device(device_p, node.path, node.identity)
+		except LibWrapperException as lwe:
+			raise GsError("Error while trying to describe the device at %s" % (node.path), str(lwe))
+		for path in node.paths[1:]:
+			device.add_path(path)
+		return device
 
-	def _create_device(self, device_p, path):
+	# Returns the Stylus for the tool id "id", or None if it is unknown.
+	# This is a lookup in the in-process StylusCatalog, no libwacom call.
+	def get_stylus(self, id):
+		return self._styli.get_stylus(id)
+
+	# Returns all the styli known by the database
+	def get_styli(self):
+		return self._styli.get_styli()
+
+	# Returns the Stylus objects supported by "device", in libwacom order
+	def get_device_styli(self, device):
+		styli = []
+		for id in device.get_styli():
+			stylus = self._styli.get_stylus(id)
+			if stylus is not None:
+				styli.append(stylus)
+		return styli
+
+	# Uses "backend" (an XiPropertyBackend or anything with the same 
+	# interface) to access device properties instead of the default one.
+	# It is then used by every thread.
+	def set_property_backend(self, backend):
+		self._xi = backend
+
+	# Properties are accessed from the main thread and the scanner thread
+	# (profiles are applied by the scan), and Xlib is not thread safe: each
+	# thread gets its own connection to the X server.
+	def _get_property_backend(self):
+		if self._xi is not None:
+			return self._xi
+		backend = getattr(self._xi_local, 'backend', None)
+		if backend is None:
+			try:
+				backend = XiPropertyBackend()
+			except (LibWrapperException, OSError) as e:
+				raise GsError("Couldn't connect to the X server to access device properties", str(e))
+			self._xi_local.backend = backend
+		return backend
+
+	# Returns the ids of the X input devices (stylus, eraser, pad, touch...) 
+	# that belong to "device". They are looked up once and kept in the Device,
+	# along with their names. None found is not kept: a tablet just plugged
+	# is usually probed before the X server has added its input devices, so
+	# they are looked up again next time.
+	def get_x_devices(self, device):
+		xids = device.get_x_devices()
+		if xids is None:
+			backend = self._get_property_backend()
+			try:
+				xids = backend.find_devices(device.get_vendor(), device.get_model())
+				if not xids:
+					return []
+				names = dict((xid, name) for (xid, name, use) in backend.list_devices() if xid in xids)
+			except LibWrapperException as lwe:
+				raise GsError("Error while looking for the X devices of %s" % (device.get_name()), str(lwe))
+			device.set_x_devices(xids, names)
+		return xids
+
+	# Returns {x_device_id: name} for the X input devices of "device". Unlike
+	# the ids, the names stay the same when the tablet is plugged again.
+	# They are kept in the Device, so they are known even once it is gone.
+	def get_x_device_names(self, device):
+		if device.get_x_devices() is None:
+			self.get_x_devices(device)
+		return device.get_x_device_names()
+
+	# Returns {x_device_id: {name: XProperty}} with the properties "names" of
+	# every X input device of "device". One X device may not have all of them.
+	# The values read are cached in the Device (see Device.get_cached_property())
+	def get_properties(self, device, names):
+		backend = self._get_property_backend()
+		properties = {}
+		try:
+			for xid in self.get_x_devices(device):
+				properties[xid] = backend.get_properties(xid, names)
+				for name in properties[xid]:
+					device.set_cached_property(xid, name, properties[xid][name].values)
+		except LibWrapperException as lwe:
+			raise GsError("Error while reading the properties of %s" % (device.get_name()), str(lwe))
+		return properties
+
+	# Starts a PropertyTransaction to change properties of "device".
+	# If "registry" is passed, the device is set DIRTY in it when committed.
+	def begin_properties(self, device, registry = None):
+		return PropertyTransaction(self, device, registry)
+
+	# Writes a batch of properties in one round trip to the X server.
+	# "changes" is a list of (x_device_id, name, values) tuples.
+	def set_properties(self, changes):
+		try:
+			self._get_property_backend().set_properties(changes)
+		except LibWrapperException as lwe:
+			raise GsError("Error while writing device properties", str(lwe))
+
+	def _create_device(self, device_p, path, identity = None):
 		# Minimum data that uniquely identifies a Device in the system.
 		vendor = self._lw.libwacom_get_vendor_id(device_p)
 		model = self._lw.libwacom_get_product_id(device_p)
 		match = self._lw.libwacom_get_match(device_p)
 
-		device = Device(self, path, vendor, model, match)
+		return Device(self._get_description(device_p, vendor, model, match), path, identity)
+
+	# Returns the interned DeviceDescription for vendor:model:match. The rest
+	# of the properties are only read from libwacom the first time.
+	def _get_description(self, device_p, vendor, model, match):
+		key = (vendor, model, match)
+		description = self._descriptions.get(key)
+		if description is None:
+			description = DeviceDescription(vendor, model, match,
+			                                name = self._lw.libwacom_get_name(device_p),
+			                                width = self._lw.libwacom_get_width(device_p),
+			                                height = self._lw.libwacom_get_height(device_p),
+			                                has_stylus = self._lw.libwacom_has_stylus(device_p),
+			                                has_touch = self._lw.libwacom_has_touch(device_p),
+			                                num_buttons = self._lw.libwacom_get_num_buttons(device_p),
+			                                styli = get_supported_styli(self._lw, device_p),
+			                                layout = self._get_layout(device_p, vendor, model))
+			self._descriptions[key] = description
+		return description
+
+	# Returns the DeviceLayout of vendor:model, reading it from libwacom only
+	# the first time. Different matches of a model (USB, Bluetooth...) share
+	# the same layout.
+	def _get_layout(self, device_p, vendor, model):
+		key = (vendor, model)
+		layout = self._layouts.get(key)
+		if layout is None:
+			layout = DeviceLayout.load(self._lw, device_p)
+			self._layouts[key] = layout
+		return layout
+
+class PropertyTransaction():
+
+	'''
+	Stages changes to the properties of a Device and writes them all at once.
+
+		tx = broker.begin_properties(device, registry)
+		tx.set(xid, WacomProperties.WACOM_PROP_PRESSURECURVE, [0, 10, 90, 100])
+		tx.set(xid, WacomProperties.WACOM_PROP_ROTATION, [1])
+		tx.commit()
+
+	or, rolling back automatically if anything raises in the block:
+
+		with broker.begin_properties(device, registry) as tx:
+			tx.set(...)
+
+	On commit():
+	~ Only the last value set for each property is written.
+	~ Values equal to the ones cached in the Device are not written.
+	~ Everything left is written in one batch (one round trip to the server).
+	~ The device is set DIRTY in the registry once, and only if something 
+	  was actually written.
+	'''
+
+	def __init__(self, broker, device, registry = None):
+		self._broker = broker
+		self._device = device
+		self._registry = registry
+		self._changes = {}       # (x_device_id, name): values
+		self._order = []         # keys in the order they were first set
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.commit()
+		else:
+			self.rollback()
+		return False
+
+	# Stages "values" for the property "name" of the X device "x_device".
+	# Setting a property again replaces the previous value.
+	def set(self, x_device, name, values):
+		key = (x_device, name)
+		if not key in self._changes:
+			self._order.append(key)
+		self._changes[key] = list(values)
+
+	# Stages "values" for the property "name" of all the X devices of the
+	# Device that have that property, reading it first where it is not cached
+	# yet. Returns how many were staged. Raises GsError if none of them has
+	# the property.
+	def set_all(self, name, values):
+		x_devices = self._broker.get_x_devices(self._device)
+		if [x_device for x_device in x_devices if self._device.get_cached_property(x_device, name) is None]:
+			self._broker.get_properties(self._device, [name])
+		staged = 0
+		for x_device in x_devices:
+			if self._device.get_cached_property(x_device, name) is not None:
+				self.set(x_device, name, values)
+				staged = staged + 1
+		if staged == 0:
+			raise GsError("Couldn't set %s of %s" % (name, self._device.get_name()), "None of its X devices has that property")
+		return staged
+
+	# Returns the list of (x_device_id, name, values) that commit() would
+	# write, ie. without the ones equal to the cached values.
+	def get_pending(self):
+		pending = []
+		for key in self._order:
+			values = self._changes[key]
+			if self._device.get_cached_property(*key) != values:
+				pending.append((key[0], key[1], values))
+		return pending
+
+	# Writes the pending changes. Returns the number of properties written.
+	# Raises GsError if the batch can't be written. The changes stay staged
+	# then, so commit() can be retried or rollback() called.
+	# The cache is updated before writing (and restored if that fails), so
+	# the PropertyRefresher never sees our own values as external changes.
+	def commit(self):
+		pending = self.get_pending()
+		if len(pending) > 0:
+			previous = [(x_device, name, self._device.get_cached_property(x_device, name)) for (x_device, name, values) in pending]
+			self._device.begin_writing()
+			try:
+				for (x_device, name, values) in pending:
+					self._device.set_cached_property(x_device, name, values)
+				try:
+					self._broker.set_properties(pending)
+				except GsException:
+					for (x_device, name, values) in previous:
+						self._device.set_cached_property(x_device, name, values)
+					raise
+			finally:
+				self._device.end_writing()
+			if self._registry is not None:
+				self._registry.set_device_dirty(self._device)
+		self.rollback()
+		return len(pending)
+
+	# Drops all the staged changes
+	def rollback(self):
+		self._changes = {}
+		self._order = []
+
+
+class DeviceDescription(object):
+
+	'''
+	Immutable description of a Wacom model, as found in the libwacom database.
+
+	Descriptions are interned by DeviceBroker per (vendor, model, match), so 
+	all the Devices of the same model (two identical tablets, or the same 
+	tablet probed again on every scan) share one single DeviceDescription.
+	Since it can't change, its fingerprint is computed once in the 
+	constructor.
+	'''
+
+	__slots__ = ('_vendor', '_model', '_match', '_name', '_width', '_height',
+	             '_has_stylus', '_has_touch', '_num_buttons', '_styli', '_layout', '_fingerprint')
+
+	# "styli" are the tool ids of the supported styli. The Stylus objects are
+	# in the StylusCatalog, see DeviceBroker.get_device_styli().
+	# "layout" is the DeviceLayout (buttons, rings, strips, LEDs) of the model.
+	def __init__(self, vendor, model, match, name = None, width = 0, height = 0,
+	             has_stylus = False, has_touch = False, num_buttons = 0, styli = (),
+	             layout = None):
+		init = super(DeviceDescription, self).__setattr__
+		init('_vendor', vendor)
+		init('_model', model)
+		init('_match', match)
+		init('_name', name or Device.GENERIC_NAME)
+		init('_width', width)
+		init('_height', height)
+		init('_has_stylus', bool(has_stylus))
+		init('_has_touch', bool(has_touch))
+		init('_num_buttons', num_buttons)
+		init('_styli', tuple(styli))
+		init('_layout', layout or DeviceLayout())
+		init('_fingerprint', hash((vendor, model, match, self._name, width, height,
+		                           self._has_stylus, self._has_touch, num_buttons,
+		                           self._styli, self._layout.get_fingerprint())))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("DeviceDescription is immutable")
+
+	# Builds a DeviceDescription from the output of as_dict() (of this class
+	# or of Device). Unknown keys are ignored.
+	@classmethod
+	def from_dict(cls, d):
+		return cls(d['vendor'], d['model'], d['match'],
+		           name = d.get('name'),
+		           width = d.get('width', 0),
+		           height = d.get('height', 0),
+		           has_stylus = d.get('has_stylus', False),
+		           has_touch = d.get('has_touch', False),
+		           num_buttons = d.get('num_buttons', 0),
+		           styli = d.get('styli', ()),
+		           layout = DeviceLayout.from_dict(d['layout']) if d.get('layout') else None)
+
+	# Key used to intern descriptions
+	def get_key(self):
+		return (self._vendor, self._model, self._match)
+
+	def get_vendor(self):
+		return self._vendor
+
+	def get_model(self):
+		return self._model
+
+	def get_match(self):
+		return self._match
+
+	def get_name(self):
+		return self._name
+
+	def get_width(self):
+		return self._width
+
+	def get_height(self):
+		return self._height
+
+	def get_has_stylus(self):
+		return self._has_stylus
+
+	def get_has_touch(self):
+		return self._has_touch
+
+	def get_num_buttons(self):
+		return self._num_buttons
+
+	# Returns a tuple with the tool ids of the supported styli
+	def get_styli(self):
+		return self._styli
+
+	def get_layout(self):
+		return self._layout
+
+	# Summarizes all the capabilities of the model in an integer. Based on 
+	# hash(), so it is only valid within the current process.
+	def get_fingerprint(self):
+		return self._fingerprint
+
+	def as_dict(self):
+		return {
+			'vendor': self._vendor,
+			'model': self._model,
+			'match': self._match,
+			'name': self._name,
+			'width': self._width,
+			'height': self._height,
+			'has_stylus': self._has_stylus,
+			'has_touch': self._has_touch,
+			'num_buttons': self._num_buttons,
+			'styli': list(self._styli),
+			'layout': self._layout.as_dict()
+		}
 
-		device.set_name(self._lw.libwacom_get_name(device_p))
-		device.set_width(self._lw.libwacom_get_width(device_p))
-		device.set_height(self._lw.libwacom_get_height(device_p))
-		device.set_has_stylus(self._lw.libwacom_has_stylus(device_p))
-		device.set_has_touch(self._lw.libwacom_has_touch(device_p))
-		device.set_num_buttons(self._lw.libwacom_get_num_buttons(device_p))
-		
-		return device
 
 # TODO: maybe better called DeviceSet as it would wrap a "set" of devices like
 # a tablet, pen, eraser and touch.
-class Device():
+class Device(object):
 
 	GENERIC_NAME = "Generic Wacom"
 
@@ -124,95 +629,193 @@ class Device():
 	This class holds "passive" data of a Wacom Device, ie, it doesn't access 
 	LibWacom or any other Ctypes wrapper. 
 	All Ctypes level data has to be retrieved/set via DeviceSomething class (TODO)
+
+	What the device is (model, name, capabilities...) lives in a shared, 
+	immutable DeviceDescription. The Device itself only keeps the state of
+	this particular device in the system: the nodes it was found at and the
+	physical device they belong to.
 	'''
 
-	# path, vendor and model are the minimum mandatory properties that have to
+	__slots__ = ('_description', '_path', '_paths', '_identity', '_fingerprint',
+	             '_x_devices', '_x_device_names', '_properties', '_writing', '_write_serial')
+
+	# description and path are the minimum mandatory properties that have to
 	# be set to a Device. 
-	def __init__(self, broker, path, vendor, model, match):
-		self._broker = broker
+	# "identity" identifies the physical device the path belongs to (see 
+	# identity.py). Other nodes of the same physical device are added with 
+	# add_path().
+	def __init__(self, description, path, identity = None):
+		self._description = description
 		self._path = path
-		self._vendor = vendor
-		self._model = model
-		self._match = match
-
-		self._name = self.GENERIC_NAME
-
-	# TODO: Return some sort of string that allows us to identify the device 
-	# uniquely on the system where it is (or was) running. 
-	# So far we will use "path:vendor:model".
-	# But I am not so sure that it is enough. What happens if we have a
-	# "Wacom Intuos XYZ" detected by "/dev/input/mouse3" and this device uses
-	# more than one path like "mouse4" and "mouse6"? The scanner would discover
-	# one more "Wacom Intuos XYZ" by "/dev/input/mouse4" and "/dev/input/mouse6".
-	# There must be another way to grant unicity, so what we discover by
-	# "/dev/input/mouse3" is exactly the same as what we discover by 
-	# "/dev/input/mouse4". Maybe some sort of internal Id. Whatever it is, that
-	# is what we have to pass to the constructor of Device.
+		self._paths = [path]
+		self._identity = identity
+
+		# Neither the id nor the description can change, so this is final
+		self._fingerprint = hash((self.get_id(), description.get_fingerprint()))
+
+		self._x_devices = None        # X input device ids, see DeviceBroker.get_x_devices()
+		self._x_device_names = {}     # X input device id: name
+		self._properties = {}         # (x_device_id, name): last known values
+		self._writing = 0             # PropertyTransactions being committed, see begin_writing()
+		self._write_serial = 0
+
+	# Builds a Device from the output of as_dict(). An already interned
+	# "description" may be passed, otherwise it is built from "d" as well.
+	@classmethod
+	def from_dict(cls, d, description = None):
+		device = cls(description or DeviceDescription.from_dict(d), d['path'], d.get('identity'))
+		device.set_paths(d.get('paths') or [d['path']])
+		return device
+
+	# Returns a string that identifies the device uniquely on the system where
+	# it is (or was) running: "identity:vendor:model".
+	# A tablet exposing several nodes ("mouse3", "mouse4", "mouse6") has one
+	# identity for all of them, so it results in one single Device.
+	# If the identity could not be resolved we fall back to the path of the 
+	# node, ie. "path:vendor:model".
 	def get_id(self):
-		return "%s:%s:%s" % (self._path, self._vendor, self._model)
+		if self._identity is None:
+			return "%s:%s:%s" % (self._path, self._description.get_vendor(), self._description.get_model())
+		return "%s:%s:%s" % (self._identity, self._description.get_vendor(), self._description.get_model())
 
-	def set_name(self, name):
-		self._name = name
+	def get_identity(self):
+		return self._identity
 
-	def get_name(self):
-		return self._name
+	# Returns the key of the profile of the device (see ProfileStore). It has
+	# to survive re-plugging, so it is the identity only when that comes from
+	# the serial number; otherwise all the tablets of a model share it.
+	def get_profile_key(self):
+		if is_stable_identity(self._identity):
+			return self._identity
+		return "%04x:%04x" % (self._description.get_vendor(), self._description.get_model())
 
-	def set_width(self, width):
-		self._width = width
+	def get_description(self):
+		return self._description
 
-	def get_width(self):
-		return self._width
+	# Returns the path of the node the device was probed from
+	def get_path(self):
+		return self._path
 
-	def set_height(self, height):
-		self._height = height
+	# Returns the paths of all the nodes of the device
+	def get_paths(self):
+		return list(self._paths)
 
-	def get_height(self):
-		return self._height
+	def add_path(self, path):
+		if not path in self._paths:
+			self._paths.append(path)
 
-	def set_has_stylus(self, has_stylus = True):
-		self._has_stylus = bool(has_stylus)
+	def set_paths(self, paths):
+		self._paths = list(paths)
 
-	def get_has_stylus(self):
-		return self._has_stylus
+	def get_vendor(self):
+		return self._description.get_vendor()
 
-	def set_has_touch(self, has_touch = True):
-		self._has_touch = bool(has_touch)
+	def get_model(self):
+		return self._description.get_model()
 
-	def get_has_touch(self):
-		return self._has_touch
+	def get_match(self):
+		return self._description.get_match()
 
-	def set_num_buttons(self, num_buttons):
-		self._num_buttons = num_buttons
+	def get_name(self):
+		return self._description.get_name()
+
+	def get_width(self):
+		return self._description.get_width()
+
+	def get_height(self):
+		return self._description.get_height()
+
+	def get_has_stylus(self):
+		return self._description.get_has_stylus()
+
+	def get_has_touch(self):
+		return self._description.get_has_touch()
 
 	def get_num_buttons(self):
-		return self._num_buttons
+		return self._description.get_num_buttons()
+
+	def get_styli(self):
+		return self._description.get_styli()
+
+	def get_layout(self):
+		return self._description.get_layout()
+
+	# Returns the ids of the X input devices of this device, or None if they
+	# have not been looked up yet.
+	def get_x_devices(self):
+		return self._x_devices
+
+	# Returns {x_device_id: name} for the X input devices that have been
+	# looked up.
+	def get_x_device_names(self):
+		return dict(self._x_device_names)
+
+	def set_x_devices(self, x_devices, names = None):
+		self._x_devices = list(x_devices) if x_devices is not None else None
+		self._x_device_names = dict(names or {})
+
+	# Returns the last values read or written for a property of one of the X
+	# input devices, or None if they are not known.
+	def get_cached_property(self, x_device, name):
+		return self._properties.get((x_device, name))
+
+	# None forgets the values
+	def set_cached_property(self, x_device, name, values):
+		if values is None:
+			self._properties.pop((x_device, name), None)
+		else:
+			self._properties[(x_device, name)] = list(values)
+
+	def get_cached_properties(self):
+		return dict(self._properties)
+
+	# Takes the X devices and the cached properties of "device", the same
+	# physical device described before (eg. by an older database).
+	def copy_state(self, device):
+		self._x_devices = list(device._x_devices) if device._x_devices is not None else None
+		self._x_device_names = dict(device._x_device_names)
+		self._properties = dict(device._properties)
+
+	# Called around the writes of a PropertyTransaction, so the
+	# PropertyRefresher can tell the values written by the application from
+	# external changes: values read while writing, or since get_write_serial()
+	# changed, are not to be trusted.
+	def begin_writing(self):
+		self._writing = self._writing + 1
+		self._write_serial = self._write_serial + 1
+
+	def end_writing(self):
+		self._writing = self._writing - 1
+
+	def is_writing(self):
+		return self._writing > 0
+
+	def get_write_serial(self):
+		return self._write_serial
+
+	# Returns a plain dictionary describing the Device, suitable to be sent
+	# to other processes (see service.py).
+	def as_dict(self):
+		d = self._description.as_dict()
+		d['id'] = self.get_id()
+		d['path'] = self._path
+		d['paths'] = list(self._paths)
+		d['identity'] = self._identity
+		return d
+
+	# Returns an integer that summarizes the id and the capabilities of the
+	# device (see DeviceDescription.get_fingerprint()). Two Devices with the
+	# same fingerprint are considered exactly the same.
+	def get_fingerprint(self):
+		return self._fingerprint
 
 	# Checks if "device" is exactly the same as the current one. 
 	# For that, not only the id but also other characteristics are checked
 	# like, for example the device has now one more pen, or an airbrush is gone
 	# Returns True if they exactly the same
 	def is_full_match(self, device):
-		# For now we assume that they are exactly the same if they just match 
-		# 'id' and a few other properties.
-		if self.get_id() != device.get_id():
-			return False
-		if self.get_name() != device.get_name():
-			return False
-		if self.get_height() != device.get_height():
-			return False
-		if self.get_width() != device.get_width():
-			return False
-
-		return True
+		return self._fingerprint == device._fingerprint
 
-	'''
-	TODO: 
-	Add a Device cache data refresher thread per Device. 
-	That thread will check properties from the Device from time to time and 
-	compare to the currently stored ones in the Device object. If there is a 
-	difference the property is marked "dirty". 
-	This is to have the application know that something (xsetwacom?) can have 
-	externally configured the device so we might want to refresh the UI with 
-	the new values. The thread could use a PropertyChanged exception. This is
-	to be determined yet.
-	'''
+	# Properties changed externally (xsetwacom?) are detected by the one
+	# PropertyRefresher (see refresher.py) watching all the registered Devices,
+	# which updates the cached values and sets the Device DIRTY.
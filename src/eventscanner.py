@@ -0,0 +1,235 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# eventscanner.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Thread
+from Queue     import Queue
+
+from pipeline import ScanPipeline, ScanBatch
+
+from gi.repository import GLib, Gio
+
+
+class EventScanner():
+
+	'''
+	EventScanner is an alternative to DeviceScanner that is driven by the GLib
+	main loop instead of a thread sleeping between scans.
+
+	It keeps the same contract with the DeviceRegistry and the application
+	(begin / register / end_checking / on_device_changes / commit) but:
+
+	~ Scans are triggered by hotplug events on /dev/input (Gio file monitor)
+	  and by a periodic timer as a fallback, never by an ad-hoc thread.
+	~ The blocking libwacom probes run in a single worker thread (the 
+	  executor). Their results are handed back to the main loop, where the
+	  registry is updated and the application is notified. That means that
+	  on_device_changes() is always called in the Gtk.main thread.
+	~ Configuration changes (set_device_path(), set_device_vendor_model())
+	  are queued in the main loop as well, so they are applied between scans
+	  and never race with a probe in progress.
+
+	Only one scan is in flight at a time. Events arriving while a scan is
+	running are coalesced into a single rescan once it is finished.
+	'''
+
+	HOTPLUG_DIR      = "/dev/input"
+	HOTPLUG_DEBOUNCE = 250    # milliseconds to wait for a burst of events to settle
+
+	def __init__(self, app, registry, broker):
+		self._app = app
+		self._logger = app.get_logger()
+		self._registry = registry
+		self._broker = broker
+		self._pipeline = ScanPipeline(app, registry, broker)
+		self._period = 5                 # seconds, fallback timer
+
+		self._device_path = None
+		self._device_vendor = None
+		self._device_model = None
+
+		self._configs = Queue()          # pending configuration changes
+		self._jobs = Queue()             # probes to be run by the executor
+		self._executor = None
+		self._monitor = None
+		self._timer_id = 0
+		self._debounce_id = 0
+		self._recheck_id = 0             # see DeviceRegistry.get_recheck_delay()
+		self._scanning = False           # a probe is in flight
+		self._rescan = False             # something happened during the probe
+
+	# Same as DeviceScanner.set_device_path() but safe to be called from any
+	# thread: the change is queued and applied before the next scan.
+	def set_device_path(self, path):
+		self._post_config((path, None, None))
+
+	# Same as DeviceScanner.set_device_vendor_model() but safe to be called
+	# from any thread: the change is queued and applied before the next scan.
+	def set_device_vendor_model(self, vendor, model):
+		self._post_config((None, vendor, model))
+
+	# Makes the scanner apply the stored profile of every new device
+	def set_profile_store(self, store):
+		self._pipeline.set_profile_store(store)
+
+	# Returns the ScanPipeline, eg. to replace a stage or read its timings
+	def get_pipeline(self):
+		return self._pipeline
+
+	def _post_config(self, config):
+		self._configs.put(config)
+		if self._executor is not None:
+			GLib.idle_add(self._on_config)
+
+	def _on_config(self):
+		self._request_scan()
+		return False
+
+	# Starts listening to hotplug events and the fallback timer. 
+	# Requires a running GLib main loop (eg. Gtk.main()).
+	# With "scan_now" a first scan is queued right away, instead of waiting
+	# for the first event (eg. when the caller didn't make a first scan()).
+	def start(self, scan_now = False):
+		if self._executor is None:
+			self._executor = Thread(target = self._run_jobs)
+			self._executor.daemon = True
+			self._executor.start()
+
+		try:
+			directory = Gio.File.new_for_path(self.HOTPLUG_DIR)
+			self._monitor = directory.monitor_directory(Gio.FileMonitorFlags.NONE, None)
+			self._monitor.connect("changed", self._on_hotplug)
+		except GLib.GError as e:
+			self._logger.warning("Can't monitor %s, falling back to polling" % (self.HOTPLUG_DIR), e)
+			self._monitor = None
+
+		self._timer_id = GLib.timeout_add_seconds(self._period, self._on_timer)
+		if scan_now:
+			self._request_scan()
+
+	# Stops listening to events and waits, at most "timeout" seconds, for a
+	# probe in progress. Must be called from the main loop.
+	def stop(self, timeout = 5.0):
+		if self._monitor is not None:
+			self._monitor.cancel()
+			self._monitor = None
+		if self._timer_id:
+			GLib.source_remove(self._timer_id)
+			self._timer_id = 0
+		if self._debounce_id:
+			GLib.source_remove(self._debounce_id)
+			self._debounce_id = 0
+		if self._recheck_id:
+			GLib.source_remove(self._recheck_id)
+			self._recheck_id = 0
+		if self._executor is not None:
+			self._jobs.put(None)
+			self._executor.join(timeout)
+			if self._executor.is_alive():
+				self._logger.warning("The scanner executor didn't finish in %.1f seconds" % (timeout))
+			self._executor = None
+
+	# Runs a complete scan synchronously, in the calling thread. 
+	# Intended for the first scan, before the main loop is running.
+	def scan(self):
+		return self._reconcile(self._probe(self._get_config()))
+
+	def _on_hotplug(self, monitor, file, other_file, event_type):
+		if event_type not in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED):
+			return
+		if not file.get_basename().startswith("mouse"):
+			return
+		self._logger.debug("Hotplug event on " + file.get_path())
+		if self._debounce_id:
+			GLib.source_remove(self._debounce_id)
+		self._debounce_id = GLib.timeout_add(self.HOTPLUG_DEBOUNCE, self._on_debounced)
+
+	def _on_debounced(self):
+		self._debounce_id = 0
+		self._request_scan()
+		return False
+
+	def _on_timer(self):
+		self._request_scan()
+		return True
+
+	def _on_recheck(self):
+		self._recheck_id = 0
+		self._request_scan()
+		return False
+
+	# Devices that are settling or have been missed are checked again as soon
+	# as that is useful, rather than on the next timer or hotplug event.
+	def _schedule_recheck(self):
+		delay = self._registry.get_recheck_delay()
+		if delay is None or self._recheck_id or self._executor is None:
+			return
+		self._recheck_id = GLib.timeout_add(int(delay * 1000) + 1, self._on_recheck)
+
+	# Queues a probe in the executor, unless one is already in flight.
+	def _request_scan(self):
+		if self._scanning:
+			self._rescan = True
+			return
+		self._scanning = True
+		self._rescan = False
+		self._logger.debug("Scanning...")
+		self._jobs.put(self._get_config())
+
+	# Applies any queued configuration change and returns the current one.
+	def _get_config(self):
+		while not self._configs.empty():
+			self._device_path, self._device_vendor, self._device_model = self._configs.get_nowait()
+		return (self._device_path, self._device_vendor, self._device_model)
+
+	# Executor. Runs the blocking probes and hands the results to the main loop.
+	def _run_jobs(self):
+		while True:
+			config = self._jobs.get()
+			if config is None:
+				break
+			GLib.idle_add(self._on_probed, self._probe(config))
+		self._logger.debug("Scanner executor finished!")
+
+	def _on_probed(self, batch):
+		self._scanning = False
+		# A probe that finished after stop() is not applied
+		if self._executor is None:
+			return False
+		self._reconcile(batch)
+		if self._rescan:
+			self._request_scan()
+		return False
+
+	# Finds devices according to "config" (the scan stages up to "describe").
+	# Runs in the executor. Returns the ScanBatch.
+	def _probe(self, config):
+		batch = ScanBatch(config)
+		self._pipeline.run(batch, last = 'describe')
+		return batch
+
+	# Updates the registry with the results of a probe, notifies the app and
+	# applies the profiles (the stages from "reconcile" on). Runs in the main
+	# loop (or in the caller of scan()).
+	def _reconcile(self, batch):
+		if batch.error is None:
+			self._pipeline.run(batch, first = 'reconcile')
+		if batch.error is not None:
+			self._logger.error(str(batch.error))
+			return False
+		self._logger.debug("Scan: " + batch.format_timings())
+		self._schedule_recheck()
+		return True
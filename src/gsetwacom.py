@@ -20,17 +20,25 @@
 import gi
 gi.require_version('Gtk', '3.0')
 
-from gi.repository import Gtk, GdkPixbuf, Gdk
+from gi.repository import Gtk, GdkPixbuf, Gdk, GLib
 from argparse import ArgumentParser
 
 import os
 import sys
+import glob
 
 from error import GsException
 from logger import Logger
 from registry import DeviceRegistry
 from device import DeviceBroker
 from scanner import DeviceScanner
+from eventscanner import EventScanner
+from service import RegistryService, GsServiceException
+from refresher import PropertyRefresher
+from profiles import ProfileStore
+from replay import TraceRecorder, ReplayBroker
+from worker import ProbeWorker
+from images import LayoutImageCache
 from w_main import WMain
 
 
@@ -67,6 +75,12 @@ def is_valid_device_file(parser, arg):
 	else:
 		return arg
 
+def is_valid_trace_file(parser, arg):
+	if not os.path.isfile(arg):
+		parser.error("The trace file %s does not exist!" % arg)
+	else:
+		return arg
+
 def is_valid_device_database(parser, arg):
 	# TODO: it is considered better practice to try and open the file with a try-except block, than to check for existence
 	# try: ... except IOError
@@ -83,7 +97,18 @@ def get_arguments():
 	help_vendor   = 'Vendor code, hex value (eg 0x056a)'
 	help_model    = 'Model code, hex value (eg 0x033e)'
 	help_path     = 'Path to de device file under /dev (eg \'/dev/input/mouse0\')'
-	help_database = 'LibWacom database path (eg \'/usr/share/libwacom\')'
+	help_database = 'LibWacom database path (eg \'/usr/share/libwacom\'). Can be repeated: earlier databases override later ones, and all of them override the system one'
+	help_service  = 'Publishes detected devices to other processes on a Unix socket'
+	help_events   = 'Scans on hotplug events from the main loop instead of polling from a thread'
+	help_misses   = 'Consecutive scans a device has to be missing to be removed (default 2)'
+	help_settle   = 'Seconds a new device has to stay to be shown (default 0.5)'
+	help_locktime = 'Seconds a scan waits for the device registry before giving up (default 5)'
+	help_record   = 'Records what every scan finds to a trace file'
+	help_replay   = 'Replays a trace file recorded with --record instead of looking for real devices'
+	help_speed    = 'Speed factor of --replay (default 1.0, 0 for as fast as possible)'
+	help_worker   = 'Probes devices in a separate process, so a crash or a hang in libwacom doesn\'t take the application down'
+	help_ptimeout = 'Seconds a probe in the --probe-worker can take before it is killed (default 5)'
+	help_snapshot = 'Doesn\'t show the devices of the last session while the first scan is running'
 
 	gr_loglevel = parser.add_mutually_exclusive_group()
 	gr_loglevel.add_argument('-l', '--loglevel', dest='loglevel', choices=['debug', 'info', 'warning', 'error', 'fatal'], help=help_loglevel)
@@ -95,7 +120,22 @@ def get_arguments():
 	gr_device.add_argument('-m', '--model', dest='device_model', type=lambda x: int(x,0), help=help_model)
 	gr_device.add_argument('-p', '--path',  dest='device_path',  type=lambda x: is_valid_device_file(parser, x), help=help_path)
 
-	parser.add_argument('-b', '--database', dest='device_database', type=lambda x: is_valid_device_database(parser, x), help=help_database)
+	parser.add_argument('-b', '--database', dest='device_database', action='append', type=lambda x: is_valid_device_database(parser, x), help=help_database)
+
+	parser.add_argument('-s', '--service', dest='service', action='store_true', help=help_service)
+	parser.add_argument('-e', '--event-scanner', dest='event_scanner', action='store_true', help=help_events)
+	parser.add_argument('--misses', dest='max_misses', default=2, type=int, help=help_misses)
+	parser.add_argument('--settle', dest='settle_time', default=0.5, type=float, help=help_settle)
+	parser.add_argument('--lock-timeout', dest='lock_timeout', default=5.0, type=float, help=help_locktime)
+
+	gr_trace = parser.add_mutually_exclusive_group()
+	gr_trace.add_argument('--record', dest='record', metavar='FILE', help=help_record)
+	gr_trace.add_argument('--replay', dest='replay', metavar='FILE', type=lambda x: is_valid_trace_file(parser, x), help=help_replay)
+	parser.add_argument('--replay-speed', dest='replay_speed', default=1.0, type=float, help=help_speed)
+
+	parser.add_argument('--probe-worker', dest='probe_worker', action='store_true', help=help_worker)
+	parser.add_argument('--probe-timeout', dest='probe_timeout', default=5.0, type=float, help=help_ptimeout)
+	parser.add_argument('--no-snapshot', dest='snapshot', action='store_false', help=help_snapshot)
 
 	return parser.parse_args()
 
@@ -111,33 +151,91 @@ class GSetWacom():
 		self._builder = Gtk.Builder()
 
 		self._logger.debug("Creating DeviceRegisty")
-		self._registry = DeviceRegistry()
-
-		self._logger.debug("Creating DeviceBroker")
-		if args and args.device_database:
-			self._device_broker = DeviceBroker(args.device_database)
+		if args:
+			self._registry = DeviceRegistry(args.max_misses, args.settle_time, args.lock_timeout)
 		else:
-			self._device_broker = DeviceBroker()
+			self._registry = DeviceRegistry()
 
-		self._logger.debug("Creating DeviceScanner")
-		self._scanner = DeviceScanner(self, self._registry, self._device_broker)
+		# A replayed session is not the last session
+		self._snapshot = args is None or (args.snapshot and not args.replay)
+
+		if args and args.replay:
+			self._logger.debug("Creating ReplayBroker")
+			self._device_broker = ReplayBroker(args.replay, args.replay_speed)
+		else:
+			self._logger.debug("Creating DeviceBroker")
+			if args and args.device_database:
+				self._device_broker = DeviceBroker(args.device_database)
+			else:
+				self._device_broker = DeviceBroker()
+
+		self._recorder = None
+		if args and args.record:
+			self._logger.debug("Recording scans to " + args.record)
+			self._recorder = TraceRecorder(self._device_broker, args.record)
+			self._device_broker = self._recorder
+
+		if args and args.event_scanner:
+			self._logger.debug("Creating EventScanner")
+			self._scanner = EventScanner(self, self._registry, self._device_broker)
+		else:
+			self._logger.debug("Creating DeviceScanner")
+			self._scanner = DeviceScanner(self, self._registry, self._device_broker)
+
+		# The probes of the worker would bypass the TraceRecorder
+		self._worker = None
+		if args and args.probe_worker and args.record:
+			self._logger.warning("Probing in-process while recording, --probe-worker ignored")
+		elif args and args.probe_worker and not args.replay:
+			self._logger.debug("Creating ProbeWorker")
+			self._worker = ProbeWorker(args.device_database, args.probe_timeout)
+			self._scanner.get_pipeline().set_probe_worker(self._worker)
+
+		# A replayed session has no X devices to configure
+		self._profiles = None
+		if not (args and args.replay):
+			self._logger.debug("Creating ProfileStore")
+			self._profiles = ProfileStore(logger = self._logger)
+			self._scanner.set_profile_store(self._profiles)
 
 		if args and args.device_path:
 			self._scanner.set_device_path(args.device_path)
 		elif args and args.device_model:
 			self._scanner.set_device_vendor_model(args.device_vendor, args.device_model)
 
+		self._logger.debug("Creating PropertyRefresher")
+		self._refresher = PropertyRefresher(self._registry, self.on_device_properties_changed, logger = self._logger)
+
+		self._service = None
+		if args and args.service:
+			self._logger.debug("Creating RegistryService")
+			self._service = RegistryService(self._registry)
+
+		self._logger.debug("Creating LayoutImageCache")
+		self._layout_images = LayoutImageCache()
+
 		self._logger.debug("Creating main window")
 		self._w_main = WMain(self)
 
 	# Returns True if the application was successfully started.
 	def run(self):
 		try:
-			self._logger.debug("Scanning devices...")
-			self._scanner.scan()
+			if self._service:
+				self._start_service()
+			# With the devices of the last session the window can be shown
+			# right away, and the first scan is made in the background. 
+			# Otherwise there is nothing to show until it is over.
+			restored = self._load_snapshot()
+			if not restored:
+				self._logger.debug("Scanning devices...")
+				self._scanner.scan()
+			else:
+				self.on_device_changes([], restored, [])
 			self._w_main.show()
 			self._logger.debug("Launching scanner thread...") 
-			self._scanner.start()
+			self._scanner.start(scan_now = bool(restored))
+			self._start_refresher()
+			self._start_database_watcher()
 			Gtk.main()
 			return True
 		except GsException as ge:
@@ -147,8 +245,88 @@ class GSetWacom():
 	# This function is used to normally end the application.
 	def quit(self):
 		self._logger.info("Terminating the application...")
+		# First, so no scan is in a transaction while the profiles and the
+		# snapshot are saved
+		self._scanner.stop()
+		if self._service:
+			self._service.stop()
+		self._refresher.stop()
+		self._device_broker.stop_watching()
+		if self._recorder:
+			self._recorder.close()
+		if self._worker:
+			self._worker.stop()
+		self._layout_images.stop()
+		self._save_profiles(self._registry.get_devices_running())
+		self._save_snapshot()
 		Gtk.main_quit()
 
+	# Keeps the current configuration of "devices", so it is applied again
+	# next time they are plugged. Devices that are gone are captured from
+	# what is cached in them.
+	def _save_profiles(self, devices):
+		if self._profiles is None:
+			return False
+		try:
+			for device in devices:
+				self._profiles.capture(device, self._device_broker)
+			self._profiles.save()
+		except GsException as ge:
+			self._logger.warning("Couldn't save device profiles", ge)
+		return False    # when called from GLib.idle_add
+
+	# Returns the devices of the last session, restored in the registry
+	def _load_snapshot(self):
+		if not self._snapshot:
+			return []
+		try:
+			restored = self._registry.load_snapshot()
+			if restored:
+				self._logger.info("%d device(s) restored from the last session" % (len(restored)))
+			return restored
+		except GsException as ge:
+			self._logger.warning("Couldn't restore the devices of the last session", ge)
+			return []
+
+	def _save_snapshot(self):
+		if not self._snapshot:
+			return
+		try:
+			self._registry.save_snapshot()
+		except GsException as ge:
+			self._logger.warning("Couldn't save the devices of this session", ge)
+
+	# Without the refresher we just don't see changes made by other tools
+	def _start_refresher(self):
+		try:
+			self._refresher.start()
+		except GsException as ge:
+			self._logger.warning("External changes to device properties won't be detected", ge)
+
+	# Without the watcher, changes to the libwacom database need a restart
+	def _start_database_watcher(self):
+		try:
+			self._device_broker.watch_databases(self.on_databases_reloaded)
+		except GsException as ge:
+			self._logger.warning("Changes to the libwacom database won't be detected", ge)
+
+	# Called from the watcher thread. Devices are described again by the
+	# next scan.
+	def on_databases_reloaded(self):
+		self._logger.info("The libwacom database has changed, it has been reloaded")
+		if self._worker:
+			self._worker.reload()
+
+	# The application can live without the service, so failing to start it is
+	# not fatal.
+	def _start_service(self):
+		try:
+			self._service.start()
+			self._logger.info("Publishing devices at " + self._service.get_path())
+		except GsServiceException as gse:
+			self._logger.warning("Couldn't start the registry service", gse)
+			self._service = None
+
 	# Retrieves a window from the Gtk builder and connect signals if signals_map is passed
 	def get_window_from_file(self, file, name, signals_map = None):
 		# TODO: check if the file has been added before
@@ -160,6 +338,12 @@ class GSetWacom():
 	def get_logger(self):
 		return self._logger
 
+	def get_object(self, name):
+		return self._builder.get_object(name)
+
+	def get_layout_images(self):
+		return self._layout_images
+
 	def on_device_changes(self, running_devices, new_devices, deleted_devices):
 		main_nb = self._builder.get_object("main_notebook")
 		c_page  = main_nb.get_current_page()
@@ -168,6 +352,17 @@ class GSetWacom():
 		n_new     = len(new_devices)
 		n_deleted = len(deleted_devices)
 
+		if n_deleted > 0 or n_new > 0:
+			devices = new_devices + running_devices
+			self._w_main.show_device(devices[0] if devices else None)
+
+		# Unplugged devices won't be there on quit. This may be the
+		# DeviceScanner thread: save in the Gtk.main one instead (the
+		# ProfileStore itself is thread-safe, profiles are still applied
+		# by the scanner)
+		if n_deleted > 0:
+			GLib.idle_add(self._save_profiles, deleted_devices)
+
 		if n_deleted == 0 and n_new == 0:
 			self._logger.debug("No changes")
 			
@@ -188,6 +383,11 @@ class GSetWacom():
 			pass		
 
 
+	# Called by the PropertyRefresher, in its own thread, when properties of
+	# a device have been changed by some other application.
+	def on_device_properties_changed(self, device, names):
+		self._logger.info("Properties of %s changed externally: %s" % (device.get_name(), ", ".join(names)))
+
 	# Any device change at the "libwacom" layer must be handled by this function
 	# This will be triggered by the Scanner when it detects changes
 	# These changes can be:
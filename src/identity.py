@@ -0,0 +1,115 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# identity.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Resolution of the physical device behind an input device node.
+
+A single tablet usually exposes several nodes under /dev/input (pen, touch,
+pad...), eg. "mouse3", "mouse4" and "mouse6". All of them hang from the same
+device in sysfs. get_node_identity() returns a string that is the same for
+all the nodes of one physical device, so they can be grouped together and
+probed only once.
+
+In order of preference the identity is built from:
+	~ the USB serial number, which survives re-plugging into another port.
+	~ the sysfs path of the USB device.
+	~ the "uniq" attribute of the input device (Bluetooth address, serial...)
+	~ the "phys" attribute of the input device without the "/inputN" suffix.
+	~ the sysfs path of the parent of the input device.
+'''
+
+import os
+
+SYSFS_INPUT = "/sys/class/input"
+
+
+def get_node_identity(path):
+	'''
+	Returns a string identifying the physical device behind the device node
+	at "path" (eg. "/dev/input/mouse3"), or None if it can't be resolved
+	(node not in sysfs, not an input device...).
+	'''
+	node = os.path.basename(path)
+	input_dir = os.path.join(SYSFS_INPUT, node, "device")
+	if not os.path.isdir(input_dir):
+		return None
+	input_dir = os.path.realpath(input_dir)
+
+	usb_dir = _find_usb_device(input_dir)
+	if usb_dir is not None:
+		serial = _read_attr(usb_dir, "serial")
+		if serial:
+			vendor = _read_attr(usb_dir, "idVendor")
+			product = _read_attr(usb_dir, "idProduct")
+			return "usb:%s:%s:%s" % (vendor, product, serial)
+		return "sysfs:%s" % (usb_dir)
+
+	uniq = _read_attr(input_dir, "uniq")
+	if uniq:
+		return "uniq:%s" % (uniq)
+
+	phys = _read_attr(input_dir, "phys")
+	if phys:
+		return "phys:%s" % (phys.rsplit("/input", 1)[0])
+
+	return "sysfs:%s" % (os.path.dirname(input_dir))
+
+
+# Returns the (vendor, product) ids of the input device behind the node at
+# "path", as reported by the kernel, or None if they can't be read.
+# This is what libwacom matches against, so it allows knowing which database
+# (if any) describes a node before probing it.
+def get_node_usbid(path):
+	id_dir = os.path.join(SYSFS_INPUT, os.path.basename(path), "device", "id")
+	vendor = _read_attr(id_dir, "vendor")
+	product = _read_attr(id_dir, "product")
+	if not vendor or not product:
+		return None
+	try:
+		return (int(vendor, 16), int(product, 16))
+	except ValueError:
+		return None
+
+
+# Identity used for devices that are not backed by any node (simulated ones)
+def get_usbid_identity(vendor, model):
+	return "usbid:%04x:%04x" % (vendor, model)
+
+
+# Returns True if "identity" comes from the device itself (its serial
+# number), so it is the same wherever and whenever the device is plugged.
+# Other identities depend on the port or on the order of plugging.
+def is_stable_identity(identity):
+	return identity is not None and identity.startswith(("usb:", "uniq:"))
+
+
+# Walks up from an input device directory in sysfs until the USB device it
+# belongs to. The USB device (not the interface) is the one with "idVendor".
+def _find_usb_device(directory):
+	while directory and directory != "/" and directory.startswith("/sys/devices"):
+		if os.path.exists(os.path.join(directory, "idVendor")):
+			return directory
+		directory = os.path.dirname(directory)
+	return None
+
+
+def _read_attr(directory, name):
+	try:
+		with open(os.path.join(directory, name)) as f:
+			return f.read().strip()
+	except (IOError, OSError):
+		return None
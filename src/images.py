@@ -0,0 +1,226 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# images.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+import tempfile
+
+from threading import Thread, Lock
+from collections import OrderedDict
+from Queue import Queue
+
+from gi.repository import GLib, GdkPixbuf
+
+
+def get_default_images_path():
+	cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return os.path.join(cache_dir, 'gsetwacom', 'layouts')
+
+
+class LayoutImageCache():
+
+	'''
+	Pictures of tablet layouts (the SVGs of libwacom, see
+	DeviceLayout.get_layout_filename()) rasterized at the size they are
+	shown, so an SVG is only rendered once for each size.
+
+	Pictures are keyed by (file, mtime, width, height, scale): an SVG that
+	changes on disk is rendered again. They are kept:
+	~ in memory, the last "max_images" used, as GdkPixbufs.
+	~ on disk, as PNG files in "path", so they survive restarts. Only the
+	  last "max_thumbnails" used are kept, the rest are removed.
+
+	Pictures that are not in memory are loaded, or rendered, in a thread of
+	the cache. Callbacks are always called in the GLib main loop.
+
+	Sizes are rounded up to multiples of SIZE_STEP, so resizing a window
+	bit by bit doesn't render a picture for every pixel.
+	'''
+
+	SIZE_STEP = 32
+
+	def __init__(self, path = None, max_images = 16, max_thumbnails = 64):
+		self._path = path or get_default_images_path()
+		self._max_images = max_images
+		self._max_thumbnails = max_thumbnails
+		self._images = OrderedDict()    # key: GdkPixbuf, least recently used first
+		self._pending = {}              # key: [callbacks] of the requests being rendered
+		self._jobs = Queue()
+		self._thread = None
+		self._lock = Lock()             # only for the statistics
+		self._stats = { 'memory': 0, 'disk': 0, 'rendered': 0, 'failed': 0 }
+
+	def get_path(self):
+		return self._path
+
+	# Returns how many requests were served from memory, from disk, rendered
+	# or failed.
+	def get_stats(self):
+		self._lock.acquire()
+		try:
+			return dict(self._stats)
+		finally:
+			self._lock.release()
+
+	def start(self):
+		if self._thread is not None:
+			return
+		self._thread = Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		if self._thread is not None:
+			self._jobs.put(None)
+			self._thread = None
+
+	# Returns the size "width" x "height" is rendered at (see SIZE_STEP)
+	def get_render_size(self, width, height):
+		step = self.SIZE_STEP
+		return (max((width + step - 1) // step, 1) * step, max((height + step - 1) // step, 1) * step)
+
+	# Asks for the picture of "filename" fitted in "width" x "height"
+	# (logical pixels) at "scale" (see Gtk.Widget.get_scale_factor()).
+	# If it is in memory it is returned right away. Otherwise None is
+	# returned and "callback(pixbuf)" is called once it is ready (pixbuf is
+	# None if it couldn't be rendered).
+	# Must be called from the main loop.
+	def request(self, filename, width, height, scale, callback):
+		key = self._get_key(filename, width, height, scale)
+		if key is None:
+			callback(None)
+			return None
+
+		pixbuf = self._images.get(key)
+		if pixbuf is not None:
+			del self._images[key]
+			self._images[key] = pixbuf
+			self._count('memory')
+			return pixbuf
+
+		if key in self._pending:
+			self._pending[key].append(callback)
+		else:
+			self._pending[key] = [callback]
+			self.start()
+			self._jobs.put(key)
+		return None
+
+	def _get_key(self, filename, width, height, scale):
+		try:
+			mtime = os.stat(filename).st_mtime
+		except (OSError, TypeError):
+			return None
+		width, height = self.get_render_size(width, height)
+		return (filename, mtime, width, height, scale)
+
+	def _count(self, what):
+		self._lock.acquire()
+		self._stats[what] = self._stats[what] + 1
+		self._lock.release()
+
+	def _run(self):
+		while True:
+			key = self._jobs.get()
+			if key is None:
+				break
+			GLib.idle_add(self._on_rendered, key, self._load(key))
+
+	# Runs in the cache thread
+	def _load(self, key):
+		filename, mtime, width, height, scale = key
+		thumbnail = self._get_thumbnail_path(key)
+		if os.path.exists(thumbnail):
+			try:
+				pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumbnail)
+				self._touch(thumbnail)
+				self._count('disk')
+				return pixbuf
+			except GLib.GError:
+				pass    # broken, render it again
+
+		try:
+			pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, width * scale, height * scale, True)
+		except GLib.GError:
+			self._count('failed')
+			return None
+		self._count('rendered')
+		if self._save_thumbnail(pixbuf, thumbnail):
+			self._prune_thumbnails()
+		return pixbuf
+
+	# Written to a temporary file and renamed, so another instance never
+	# reads half a thumbnail. A thumbnail that can't be written is just not
+	# cached on disk. Returns True if it was written.
+	def _save_thumbnail(self, pixbuf, thumbnail):
+		try:
+			if not os.path.isdir(self._path):
+				os.makedirs(self._path)
+			fd, tmp_path = tempfile.mkstemp(prefix = '.layout-', suffix = '.png', dir = self._path)
+			os.close(fd)
+			try:
+				pixbuf.savev(tmp_path, 'png', [], [])
+				os.rename(tmp_path, thumbnail)
+			except:
+				os.unlink(tmp_path)
+				raise
+			return True
+		except (IOError, OSError, GLib.GError):
+			return False
+
+	# The modification time of a thumbnail is the last time it was used
+	def _touch(self, thumbnail):
+		try:
+			os.utime(thumbnail, None)
+		except OSError:
+			pass
+
+	# Removes the thumbnails used least recently beyond "max_thumbnails".
+	# Those of old sizes, scales or versions of an SVG go first, since
+	# nothing asks for them any more.
+	def _prune_thumbnails(self):
+		try:
+			names = os.listdir(self._path)
+		except OSError:
+			return
+		thumbnails = []
+		for name in names:
+			if name.endswith('.png') and not name.startswith('.'):
+				path = os.path.join(self._path, name)
+				try:
+					thumbnails.append((os.path.getmtime(path), path))
+				except OSError:
+					pass    # removed by another instance
+		thumbnails.sort()
+		for (mtime, path) in thumbnails[:max(len(thumbnails) - self._max_thumbnails, 0)]:
+			try:
+				os.unlink(path)
+			except OSError:
+				pass    # removed by another instance
+
+	def _get_thumbnail_path(self, key):
+		return os.path.join(self._path, hashlib.sha1(repr(key)).hexdigest() + '.png')
+
+	# Runs in the main loop
+	def _on_rendered(self, key, pixbuf):
+		if pixbuf is not None:
+			self._images[key] = pixbuf
+			while len(self._images) > self._max_images:
+				self._images.popitem(last = False)
+		for callback in self._pending.pop(key, []):
+			callback(pixbuf)
+		return False
@@ -0,0 +1,137 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# inotify.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Wrapper for the inotify calls of the C library (sys/inotify.h).
+'''
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from libwrapper import *
+
+from ctypes import c_char_p, c_int, c_uint32
+
+
+class InotifyFlags:
+	IN_NONBLOCK    = 0o4000
+	IN_CLOEXEC     = 0o2000000
+
+
+class InotifyMask:
+	IN_MODIFY      = 0x00000002
+	IN_ATTRIB      = 0x00000004
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM  = 0x00000040
+	IN_MOVED_TO    = 0x00000080
+	IN_CREATE      = 0x00000100
+	IN_DELETE      = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF   = 0x00000800
+	IN_IGNORED     = 0x00008000
+	IN_ONLYDIR     = 0x01000000
+
+	# Anything that changes the content of a directory
+	IN_DIR_CHANGES = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class LibInotify(LibraryWrapper):
+
+	@staticmethod
+	def _cdll():
+		return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+	_api_prototypes = {
+		# int inotify_init1(int flags);
+		"inotify_init1": {
+			"argtypes": (c_int,),
+			"restype": c_int,
+			"errcheck": expect_ge_zero
+		},
+
+		# int inotify_add_watch(int fd, const char *pathname, uint32_t mask);
+		"inotify_add_watch": {
+			"argtypes": (c_int, c_char_p, c_uint32),
+			"restype": c_int,
+			"errcheck": expect_ge_zero
+		},
+
+		# int inotify_rm_watch(int fd, int wd);
+		"inotify_rm_watch": {
+			"argtypes": (c_int, c_int),
+			"restype": c_int
+		},
+	}
+
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify():
+
+	'''
+	An inotify instance: a non-blocking file descriptor (see fileno(), to be
+	used with select()) that reports changes in the watched paths.
+	'''
+
+	def __init__(self):
+		self._lib = LibInotify()
+		self._fd = self._lib.inotify_init1(InotifyFlags.IN_NONBLOCK | InotifyFlags.IN_CLOEXEC)
+		self._watches = {}      # wd: path
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+	def fileno(self):
+		return self._fd
+
+	# Raises LibWrapperException if "path" can't be watched
+	def add_watch(self, path, mask = InotifyMask.IN_DIR_CHANGES):
+		wd = self._lib.inotify_add_watch(self._fd, path, mask)
+		self._watches[wd] = path
+		return wd
+
+	# Returns the pending events as a list of (path, mask, name) tuples, where
+	# "path" is the watched path and "name" the file inside it (or "").
+	def read_events(self):
+		events = []
+		while True:
+			try:
+				data = os.read(self._fd, 4096)
+			except OSError as e:
+				if e.errno in (errno.EAGAIN, errno.EINTR):
+					return events
+				raise
+			offset = 0
+			while offset + _EVENT.size <= len(data):
+				wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+				offset = offset + _EVENT.size
+				name = data[offset:offset + length].rstrip(b"\0")
+				offset = offset + length
+				if mask & InotifyMask.IN_IGNORED:
+					self._watches.pop(wd, None)
+					continue
+				events.append((self._watches.get(wd), mask, name))
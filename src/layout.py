@@ -0,0 +1,154 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# layout.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from ctypes import c_int, byref, set_errno
+
+from libwacom import WacomButtonFlags
+
+
+class DeviceLayout(object):
+
+	'''
+	Immutable description of the pad of a tablet model: buttons, touch rings,
+	touch strips and status LEDs.
+
+	It is read from libwacom once per (vendor, model) by DeviceLayout.load()
+	and shared by every Device of that model (see DeviceBroker), so the UI
+	can render a pad mapping without calling into libwacom at all.
+
+	Buttons are numbered from 0, where 0 is libwacom's button 'A'.
+	'''
+
+	__slots__ = ('_button_flags', '_button_led_groups', '_status_leds',
+	             '_has_ring', '_has_ring2', '_ring_num_modes', '_ring2_num_modes',
+	             '_num_strips', '_strips_num_modes', '_layout_filename', '_fingerprint')
+
+	def __init__(self, button_flags = (), button_led_groups = (), status_leds = (),
+	             has_ring = False, has_ring2 = False, ring_num_modes = 0, ring2_num_modes = 0,
+	             num_strips = 0, strips_num_modes = 0, layout_filename = None):
+		init = super(DeviceLayout, self).__setattr__
+		init('_button_flags', array('i', button_flags))            # WacomButtonFlags per button
+		init('_button_led_groups', array('b', button_led_groups))  # LED group per button, -1 for none
+		init('_status_leds', tuple(status_leds))                   # WacomStatusLEDs
+		init('_has_ring', bool(has_ring))
+		init('_has_ring2', bool(has_ring2))
+		init('_ring_num_modes', ring_num_modes)
+		init('_ring2_num_modes', ring2_num_modes)
+		init('_num_strips', num_strips)
+		init('_strips_num_modes', strips_num_modes)
+		init('_layout_filename', layout_filename)
+		init('_fingerprint', hash((tuple(self._button_flags), tuple(self._button_led_groups),
+		                           self._status_leds, self._has_ring, self._has_ring2,
+		                           ring_num_modes, ring2_num_modes, num_strips, strips_num_modes,
+		                           layout_filename)))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("DeviceLayout is immutable")
+
+	# Reads the layout of the tablet "device_p" (a WacomDevice *) from libwacom.
+	# Raises LibWrapperException if libwacom fails.
+	@classmethod
+	def load(cls, lw, device_p):
+		num_buttons = lw.libwacom_get_num_buttons(device_p)
+		buttons = [chr(ord('A') + n) for n in range(num_buttons)]
+
+		# Checked through errno (see ctypes_errcheck), which may still hold
+		# the error of any previous call
+		num_leds = c_int(0)
+		set_errno(0)
+		leds = lw.libwacom_get_status_leds(device_p, byref(num_leds))
+
+		return cls(button_flags = [lw.libwacom_get_button_flag(device_p, b) for b in buttons],
+		           button_led_groups = [lw.libwacom_get_button_led_group(device_p, b) for b in buttons],
+		           status_leds = [leds[n] for n in range(num_leds.value)],
+		           has_ring = lw.libwacom_has_ring(device_p),
+		           has_ring2 = lw.libwacom_has_ring2(device_p),
+		           ring_num_modes = lw.libwacom_get_ring_num_modes(device_p),
+		           ring2_num_modes = lw.libwacom_get_ring2_num_modes(device_p),
+		           num_strips = lw.libwacom_get_num_strips(device_p),
+		           strips_num_modes = lw.libwacom_get_strips_num_modes(device_p),
+		           layout_filename = lw.libwacom_get_layout_filename(device_p))
+
+	# Builds a DeviceLayout from the output of as_dict()
+	@classmethod
+	def from_dict(cls, d):
+		return cls(**dict((str(k), v) for (k, v) in d.items()))
+
+	def get_num_buttons(self):
+		return len(self._button_flags)
+
+	# Returns the WacomButtonFlags of "button" (0 for 'A', 1 for 'B', ...)
+	def get_button_flag(self, button):
+		return self._button_flags[button]
+
+	def get_button_flags(self):
+		return self._button_flags.tolist()
+
+	# Returns the status LED group of "button", or -1 if it has no LED
+	def get_button_led_group(self, button):
+		return self._button_led_groups[button]
+
+	# Returns the buttons that have any of the "flags" set
+	def get_buttons_with_flag(self, flags):
+		return [n for (n, f) in enumerate(self._button_flags) if f & flags]
+
+	# Returns the buttons that switch the mode of a ring or a strip
+	def get_mode_switch_buttons(self):
+		return self.get_buttons_with_flag(WacomButtonFlags.WACOM_BUTTON_MODESWITCH)
+
+	def get_status_leds(self):
+		return self._status_leds
+
+	def get_has_ring(self):
+		return self._has_ring
+
+	def get_has_ring2(self):
+		return self._has_ring2
+
+	def get_ring_num_modes(self):
+		return self._ring_num_modes
+
+	def get_ring2_num_modes(self):
+		return self._ring2_num_modes
+
+	def get_num_strips(self):
+		return self._num_strips
+
+	def get_strips_num_modes(self):
+		return self._strips_num_modes
+
+	# Returns the path to the SVG picture of the tablet, or None
+	def get_layout_filename(self):
+		return self._layout_filename
+
+	def get_fingerprint(self):
+		return self._fingerprint
+
+	def as_dict(self):
+		return {
+			'button_flags': self._button_flags.tolist(),
+			'button_led_groups': self._button_led_groups.tolist(),
+			'status_leds': list(self._status_leds),
+			'has_ring': self._has_ring,
+			'has_ring2': self._has_ring2,
+			'ring_num_modes': self._ring_num_modes,
+			'ring2_num_modes': self._ring2_num_modes,
+			'num_strips': self._num_strips,
+			'strips_num_modes': self._strips_num_modes,
+			'layout_filename': self._layout_filename
+		}
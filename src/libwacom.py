@@ -27,6 +27,8 @@ import ctypes
 import ctypes.util
 import os
 import sys
+import threading
+import contextlib
 
 from libwrapper import *
 
@@ -419,9 +421,6 @@ def libwacom_errcheck(result, func, args, skip_errors = []):
 
 	_error = None
 
-	if not WacomErrorCode.WERROR_NONE in skip_errors:
-		skip_errors.append(WacomErrorCode.WERROR_NONE)
-
 	# Search a "WacomError *" in the parameters list
 	for (num, argtype) in enumerate(func.argtypes):
 		#if argtype == POINTER(WacomError) and args[num] is True:
@@ -445,7 +444,7 @@ def libwacom_errcheck(result, func, args, skip_errors = []):
 
 	#print "[libwacom.libwacom_errcheck()]: Type of _error:", type(_error)
 	#print "[libwacom.libwacom_errcheck()]: _error.code:", _error.code
-	if not _error.code in skip_errors:
+	if _error.code != WacomErrorCode.WERROR_NONE and not _error.code in skip_errors:
 		#print "[libwacom.libwacom_errcheck()]:", "Raising exception"
 		raise LibWacomError(_error, result, func, args)
 
@@ -488,13 +487,33 @@ def libwacom_errcheck_skip_invalid_path(result, func, args):
 	#return libwacom_errcheck(result, func, args)
 
 
+def libwacom_errcheck_status(result, func, args):
+	'''
+	Status-return mode: never raises. Returns a (result, error_code) tuple,
+	where "error_code" is WERROR_NONE unless "result" is NULL.
+
+	This is intended for calls where a miss is expected and frequent, like
+	probing every /dev/input/mouse* with "libwacom_new_from_path": checking a
+	code is much cheaper than raising and catching an exception for each
+	node that is not a Wacom device.
+	Use this error checker only with C prototypes that have a "WacomError *"
+	argument.
+	'''
+	if bool(result):
+		return (result, WacomErrorCode.WERROR_NONE)
+	for (num, argtype) in enumerate(func.argtypes):
+		if argtype == POINTER(WacomError) and args[num]:
+			return (result, args[num].contents.code)
+	return (result, WacomErrorCode.WERROR_NONE)
+
+
 class LibWacomException(LibWrapperException):
 
 	''' 
 	LibWacomException is a base Exception for all Py LibWacom operations
 	'''
 
-	def __init__(self, message):
+	def __init__(self, message = None):
 		super(LibWacomException, self).__init__(message)
 
 
@@ -529,74 +548,64 @@ class LibWacomError(LibWacomException):
 	# "error" is expected to be a WacomError object (not a pointer!)
 	# In case you have a "WacomError *" pointer, make sure to pass 
 	# "error_p.contents" to the constructor of LibWacomError
+	#
+	# Only the raw data is kept here (the WacomError itself may be reused by
+	# the caller, so its code and message are copied). The message is not
+	# formatted until the exception is printed, see __str__().
 	def __init__(self, error, result = None, func = None, args = None):
+		super(LibWacomError, self).__init__()
 		self._error_code = None
-		self._error_msg  = ""
-		self._call = None
-		
+		self._error_msg  = None
+		self._error = None
+		self._result = result
+		self._func = func
+		self._args = args
+
 		if (not error is None) and type(error).__name__ == 'WacomError':
-			#print "[LibWacomError.__init__()]:", "Error passed is a WacomError: ", error.code, error.msg
 			self._error_code = error.code
-			if not error.msg is None: 
-				self._error_msg  = error.msg
-			else:
-				# some libwacom functions don't set a message in case of 
-				# WERROR_UNKNOWN_MODEL
-				if error.code == WacomErrorCode.WERROR_UNKNOWN_MODEL:
-					self._error_msg  = "Unknown Model"
+			self._error_msg  = error.msg
 		else:
-			if not error is None:
-				self._error_msg = repr(error)
-			else: 
-				#self._error_msg = ""
-				#self._error_msg = " "
-				self._error_msg  = "Reason Unknown"
+			self._error = error
 
-		if not (result is None) and (not func is None) and (not args is None):
-			self._call = self.get_call_str(result, func, args)
+	def get_error_code(self):
+		return self._error_code
 
-		if self._error_code is None:
-			if self._call is None:
-				#if len(self._error_msg) == 0:
-				#	#message = "(No LibWacom error)"
-				#	message = ""
-				#else:
-				#	#message = "(No LibWacom error)%s" % (self._error_msg,)
-				#	message = "%s" % (self._error_msg,)
-				if len(self._error_msg) > 0:
-					message = "%s" % (self._error_msg,)
+	def __str__(self):
+		if self._error_code is not None:
+			if self._error_msg is not None:
+				error_msg = self._error_msg
+			elif self._error_code == WacomErrorCode.WERROR_UNKNOWN_MODEL:
+				# some libwacom functions don't set a message in case of 
+				# WERROR_UNKNOWN_MODEL
+				error_msg = "Unknown Model"
 			else:
-				#message = "(No LibWacom error)%s, at %s" % (self._error_msg, self._call)
-				message = "%s, at %s" % (self._error_msg, self._call)
+				error_msg = ""
+		elif self._error is not None:
+			error_msg = repr(self._error)
 		else:
-			if self._call is None:
-				message = "(WacomErrorCode %i) - %s" % (self._error_code, self._error_msg)
-			else:
-				message = "(WacomErrorCode %i) - %s, at %s" % (self._error_code, self._error_msg, self._call)
+			error_msg = "Reason Unknown"
 
-		super(LibWacomError, self).__init__(message)
+		call = None
+		if not (self._result is None) and (not self._func is None) and (not self._args is None):
+			call = self.get_call_str(self._result, self._func, self._args)
+
+		if self._error_code is None:
+			if call is None:
+				return "%s" % (error_msg,)
+			return "%s, at %s" % (error_msg, call)
+		if call is None:
+			return "(WacomErrorCode %i) - %s" % (self._error_code, error_msg)
+		return "(WacomErrorCode %i) - %s, at %s" % (self._error_code, error_msg, call)
 
 	# Returns a str 'function_name(argument_values...)'.
 	def get_call_str(self, result, func, args):
-		strargs = []
-		for (num, arg) in enumerate(func.argtypes):
-			# convert args to str for readable output
-			if arg == c_char_p:
-				strargs.append('"%s"' % args[num].decode("iso8859-1"))
-			elif arg == c_void_p:
-				try:
-					# Ctypes native c_void_p can be casted to "int"
-					strargs.append(hex(int(args[num])))
-				except TypeError:
-					# Other pointer objects fall here, and can't be casted to "int"
-					strargs.append(hex(id(args[num])))
-			else:
-				strargs.append(str(args[num]))
-		return "%s(%s)" % (func.__name__, ", ".join(strargs))
+		return format_call(func, args)
 
 
 class LibWacom(LibraryWrapper):
 
+	_libc = LibC()
+
 	@staticmethod
 	def _cdll():
 		return ctypes.CDLL("libwacom.so.2", use_errno=True)
@@ -636,43 +645,22 @@ class LibWacom(LibraryWrapper):
 		#
 		# Raises LibWacomError
 		#
-		# The list can be iterated with something like:
+		# The list is better walked with iter_devices_from_database(), which
+		# reads it lazily and frees it when done:
 		#
 		# 	lw = LibWacom()
 		# 	db = lw.libwacom_database_new()
 		# 	error = lw.libwacom_error_new()
-		# 	list = None
-		# 	
 		# 	try:
-		# 		i = 0
-		# 		list = lw.libwacom_list_devices_from_database(db, error)
-		# 		while True:
-		# 			device_p = list[i]
-		# 			if not bool(device_p): 
-		# 				break
-		# 			print i, "Device:", device_p.contents.name
-		# 			i = i +  1
+		# 		for device_p in lw.iter_devices_from_database(db, error):
+		# 			print lw.libwacom_get_name(device_p)
 		# 	except LibWrapperException as lwe:
 		# 		print lwe
-		#
-		# 	if bool(list): 
-		# 		lw.libwacom_devices_list_destroy(device_p, deep = True)
-		#
 		# 	lw.libwacom_error_free(byref(error))
 		# 	lw.libwacom_database_destroy(db)
 		#
-		# The list can also be iterated with a "for" loop in this fashion:
-		#
-		# 	i = 0
-		# 	list = lw.libwacom_list_devices_from_database(db, error)
-		# 	for device_p in list:
-		# 		if not bool(device_p):
-		# 			break
-		# 		print i, lw.libwacom_get_name(device_p)
-		# 		i = i + 1
-		#
-		# Note that "libwacom_get_name(device_p)" is the preferred way over
-		# "device_p.contents.name"
+		# If called directly, the list must be released with
+		# libwacom_devices_list_destroy().
 		"libwacom_list_devices_from_database": {
 			"argtypes": (c_void_p, POINTER(WacomError),),
 			"restype": POINTER(POINTER(WacomDevice)),      # Raises LibWacomError
@@ -731,6 +719,16 @@ class LibWacom(LibraryWrapper):
 			"errcheck": libwacom_errcheck_skip_invalid_path   # None for WERROR_INVALID_PATH, LibWacomError for WERROR_INVALID_DB
 		},
 
+		# Same as "libwacom_new_from_path", in status-return mode: it returns 
+		# a (WacomDevice *, WacomErrorCode) tuple and never raises. See 
+		# libwacom_errcheck_status().
+		"libwacom_probe_path": {
+			"symbol": "libwacom_new_from_path",
+			"argtypes": (c_void_p, c_char_p, c_int, POINTER(WacomError)),
+			"restype": POINTER(WacomDevice),
+			"errcheck": libwacom_errcheck_status
+		},
+
 		# WacomDevice* libwacom_new_from_usbid(const WacomDeviceDatabase *db, int vendor_id, int product_id, WacomError *error)
 		#
 		# Returns a pointer to WacomDevice from the given vendor/product IDs.
@@ -826,16 +824,10 @@ class LibWacom(LibraryWrapper):
 		# Returns a pointer to the null-terminated list of possible matches for
 		# this device. Do not modify this pointer or any content!
 		# 
-		# You can iterate the list with something like:
+		# Use iter_matches() to walk it:
 		#
-		#   i = 0
-		#   list = lw.libwacom_get_matches(device)
-		#   while True:
-		#   	match_p = list[i]
-		#   	if not bool(match_p): 
-		#   		break
-		#   	print i, "Match:", match_p.contents.match
-		#   	i = i + 1
+		#   for match_p in lw.iter_matches(device):
+		#   	print lw.libwacom_match_get_match_string(match_p)
 		"libwacom_get_matches": {
 			"argtypes": (POINTER(WacomDevice),),
 			"restype": POINTER(POINTER(WacomMatch)),
@@ -1193,19 +1185,39 @@ class LibWacom(LibraryWrapper):
 
 	}
 
-	# TODO: ask in libwacom distro if we need to add this. 
-	# "list" is a POINTER(POINTER(WacomDevice))
-	# "deep" is a c_bool, indicates whether to also delete each WacomDevice
-	# list = calloc (g_list_length (devices) + 1, sizeof (WacomDevice *));
+	# Generator over the devices in the database "db". The list returned by
+	# libwacom is walked lazily, without copying it, and its container is
+	# freed once the loop ends (or the generator is discarded). The devices
+	# themselves belong to the database and stay valid while it does.
+	# Raises LibWacomError
+	def iter_devices_from_database(self, db, error):
+		list = self.libwacom_list_devices_from_database(db, error)
+		try:
+			for device_p in iter_null_terminated(list):
+				yield device_p
+		finally:
+			if bool(list):
+				self.libwacom_devices_list_destroy(list)
+
+	# Generator over the WacomMatch of "device". Nothing to free here, the
+	# list belongs to the device.
+	# libwacom_get_matches() is checked through errno, which may still hold
+	# the error of any previous call
+	def iter_matches(self, device):
+		ctypes.set_errno(0)
+		return iter_null_terminated(self.libwacom_get_matches(device))
+
+	# "list" is a POINTER(POINTER(WacomDevice)) as returned by
+	# libwacom_list_devices_from_database()
+	# "deep" indicates whether to also delete each WacomDevice. Only for lists
+	# whose devices are not owned by a database.
+	# libwacom allocates the list with calloc() and has no function to
+	# release it, so it is freed here through libc.
 	def libwacom_devices_list_destroy(self, list, deep = False):
-		for device_p in list:
-			if not bool(device_p):
-				break
-			if deep:
+		if deep:
+			for device_p in iter_null_terminated(list):
 				self.libwacom_destroy(device_p)
-			# TODO: delete here the list[i] elements
-			# libwacom does not provide a delete function for this
-			# we could load libc and call free 
+		LibWacom._libc.free(list)
 
 	def get_error_message(self, error):
 		_code = self.libwacom_error_get_code(error)
@@ -1216,3 +1228,72 @@ class LibWacom(LibraryWrapper):
 
 
 
+
+
+class WacomErrorPool(object):
+
+	'''
+	A pool of reusable "WacomError *", so that concurrent callers don't 
+	share (and overwrite) the same error, and no error is allocated per call.
+
+		pool = WacomErrorPool(lw)
+		with pool.error() as error:
+			device_p = lw.libwacom_new_from_path(db, path, fallback, error)
+
+	Errors are reset (code back to WERROR_NONE, message freed) every time 
+	they are returned to the pool. All of them, in use or not, are freed by
+	destroy().
+	'''
+
+	def __init__(self, lw):
+		self._lw = lw
+		self._free = []         # errors available
+		self._all = []          # every error allocated by the pool
+		self._lock = threading.Lock()
+
+	# Returns an error for the exclusive use of the caller, who must give it 
+	# back with release().
+	def acquire(self):
+		self._lock.acquire()
+		try:
+			if self._free:
+				return self._free.pop()
+			error = self._lw.libwacom_error_new()
+			self._all.append(error)
+			return error
+		finally:
+			self._lock.release()
+
+	def release(self, error):
+		self.reset(error)
+		self._lock.acquire()
+		self._free.append(error)
+		self._lock.release()
+
+	# Context manager around acquire() and release()
+	@contextlib.contextmanager
+	def error(self):
+		error = self.acquire()
+		try:
+			yield error
+		finally:
+			self.release(error)
+
+	# Leaves "error" as new, freeing its message. libwacom allocates messages
+	# with g_strdup_printf(), whose memory comes from malloc().
+	def reset(self, error):
+		msg_p = ctypes.cast(ctypes.addressof(error.contents) + WacomError.msg.offset, POINTER(c_void_p))
+		if msg_p[0]:
+			LibWacom._libc.free(msg_p[0])
+			msg_p[0] = None
+		error.contents.code = WacomErrorCode.WERROR_NONE
+
+	def destroy(self):
+		self._lock.acquire()
+		try:
+			for error in self._all:
+				self._lw.libwacom_error_free(ctypes.byref(error))
+			self._all = []
+			self._free = []
+		finally:
+			self._lock.release()
@@ -18,70 +18,78 @@ from ctypes import c_char_p, c_int, c_uint, c_void_p, c_long, c_int32, c_uint16,
 
 # [CHANGE] -- Added LibWrapperException
 class LibWrapperException(Exception):
-	def __init__(self, message):
+	def __init__(self, message = None):
 		# Call the base class constructor with the parameters it needs
 		super(LibWrapperException, self).__init__(message)
 
 
-def raise_error_if(raise_error, result, func, args):
+# [CHANGE] -- Added LibCallError. The message used to be built right away in
+# raise_error_if(), even for errors that are caught and never printed.
+class LibCallError(LibWrapperException):
 	"""
-	Raise an ExecutionError for an unexpected result (raise_error == True).
-
-	The exception message includes the API call (name) plus arguments, the
-	unexpected result and, if errno is not zero, text describing the
-	error number.
+	Raised for an unexpected result of an API call. Only the raw data of the
+	call is kept; the message is formatted when the exception is printed.
 	"""
-	def get_call_str():
-		""" Returns a str 'function_name(argument_values...)'. """
-		strargs = []
-		for (num, arg) in enumerate(func.argtypes):
-			# convert args to str for readable output
-			#print num, type(arg), type(args[num])
-			if arg == c_char_p:
-				strargs.append('"%s"' % args[num].decode("iso8859-1"))
-			elif arg == c_void_p:
-				# [CHANGE] -- Replaced this:
-				#strargs.append(hex(int(args[num])))
-				# [CHANGE] -- for this:
-				#print "YESS!! "
-				#print args[num], type(args[num])
-				#print hex(int(args[num]))
-				#print hex(id(args[num]))
-				#print ctypes.addressof(args[num])
-				#strargs.append("kk")
-				try:
-					# Ctypes native c_void_p can be casted to "int"
-					#print "Object [1]:", args[num]
-					strargs.append(hex(int(args[num])))
-				except TypeError:
-					# Other pointer objects fall here, and can't be casted to "int"
-					#print "Object [2]:", args[num]
-					strargs.append(hex(id(args[num])))
-			else:
-				strargs.append(str(args[num]))
-		return "%s(%s)" % (func.__name__, ", ".join(strargs))
-
-	def get_retval_str():
-		""" Returns a str with the unexpected return value. """
+	def __init__(self, result, func, args, errno = 0):
+		super(LibCallError, self).__init__()
+		self.result = result
+		self.func = func
+		self.call_args = args
+		self.errno = errno
+
+	def __str__(self):
+		"""
+		The message includes the API call (name) plus arguments, the
+		unexpected result and, if errno is not zero, text describing the
+		error number.
+		"""
 		# [CHANGE] -- Replaced this
 		#return ", Unexpected return value: %s" % result
 		# [CHANGE] -- by this:
-		return " - Unexpected return value: %s" % result
-
-	def get_errno_str():
-		""" Returns a str describing the error number or an empty string. """
-		errno = ctypes.get_errno()
-		if errno != 0:
-			return ", errno[%d]: %s" % (errno, os.strerror(errno))
+		msg = "%s - Unexpected return value: %s" % (format_call(self.func, self.call_args), self.result)
+		if self.errno != 0:
+			msg = "%s, errno[%d]: %s" % (msg, self.errno, os.strerror(self.errno))
+		return msg
+
+
+# [CHANGE] -- Moved out of raise_error_if(), so LibCallError and others can
+# format a call only when needed.
+def format_call(func, args):
+	""" Returns a str 'function_name(argument_values...)'. """
+	strargs = []
+	for (num, arg) in enumerate(func.argtypes or ()):
+		# convert args to str for readable output
+		if num >= len(args):
+			break
+		if args[num] is None:
+			# [CHANGE] -- NULL arguments used to crash here
+			strargs.append("NULL")
+		elif arg == c_char_p:
+			strargs.append('"%s"' % args[num].decode("iso8859-1"))
+		elif arg == c_void_p:
+			# [CHANGE] -- Replaced this:
+			#strargs.append(hex(int(args[num])))
+			# [CHANGE] -- for this:
+			try:
+				# Ctypes native c_void_p can be casted to "int"
+				strargs.append(hex(int(args[num])))
+			except TypeError:
+				# Other pointer objects fall here, and can't be casted to "int"
+				strargs.append(hex(id(args[num])))
 		else:
-			return ""
+			strargs.append(str(args[num]))
+	return "%s(%s)" % (func.__name__, ", ".join(strargs))
 
+
+def raise_error_if(raise_error, result, func, args):
+	"""
+	Raise a LibCallError for an unexpected result (raise_error == True).
+	"""
 	if raise_error:
-		msg = "%s%s%s" % (get_call_str(), get_retval_str(), get_errno_str())
 		# [CHANGE] -- Removed from the original base.py @Evemu.
 		#raise evemu.exception.ExecutionError(msg)
-		# [CHANGE] -- Added:
-		raise LibWrapperException(msg)
+		# [CHANGE] -- Added (errno is read now, before anything changes it):
+		raise LibCallError(result, func, args, ctypes.get_errno())
 	else:
 		# If the errcheck function returns the argument tuple it receives
 		# unchanged, ctypes continues the normal processing it does on the
@@ -113,6 +121,26 @@ def expect_not_none(result, func, args):
 	return raise_error_if(result is None or not result, result, func, args)
 	# [CHANGE] -- to match also POINTER results, which evaluate to false in case they are NULL
 
+# [CHANGE] -- Added iter_null_terminated()
+def iter_null_terminated(array):
+	"""
+	Yields the elements of a NULL-terminated array of pointers (eg. the
+	"WacomDevice **" returned by libwacom), stopping at the first NULL one.
+
+	Elements are read one at a time, straight from C memory: no list is
+	built and nothing is copied.
+	"""
+	if not bool(array):
+		return
+	i = 0
+	while True:
+		element = array[i]
+		if not bool(element):
+			return
+		yield element
+		i = i + 1
+
+
 class LibraryWrapper(object):
 	"""
 	Base class for wrapping a shared library.
@@ -130,6 +158,7 @@ class LibraryWrapper(object):
 	# classes.
 	_api_prototypes = {
 		#"API_CALL_NAME": {
+		#    "symbol": name of the C function, optional, defaults to API_CALL_NAME
 		#    "argtypes": sequence of ARGUMENT TYPES,
 		#    "restype": RETURN TYPE,
 		#    "errcheck": callback for return value checking, optional
@@ -155,7 +184,14 @@ class LibraryWrapper(object):
 		# Iterate the API call prototypes.
 		for (name, attrs) in cls._api_prototypes.items():
 			# Get the API call.
-			api_call = getattr(cls._loaded_lib, name)
+			# [CHANGE] -- An optional "symbol" allows several prototypes for
+			# the same C function (eg. with different error checking). They
+			# need their own function pointer: getattr() returns a shared one.
+			if "symbol" in attrs:
+				api_call = cls._loaded_lib._FuncPtr((attrs["symbol"], cls._loaded_lib))
+				api_call.__name__ = attrs["symbol"]
+			else:
+				api_call = getattr(cls._loaded_lib, name)
 			# Add argument and return types.
 			api_call.argtypes = attrs["argtypes"]
 			api_call.restype = attrs["restype"]
@@ -175,8 +211,27 @@ class LibraryWrapper(object):
 		raise NotImplementedError
 
 
+# [CHANGE] -- Restored a minimal LibC, to free memory allocated by other
+# libraries that don't provide a function to do it.
+class LibC(LibraryWrapper):
+	"""
+	Wrapper for API calls to the C library.
+	"""
+
+	@staticmethod
+	def _cdll():
+		return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+	_api_prototypes = {
+		# void free(void *ptr);
+		"free": {
+			"argtypes": (c_void_p,),
+			"restype": None
+		},
+	}
+
+
 # [CHANGE] -- Removed the following classes from the original base.py @Evemu
-# class LibC(LibraryWrapper)
 # class LibEvdev(LibraryWrapper)
 # class LibEvemu(LibraryWrapper)
 # class InputEvent(ctypes.Structure)
@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# loadgen.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Load generator for the device discovery.
+
+Creates virtual tablets through /dev/uinput, with the vendor:model of real
+models taken from the libwacom database, and plugs and unplugs them at
+random while a DeviceScanner scans. At the end it reports, per number of
+connected devices, what a scan costs and how long it took to detect the
+devices plugged and unplugged.
+
+Needs write access to /dev/uinput (usually root):
+
+	sudo ./loadgen.py -n 32 --plug-rate 4 --unplug-rate 2 -t 60
+'''
+
+import os
+import sys
+import time
+import fcntl
+import random
+import struct
+
+from threading import Thread, Lock, Event
+from argparse import ArgumentParser
+
+from error import GsException
+from logger import Logger
+from registry import DeviceRegistry
+from device import DeviceBroker
+from scanner import DeviceScanner
+from database import DatabaseStack
+from libwacom import LibWacom
+from libwrapper import LibWrapperException
+
+WACOM_VENDOR = 0x056a
+
+# linux/input-event-codes.h
+EV_SYN         = 0x00
+EV_KEY         = 0x01
+EV_ABS         = 0x03
+BTN_TOOL_PEN   = 0x140
+BTN_TOUCH      = 0x14a
+BTN_STYLUS     = 0x14b
+ABS_X          = 0x00
+ABS_Y          = 0x01
+ABS_PRESSURE   = 0x18
+ABS_CNT        = 0x40
+BUS_USB        = 0x03
+
+# linux/uinput.h
+UI_DEV_CREATE  = 0x5501
+UI_DEV_DESTROY = 0x5502
+UI_SET_EVBIT   = 0x40045564
+UI_SET_KEYBIT  = 0x40045565
+UI_SET_ABSBIT  = 0x40045567
+UI_SET_PHYS    = 0x4008556c
+UINPUT_MAX_NAME_SIZE = 80
+
+# Every virtual tablet gets the "phys" PHYS_PREFIX + number, which makes its
+# identity "phys:" + PHYS_PREFIX + number (see identity.py).
+PHYS_PREFIX = "gsetwacom-loadgen/"
+
+
+class VirtualTablet():
+
+	'''
+	A pen tablet created through uinput. It appears as /dev/input/mouseN
+	(and eventN) until destroy() is called.
+	'''
+
+	def __init__(self, number, vendor, model, name):
+		self._number = number
+		self._fd = os.open("/dev/uinput", os.O_WRONLY | os.O_NONBLOCK)
+		try:
+			fcntl.ioctl(self._fd, UI_SET_EVBIT, EV_SYN)
+			fcntl.ioctl(self._fd, UI_SET_EVBIT, EV_KEY)
+			fcntl.ioctl(self._fd, UI_SET_EVBIT, EV_ABS)
+			for key in (BTN_TOOL_PEN, BTN_TOUCH, BTN_STYLUS):
+				fcntl.ioctl(self._fd, UI_SET_KEYBIT, key)
+			for axis in (ABS_X, ABS_Y, ABS_PRESSURE):
+				fcntl.ioctl(self._fd, UI_SET_ABSBIT, axis)
+			fcntl.ioctl(self._fd, UI_SET_PHYS, PHYS_PREFIX + str(number) + "\0")
+
+			# struct uinput_user_dev
+			absmax = [0] * ABS_CNT
+			absmax[ABS_X] = 21600
+			absmax[ABS_Y] = 13500
+			absmax[ABS_PRESSURE] = 2047
+			data = struct.pack("%dsHHHHi" % (UINPUT_MAX_NAME_SIZE), name[:UINPUT_MAX_NAME_SIZE - 1],
+			                   BUS_USB, vendor, model, 1, 0)
+			data = data + struct.pack("%di" % (ABS_CNT), *absmax)
+			data = data + struct.pack("%di" % (ABS_CNT * 3), *([0] * ABS_CNT * 3))
+			os.write(self._fd, data)
+			fcntl.ioctl(self._fd, UI_DEV_CREATE)
+		except:
+			os.close(self._fd)
+			raise
+
+	def get_identity(self):
+		return "phys:" + PHYS_PREFIX + str(self._number)
+
+	def destroy(self):
+		if self._fd is not None:
+			try:
+				fcntl.ioctl(self._fd, UI_DEV_DESTROY)
+			finally:
+				os.close(self._fd)
+				self._fd = None
+
+
+class LoadGenerator():
+
+	'''
+	Plugs and unplugs VirtualTablets at random, with the given mean rates
+	(per second), keeping at most "max_devices" plugged at once.
+
+	Every plug and unplug is timestamped, see pop_detected().
+	'''
+
+	TICK = 0.05     # seconds
+
+	def __init__(self, models, max_devices, plug_rate, unplug_rate):
+		self._models = models           # [(vendor, model, name)]
+		self._max = max_devices
+		self._plug_rate = plug_rate
+		self._unplug_rate = unplug_rate
+		self._tablets = {}              # identity: VirtualTablet
+		self._plugged = {}              # identity: time, not yet detected
+		self._unplugged = {}            # identity: time, not yet detected
+		self._lock = Lock()
+		self._stop = Event()
+		self._thread = None
+		self._count = 0
+		self.error = None
+
+	def start(self):
+		self._thread = Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+		self._lock.acquire()
+		for tablet in self._tablets.values():
+			tablet.destroy()
+		self._tablets = {}
+		self._lock.release()
+
+	def get_num_plugged(self):
+		return len(self._tablets)
+
+	# Marks as detected, at time "now", the tablets with the identities in
+	# "plugged" and "unplugged". Returns their detection latencies, as a
+	# (plug latencies, unplug latencies) tuple.
+	def pop_detected(self, plugged, unplugged, now):
+		latencies = ([], [])
+		self._lock.acquire()
+		for identity in plugged:
+			if identity in self._plugged:
+				latencies[0].append(now - self._plugged.pop(identity))
+		for identity in unplugged:
+			if identity in self._unplugged:
+				latencies[1].append(now - self._unplugged.pop(identity))
+		self._lock.release()
+		return latencies
+
+	def _run(self):
+		try:
+			while not self._stop.wait(self.TICK):
+				if len(self._tablets) < self._max and random.random() < self._plug_rate * self.TICK:
+					self._plug()
+				if self._tablets and random.random() < self._unplug_rate * self.TICK:
+					self._unplug()
+		except (OSError, IOError) as e:
+			self.error = e
+
+	def _plug(self):
+		vendor, model, name = random.choice(self._models)
+		tablet = VirtualTablet(self._count, vendor, model, name)
+		self._count = self._count + 1
+		self._lock.acquire()
+		self._tablets[tablet.get_identity()] = tablet
+		self._plugged[tablet.get_identity()] = time.time()
+		self._lock.release()
+
+	def _unplug(self):
+		self._lock.acquire()
+		identity = random.choice(list(self._tablets))
+		tablet = self._tablets.pop(identity)
+		self._plugged.pop(identity, None)
+		self._unplugged[identity] = time.time()
+		self._lock.release()
+		tablet.destroy()
+
+
+class LoadApp():
+
+	'''
+	The part of GSetWacom that DeviceScanner needs: it just collects what
+	every scan reports.
+	'''
+
+	def __init__(self, logger):
+		self._logger = logger
+		self.new = []
+		self.deleted = []
+
+	def get_logger(self):
+		return self._logger
+
+	def on_device_changes(self, devices_running, devices_new, devices_deleted):
+		self.new = [device.get_identity() for device in devices_new]
+		self.deleted = [device.get_identity() for device in devices_deleted]
+
+
+class Report():
+
+	'''
+	Scan costs and detection latencies, grouped by the number of virtual
+	tablets plugged when the scan was made.
+	'''
+
+	def __init__(self):
+		self._rows = {}     # num_devices: [scan times, plug latencies, unplug latencies]
+
+	def add(self, num_devices, scan_time, plug_latencies, unplug_latencies):
+		row = self._rows.setdefault(num_devices, [[], [], []])
+		row[0].append(scan_time)
+		row[1].extend(plug_latencies)
+		row[2].extend(unplug_latencies)
+
+	def write(self, out):
+		out.write("%8s %7s %12s %12s %14s %14s\n" % ("devices", "scans", "scan (ms)", "per dev (ms)", "plug avg/max", "unplug avg/max"))
+		for num_devices in sorted(self._rows):
+			scans, plugs, unplugs = self._rows[num_devices]
+			scan_ms = 1000.0 * sum(scans) / len(scans)
+			out.write("%8d %7d %12.2f %12s %14s %14s\n" % (
+			          num_devices, len(scans), scan_ms,
+			          "%.2f" % (scan_ms / num_devices) if num_devices else "-",
+			          _format_latencies(plugs), _format_latencies(unplugs)))
+
+	# Writes where the scan time went, "stats" as in ScanPipeline.get_stats()
+	def write_stages(self, out, stats):
+		out.write("\n%10s %7s %12s %12s\n" % ("stage", "runs", "avg (ms)", "max (ms)"))
+		for stage in stats:
+			runs, total, longest = stats[stage]
+			out.write("%10s %7d %12.2f %12.2f\n" % (stage, runs, 1000.0 * total / runs if runs else 0, 1000.0 * longest))
+
+
+def _format_latencies(latencies):
+	if not latencies:
+		return "-"
+	return "%.0f/%.0f" % (1000.0 * sum(latencies) / len(latencies), 1000.0 * max(latencies))
+
+
+# Returns [(vendor, model, name)] for the Wacom USB models in the databases
+def get_models(databases):
+	lw = LibWacom()
+	stack = DatabaseStack.load(lw, (databases or []) + [None])
+	usbids = set()
+	for database in stack.get_databases():
+		usbids.update(usbid for usbid in database.get_usbids() if usbid[0] == WACOM_VENDOR and usbid[1] != 0)
+	return [(vendor, model, "Wacom virtual %04x:%04x" % (vendor, model)) for (vendor, model) in sorted(usbids)]
+
+
+def get_arguments():
+	parser = ArgumentParser(description='Plugs and unplugs virtual Wacom tablets while scanning them')
+	parser.add_argument('-n', '--devices', dest='devices', type=int, default=16, help='Maximum number of virtual tablets plugged at once (default 16)')
+	parser.add_argument('--plug-rate', dest='plug_rate', type=float, default=2.0, help='Mean plugs per second (default 2)')
+	parser.add_argument('--unplug-rate', dest='unplug_rate', type=float, default=1.0, help='Mean unplugs per second (default 1)')
+	parser.add_argument('-t', '--time', dest='time', type=float, default=30.0, help='Seconds to run (default 30)')
+	parser.add_argument('-p', '--scan-period', dest='scan_period', type=float, default=0.5, help='Seconds between scans (default 0.5)')
+	parser.add_argument('-b', '--database', dest='databases', action='append', help='LibWacom database path, can be repeated')
+	parser.add_argument('-l', '--loglevel', dest='loglevel', default='error', choices=['debug', 'info', 'warning', 'error', 'fatal'])
+	return parser.parse_args()
+
+
+def main(argv):
+	args = get_arguments()
+	logger = Logger(args.loglevel)
+
+	try:
+		models = get_models(args.databases)
+		broker = DeviceBroker(args.databases)
+	except (GsException, LibWrapperException) as e:
+		logger.error("Couldn't load the libwacom database", e)
+		return 1
+	if not models:
+		logger.error("There are no Wacom models in the libwacom database")
+		return 1
+
+	app = LoadApp(logger)
+	registry = DeviceRegistry()
+	scanner = DeviceScanner(app, registry, broker)
+	generator = LoadGenerator(models, args.devices, args.plug_rate, args.unplug_rate)
+	report = Report()
+
+	try:
+		os.close(os.open("/dev/uinput", os.O_WRONLY))
+	except OSError as e:
+		logger.error("Can't use /dev/uinput", e)
+		return 1
+
+	generator.start()
+	try:
+		end = time.time() + args.time
+		while time.time() < end and generator.error is None:
+			num_devices = generator.get_num_plugged()
+			app.new, app.deleted = [], []
+			start = time.time()
+			scanner.scan()
+			now = time.time()
+			plugs, unplugs = generator.pop_detected(app.new, app.deleted, now)
+			report.add(num_devices, now - start, plugs, unplugs)
+			time.sleep(max(args.scan_period - (now - start), 0))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		generator.stop()
+
+	if generator.error is not None:
+		logger.error("Couldn't create a virtual tablet", generator.error)
+	report.write(sys.stdout)
+	report.write_stages(sys.stdout, scanner.get_pipeline().get_stats())
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,281 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# pipeline.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+The scan, split in stages. Every stage takes a ScanBatch, reads what the
+previous stages left in it and fills in its own part:
+
+	enumerate   config            -> paths     nodes that may be tablets
+	prefilter   paths             -> nodes     ScanNodes worth probing
+	probe       nodes             -> probed    [(ScanNode, WacomDevice *)]
+	describe    probed            -> devices   [Device]
+	reconcile   devices           -> changes   registry updated, in a transaction
+	notify      changes           ->           application notified, transaction committed
+	configure   changes           ->           stored profiles applied, out of the transaction
+
+In discover mode the first four stages are the ones of DeviceBroker
+(enumerate_nodes(), prefilter_nodes()...). When a device path or a
+vendor:model is set, or the broker can't be split in stages (eg. a
+ReplayBroker), "probe" fills "devices" with the broker's find_*() and the
+stages around it have nothing to do.
+
+With a ProbeWorker (see worker.py) the probe and describe stages happen in
+the worker process: "probe" fills "devices" with what it finds.
+'''
+
+import time
+
+from collections import OrderedDict
+
+from error import GsException, GsError
+from libwrapper import LibWrapperException
+from profiles import apply_profiles
+
+STAGES = ('enumerate', 'prefilter', 'probe', 'describe', 'reconcile', 'notify', 'configure')
+
+# Modes of a scan, see ScanBatch.get_mode()
+MODE_PATH     = 'path'
+MODE_USBID    = 'usbid'
+MODE_DISCOVER = 'discover'
+
+
+class ScanNode():
+
+	'''
+	A physical device found under /dev/input, with all its nodes ("paths")
+	and the databases in which it has to be probed ("candidates").
+	'''
+
+	def __init__(self, path, identity, usbid, candidates):
+		self.path = path                # the node to probe
+		self.paths = [path]
+		self.identity = identity        # see identity.py, or None
+		self.usbid = usbid              # (vendor, model), or None
+		self.candidates = candidates    # [Database]
+
+	def add_path(self, path):
+		self.paths.append(path)
+
+
+class ScanBatch():
+
+	'''
+	What one scan carries from stage to stage. "config" is the
+	(path, vendor, model) of the scanner when the scan started.
+	'''
+
+	def __init__(self, config):
+		self.config = config
+		self.paths = []                 # enumerate
+		self.nodes = []                 # prefilter
+		self.probed = []                # probe
+		self.devices = None             # describe (or probe), None until found
+		self.changes = None             # reconcile: (running, new, deleted)
+		self.transaction = None         # reconcile: RegistryTransaction, committed by notify
+		self.error = None               # exception that stopped the scan
+		self.timings = OrderedDict()    # stage: seconds
+
+	def get_mode(self):
+		path, vendor, model = self.config
+		if path:
+			return MODE_PATH
+		elif model:
+			return MODE_USBID
+		return MODE_DISCOVER
+
+	# Returns the timings as "stage 1.23ms, ..." for the logs
+	def format_timings(self):
+		return ", ".join("%s %.2fms" % (stage, 1000.0 * self.timings[stage]) for stage in self.timings)
+
+
+class ScanPipeline():
+
+	'''
+	Runs the stages of a scan over a ScanBatch and keeps how long each one
+	takes, per scan (ScanBatch.timings) and overall (get_stats()).
+
+	Any stage can be replaced with set_stage(), eg. to cache or parallelize
+	it. A stage is a callable that takes the ScanBatch; it may raise
+	GsException or LibWrapperException, which stops the scan and is left in
+	ScanBatch.error. Whatever a stage raises, the registry transaction of
+	the scan, if still open, is rolled back.
+
+	The X server adds the X devices of a tablet a bit after its node shows
+	up, so a profile that couldn't be applied for lack of them is tried
+	again in the next scans, waiting twice as long every time, up to
+	MAX_PROFILE_RETRIES times.
+	'''
+
+	MAX_PROFILE_RETRIES = 6
+	PROFILE_RETRY_DELAY = 1.0   # seconds before the first retry
+
+	def __init__(self, app, registry, broker):
+		self._app = app
+		self._logger = app.get_logger()
+		self._registry = registry
+		self._broker = broker
+		self._profiles = None           # ProfileStore, see set_profile_store()
+		self._worker = None             # ProbeWorker, see set_probe_worker()
+		self._retries = {}              # device id: (profile retries, time of the next one)
+		self._stages = OrderedDict((name, getattr(self, '_' + name)) for name in STAGES)
+		self._stats = OrderedDict((name, [0, 0.0, 0.0]) for name in STAGES)     # stage: [runs, total, max]
+
+	def set_profile_store(self, store):
+		self._profiles = store
+
+	# Makes the probes through "worker" (a ProbeWorker) instead of in this
+	# process. None goes back to probing in-process.
+	def set_probe_worker(self, worker):
+		self._worker = worker
+
+	# Replaces the stage "name" with "stage(batch)"
+	def set_stage(self, name, stage):
+		if name not in self._stages:
+			raise GsError("Couldn't set the scan stage %s" % (name), "Unknown stage")
+		self._stages[name] = stage
+
+	def get_stage(self, name):
+		return self._stages[name]
+
+	# Returns {stage: (runs, total seconds, max seconds)}
+	def get_stats(self):
+		return OrderedDict((name, tuple(self._stats[name])) for name in self._stats)
+
+	def reset_stats(self):
+		for name in self._stats:
+			self._stats[name] = [0, 0.0, 0.0]
+
+	# Runs the stages from "first" to "last" (both included) over "batch".
+	# Returns False if one of them failed (see ScanBatch.error).
+	def run(self, batch, first = STAGES[0], last = STAGES[-1]):
+		names = list(self._stages)
+		for name in names[names.index(first):names.index(last) + 1]:
+			start = time.time()
+			try:
+				self._stages[name](batch)
+			except (GsException, LibWrapperException) as e:
+				batch.error = e
+			except:
+				self._abort(batch)
+				raise
+			finally:
+				took = time.time() - start
+				batch.timings[name] = took
+				stats = self._stats[name]
+				stats[0] = stats[0] + 1
+				stats[1] = stats[1] + took
+				stats[2] = max(stats[2], took)
+			if batch.error is not None:
+				self._abort(batch)
+				return False
+		return True
+
+	def _abort(self, batch):
+		if batch.transaction is not None:
+			batch.transaction.rollback()
+
+	# Whether discovery can be run in stages. A ReplayBroker can't: it only
+	# answers the find_*() calls.
+	def _is_staged(self, batch):
+		return batch.get_mode() == MODE_DISCOVER and getattr(self._broker, 'STAGED', False)
+
+	def _enumerate(self, batch):
+		if self._is_staged(batch):
+			batch.paths = self._broker.enumerate_nodes()
+
+	def _prefilter(self, batch):
+		if self._is_staged(batch):
+			batch.nodes = self._broker.prefilter_nodes(batch.paths)
+
+	def _probe(self, batch):
+		path, vendor, model = batch.config
+		mode = batch.get_mode()
+		finder = self._worker if self._worker is not None and getattr(self._broker, 'STAGED', False) else self._broker
+		if mode == MODE_PATH:
+			self._logger.info("Finding device at " + path)
+			device = finder.find_by_path(path)
+			if device is None:
+				self._logger.info("Device not found at " + path)
+			batch.devices = [device] if device is not None else []
+		elif mode == MODE_USBID:
+			self._logger.info("Simulating " + hex(vendor) + ":" + hex(model))
+			device = finder.find_by_usbid(vendor, model)
+			if device is None:
+				self._logger.warning("Can't simulate a device by vendor " + hex(vendor) + " and model " + hex(model))
+			batch.devices = [device] if device is not None else []
+		elif not self._is_staged(batch):
+			self._logger.info("Discovering connected devices")
+			batch.devices = self._broker.find_all() or []
+		elif finder is self._worker:
+			self._logger.info("Discovering connected devices")
+			batch.devices = self._worker.find_nodes([p for node in batch.nodes for p in node.paths]) if batch.nodes else []
+		else:
+			self._logger.info("Discovering connected devices")
+			for node in batch.nodes:
+				device_p = self._broker.probe_node(node)
+				if bool(device_p):
+					batch.probed.append((node, device_p))
+
+	def _describe(self, batch):
+		if batch.devices is None:
+			batch.devices = [self._broker.describe_node(node, device_p) for (node, device_p) in batch.probed]
+
+	def _reconcile(self, batch):
+		batch.transaction = self._registry.begin_transaction()
+		for device in batch.devices:
+			self._registry.register(device)
+		self._registry.end_checking()
+		batch.changes = (self._registry.get_devices_running(),
+		                 self._registry.get_devices_new(),
+		                 self._registry.get_devices_deleted())
+
+	def _notify(self, batch):
+		with batch.transaction:
+			self._app.on_device_changes(*batch.changes)
+
+	# Profiles of new devices, and of the running ones that have a profile
+	# but had no X devices yet when it was applied (see _retry_profile())
+	def _configure(self, batch):
+		if self._profiles is None:
+			return
+		running, new, deleted = batch.changes
+		for device in deleted:
+			self._retries.pop(device.get_id(), None)
+
+		now = time.time()
+		devices = list(new)
+		for device in running:
+			retry = self._retries.get(device.get_id())
+			if retry is not None and retry[1] <= now:
+				devices.append(device)
+		if not devices:
+			return
+
+		apply_profiles(self._profiles, self._broker, self._registry, devices, self._logger)
+		for device in devices:
+			if device.get_x_devices() is None and self._profiles.get(device):
+				self._retry_profile(device, now)
+			else:
+				self._retries.pop(device.get_id(), None)
+
+	def _retry_profile(self, device, now):
+		retries, _ = self._retries.get(device.get_id(), (0, now))
+		if retries >= self.MAX_PROFILE_RETRIES:
+			self._retries.pop(device.get_id(), None)
+			self._logger.warning("Giving up on the profile of %s, it has no X devices" % (device.get_name()))
+			return
+		self._retries[device.get_id()] = (retries + 1, now + self.PROFILE_RETRY_DELAY * 2 ** retries)
@@ -0,0 +1,191 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# profiles.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import copy
+import json
+import errno
+import tempfile
+
+from threading import Lock
+
+from error import GsException, GsError
+
+
+def get_default_profiles_path():
+	config_dir = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+	return os.path.join(config_dir, 'gsetwacom', 'profiles.json')
+
+
+class ProfileStore():
+
+	'''
+	ProfileStore keeps the configuration of each tablet on disk, so it can be
+	applied again when the tablet is plugged back.
+
+	Profiles are keyed by Device.get_profile_key(), which is stable across
+	re-plugging. Inside a profile, properties are grouped by the name of the
+	X input device they belong to ("Wacom Intuos PT M 2 Pen stylus", ...),
+	since the X device ids change every time:
+
+		{
+		    "usb:056a:033e:8CH00Q1012345": {
+		        "Wacom Intuos PT M 2 Pen stylus": {
+		            "Wacom Pressurecurve": [0, 10, 90, 100],
+		            ...
+		        },
+		        ...
+		    },
+		    ...
+		}
+
+	The whole store is one compact JSON file, loaded once and rewritten
+	atomically (write to a temporary file, then rename) on every save().
+	A file that can't be parsed is moved aside (to "<path>.bad") and
+	reported to "logger", rather than overwritten by the next save().
+
+	A ProfileStore can be used from several threads: profiles are applied
+	and captured by the scanner thread, and saved by the main one on quit.
+	Every method holds the lock of the store, and get() returns a copy.
+	'''
+
+	def __init__(self, path = None, logger = None):
+		self._path = path or get_default_profiles_path()
+		self._logger = logger
+		self._profiles = None       # loaded on first use
+		self._lock = Lock()
+
+	def get_path(self):
+		return self._path
+
+	# Returns the profile of "device" ({x_device_name: {property: values}}),
+	# or None if there is none.
+	def get(self, device):
+		self._lock.acquire()
+		try:
+			return copy.deepcopy(self._load().get(device.get_profile_key()))
+		finally:
+			self._lock.release()
+
+	def set(self, device, profile):
+		self._lock.acquire()
+		try:
+			self._load()[device.get_profile_key()] = profile
+		finally:
+			self._lock.release()
+
+	def remove(self, device):
+		self._lock.acquire()
+		try:
+			self._load().pop(device.get_profile_key(), None)
+		finally:
+			self._lock.release()
+
+	# Makes the properties cached in "device" its profile.
+	# Returns False if there was nothing to keep.
+	def capture(self, device, broker):
+		names = broker.get_x_device_names(device)
+		profile = {}
+		for ((xid, name), values) in device.get_cached_properties().items():
+			if xid in names:
+				profile.setdefault(names[xid], {})[name] = values
+		if not profile:
+			return False
+		self.set(device, profile)
+		return True
+
+	# Writes the stored profile of "device" in one batch (see
+	# PropertyTransaction). Values that the device already has are skipped.
+	# Returns the number of properties written, 0 if there is no profile.
+	# Raises GsError if the properties can't be written.
+	def apply(self, device, broker, registry = None):
+		profile = self.get(device)
+		if not profile:
+			return 0
+
+		tx = broker.begin_properties(device, registry)
+		names = broker.get_x_device_names(device)
+		for xid in names:
+			for (name, values) in profile.get(names[xid], {}).items():
+				tx.set(xid, name, values)
+		return tx.commit()
+
+	# Writes the store to disk, atomically.
+	# Raises GsError if it can't be written.
+	def save(self):
+		self._lock.acquire()
+		try:
+			data = json.dumps(self._load(), separators = (',', ':'), sort_keys = True)
+			directory = os.path.dirname(self._path)
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			fd, tmp_path = tempfile.mkstemp(prefix = '.profiles-', dir = directory)
+			try:
+				with os.fdopen(fd, 'w') as f:
+					f.write(data)
+					f.flush()
+					os.fsync(f.fileno())
+				os.rename(tmp_path, self._path)
+			except:
+				os.unlink(tmp_path)
+				raise
+		except (IOError, OSError) as e:
+			raise GsError("Couldn't save profiles to %s" % (self._path), str(e))
+		finally:
+			self._lock.release()
+
+	# Must be called with the lock held
+	def _load(self):
+		if self._profiles is None:
+			self._profiles = {}
+			try:
+				with open(self._path) as f:
+					profiles = json.load(f)
+				if not isinstance(profiles, dict):
+					raise ValueError("Not a dictionary of profiles")
+				self._profiles = profiles
+			except (IOError, OSError) as e:
+				# No store yet is fine, anything else is worth a warning
+				if e.errno != errno.ENOENT and self._logger is not None:
+					self._logger.warning("Couldn't read the profiles at %s, starting with none" % (self._path), e)
+			except ValueError as e:
+				self._set_aside(e)
+		return self._profiles
+
+	# Moves a broken store aside, so the profiles in it can still be
+	# recovered by hand. Must be called with the lock held.
+	def _set_aside(self, e):
+		bad_path = self._path + '.bad'
+		try:
+			os.rename(self._path, bad_path)
+			moved = "moved to " + bad_path
+		except OSError as oe:
+			moved = "couldn't move it aside: " + str(oe)
+		if self._logger is not None:
+			self._logger.warning("The profiles at %s are broken (%s), starting with none" % (self._path, moved), e)
+
+
+# Applies the stored profiles of "devices" (typically the NEW ones of a scan)
+# logging, not raising, any error. Used by the scanners.
+def apply_profiles(store, broker, registry, devices, logger):
+	for device in devices:
+		try:
+			written = store.apply(device, broker, registry)
+			if written > 0:
+				logger.info("Applied %d properties from the profile of %s" % (written, device.get_name()))
+		except GsException as ge:
+			logger.warning("Couldn't apply the profile of %s" % (device.get_name()), ge)
@@ -0,0 +1,189 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# refresher.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import select
+
+from threading import Thread, Event
+
+from error import GsException, GsError
+from libwrapper import LibWrapperException
+from xinput import XiPropertyBackend
+
+
+class PropertyRefresher():
+
+	'''
+	PropertyRefresher detects properties of the registered devices that have
+	been changed by someone else (xsetwacom, another settings panel...).
+
+	There is one refresher for all the devices, running in one thread with
+	its own connection to the X server:
+	~ If the server supports XInput2 property events, the refresher
+	  subscribes to them and just waits. Only the properties reported as
+	  changed are read again.
+	~ Otherwise it polls, every "period" seconds, the properties cached in
+	  every RUNNING device, all of them in one pass.
+
+	Only properties already cached in a Device (ie. read or written by the
+	application before) are watched. When a value differs from the cached
+	one, the cache is updated, the device is set DIRTY in the registry and
+	"listener(device, names)" is called, in the refresher thread, with the
+	names of the properties that changed.
+
+	Failed rounds are logged to "logger". The refresher waits longer after
+	every failure in a row (up to MAX_BACKOFF seconds), and stops after
+	MAX_FAILURES of them.
+	'''
+
+	MAX_BACKOFF  = 60
+	MAX_FAILURES = 10
+
+	def __init__(self, registry, listener = None, period = 5, backend = None, logger = None):
+		self._registry = registry
+		self._listener = listener
+		self._period = period
+		self._backend = backend
+		self._logger = logger
+		self._events = False
+		self._stop = Event()
+		self._thread = None
+		self._failures = 0          # failed rounds in a row
+
+	# Connects to the X server and starts the refresher thread.
+	# Raises GsError if the X server can't be reached.
+	def start(self):
+		if self._thread is not None:
+			return
+		try:
+			if self._backend is None:
+				self._backend = XiPropertyBackend()
+			self._events = self._backend.select_property_events()
+		except LibWrapperException as lwe:
+			raise GsError("Couldn't start the property refresher", str(lwe))
+
+		self._stop.clear()
+		self._thread = Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		if self._thread is None:
+			return
+		self._stop.set()
+		self._thread.join(self._period + 1)
+		self._thread = None
+
+	def is_event_driven(self):
+		return self._events
+
+	# Returns the number of failed rounds in a row
+	def get_failures(self):
+		return self._failures
+
+	def _run(self):
+		fd = self._backend.get_connection_number() if self._events else None
+		while not self._stop.is_set():
+			try:
+				if self._events:
+					ready, _, _ = select.select([fd], [], [], self._period)
+					if ready:
+						self._refresh_events(self._backend.read_property_events())
+				else:
+					self._stop.wait(self._period)
+					if not self._stop.is_set():
+						self._refresh_all()
+				self._failures = 0
+			except (LibWrapperException, GsException, select.error) as e:
+				# Usually a device that has just vanished, which the scanner
+				# removes soon. The next round will try again.
+				if not self._on_failure(e):
+					break
+
+	# Logs a failed round and waits before the next one. Returns False if
+	# the refresher has to give up.
+	def _on_failure(self, e):
+		self._failures = self._failures + 1
+		if self._failures >= self.MAX_FAILURES:
+			if self._logger is not None:
+				self._logger.error("The property refresher failed %d times in a row, external changes won't be detected any more" % (self._failures), e)
+			return False
+		delay = min(self._period * 2 ** (self._failures - 1), self.MAX_BACKOFF)
+		if self._logger is not None:
+			self._logger.warning("The property refresher failed, retrying in %g seconds" % (delay), e)
+		self._stop.wait(delay)
+		return True
+
+	# Returns { x_device_id: Device } for the devices in the registry
+	def _get_x_device_index(self):
+		index = {}
+		for device in self._registry.get_devices_running():
+			for xid in device.get_x_devices() or ():
+				index[xid] = device
+		return index
+
+	def _refresh_events(self, events):
+		index = self._get_x_device_index()
+		names = {}          # x_device_id: set of property names
+		for (xid, name, what) in events:
+			device = index.get(xid)
+			if device is not None and device.get_cached_property(xid, name) is not None:
+				names.setdefault(xid, set()).add(name)
+
+		changed = {}        # Device: set of property names
+		for xid in names:
+			device = index[xid]
+			changed_names = self._refresh(device, xid, list(names[xid]))
+			if changed_names:
+				changed.setdefault(device, set()).update(changed_names)
+		self._notify(changed)
+
+	def _refresh_all(self):
+		changed = {}
+		for device in self._registry.get_devices_running():
+			cached = {}     # x_device_id: [names]
+			for (xid, name) in device.get_cached_properties():
+				cached.setdefault(xid, []).append(name)
+			for xid in cached:
+				changed_names = self._refresh(device, xid, cached[xid])
+				if changed_names:
+					changed.setdefault(device, set()).update(changed_names)
+		self._notify(changed)
+
+	# Reads the properties "names" of an X device, updates the cache of the
+	# Device and returns the names of those whose value has changed.
+	def _refresh(self, device, xid, names):
+		changed = []
+		serial = device.get_write_serial()
+		properties = self._backend.get_properties(xid, names)
+		# The application has written properties of the device meanwhile: the
+		# values read may be older than the cache, the next round will tell.
+		if device.is_writing() or device.get_write_serial() != serial:
+			return changed
+		for name in names:
+			prop = properties.get(name)
+			if prop is None:
+				continue
+			if device.get_cached_property(xid, name) != prop.values:
+				device.set_cached_property(xid, name, prop.values)
+				changed.append(name)
+		return changed
+
+	def _notify(self, changed):
+		for device in changed:
+			self._registry.set_device_dirty(device)
+			if self._listener is not None:
+				self._listener(device, sorted(changed[device]))
@@ -15,8 +15,14 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from threading import Lock, RLock
+import os
+import json
+import time
+import tempfile
+
+from threading import Lock, RLock, Condition, current_thread
 from error import GsException, GsError
+from device import Device, DeviceDescription
 
 
 TRANSACTION_STATUS_NONE     = 1 << 0	# set by commit(), and initial
@@ -25,6 +31,14 @@ TRANSACTION_STATUS_CHECKING = 1 << 2    # set by start_checking()
 TRANSACTION_STATUS_CKECKED  = 1 << 3    # set by end_checking()
 
 
+SNAPSHOT_VERSION = 1
+
+
+def get_default_snapshot_path():
+	cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return os.path.join(cache_dir, 'gsetwacom', 'registry.json')
+
+
 class GsRegistryException(GsException):
 	pass
 
@@ -47,8 +61,7 @@ class DeviceRegistry():
 	In most cases the registry will contain just one device.
 
 	The registry is transactional, meaning that it can be set to take changes,
-	keep track of the changes and persist (TODO: implement rollback) the 
-	changes.
+	keep track of the changes and persist or roll back the changes.
 
 	A typical flow of operation can be:
 
@@ -102,11 +115,41 @@ class DeviceRegistry():
 	In normal operation (before begin() and after commit()/rollback()), all 
 	existing Devices are supposed to be in STATUS_RUNNING.
 
-	TODO: implement rollback(). Not sure that will be too useful. 
-	Without having studied yet how "rollback" could be implemented, I suspect
-	that it would make the other Registry transaction operations (begin, 
-	register, commit) a bit more expensive. 
-	Thus, still to be determined if this is worth to be implemented.
+	Transactions:
+	~ begin() returns the id of the transaction ("t-001", "t-002"...). A
+	  thread calling begin() while another one is in a transaction waits
+	  for it to commit or roll back, for "lock_timeout" seconds at most (or
+	  forever if None); then GsRegistryLocked is raised. Calling begin() 
+	  again from the thread in the transaction raises GsRegistryException.
+	~ The other transaction operations can only be called by the thread
+	  that called begin(); anyone else gets GsNoTransaction.
+	~ rollback() puts the registry back as it was at begin(). The Devices
+	  themselves are not copied, so changes made to them (eg. their paths)
+	  are kept.
+	~ begin_transaction() wraps all that in a RegistryTransaction, a
+	  context manager that commits at the end of the block and rolls back
+	  if anything raises in it, so an error can't leave the registry locked.
+	~ get_lock_stats() tells how long transactions wait for the lock and 
+	  hold it.
+
+	Hysteresis: 
+	~ A device has to be missed by "max_misses" consecutive checks before it
+	  is DELETED. Until then it stays RUNNING (a loose cable, a slow probe).
+	~ A new device has to stay for "settle_time" seconds before it is NEW. 
+	  Until then it is PENDING: not reported as NEW nor RUNNING, and if it 
+	  goes away in the meantime it is just forgotten.
+	The defaults (1 miss, no settle time) turn both off. Scanners should 
+	check again after get_recheck_delay() seconds, so that unsettled devices
+	are resolved without waiting for the next regular scan.
+
+	Snapshots:
+	~ save_snapshot() writes the committed devices to a file, typically on 
+	  exit, and load_snapshot() brings them back, typically on start, so 
+	  the application can show them before the first scan is over.
+	~ Restored devices are RUNNING, but they have not been seen yet. The 
+	  first check that finds them sets them NEW (so they are handled as any
+	  device plugged in, eg. their profile is applied), and the first one
+	  that misses them sets them DELETED right away, whatever "max_misses".
 
 	TODO: implement locking on the class level, probably. 
 	I don't see why someone would have two Registries, but in case that happens
@@ -132,20 +175,53 @@ class DeviceRegistry():
 	STATUS_CHANGED   = 1 << 3 | STATUS_RUNNING  # found in the system with changes
 	STATUS_DIRTY     = 1 << 4 | STATUS_RUNNING  # set by the app as changed properties
 	STATUS_CHECKING  = 1 << 8 | STATUS_RUNNING  # was running, set to be checked (may or may not be found)
+	STATUS_PENDING   = 1 << 5                   # found, but not for long enough to be NEW (see settle_time)
 
-	def __init__(self):
+	# Seconds after which a device that has been missed (but not DELETED yet)
+	# is worth checking again. See get_recheck_delay().
+	MISS_RECHECK = 1.0
+
+	# "max_misses" is the number of consecutive checks a device has to be 
+	# missing to be DELETED, "settle_time" the seconds a new device has to be 
+	# found for to be NEW. "lock_timeout" is the default of begin().
+	def __init__(self, max_misses = 1, settle_time = 0, lock_timeout = None):
 		'''
 		self._registry = {
 		    "device_id": {
 		        "status": STATUS_NEW,
-				"device": Device object
+				"device": Device object,
+				"previous": status before start_checking(),
+				"misses": consecutive checks the device was not found,
+				"since": time the device was first found
 		    }
 		}
 		'''
 		self._registry = {}	
 		self._reg_lock = RLock()
 
-		self._tx_lock = Lock()
+		# Index of the physical devices in the registry:
+		# { "identity": set(["device_id", ...]) }
+		# See Device.get_identity().
+		self._identities = {}
+
+		# The transaction lock. The thread in a transaction is its owner, the
+		# others wait on the condition. See begin().
+		self._tx_cond = Condition(Lock())
+		self._tx_owner = None
+		self._tx_id = None
+		self._tx_count = 0
+		self._tx_acquired = 0       # time the transaction in progress got the lock
+		self._lock_timeout = lock_timeout
+		self._lock_stats = {
+			'transactions': 0,      # begun
+			'rollbacks': 0,
+			'waits': 0,             # transactions that had to wait for the lock
+			'timeouts': 0,          # begin() calls that gave up waiting
+			'wait_total': 0.0,      # seconds waited for the lock
+			'wait_max': 0.0,
+			'hold_total': 0.0,      # seconds the lock was held
+			'hold_max': 0.0,
+		}
 		self._transaction_status = TRANSACTION_STATUS_NONE
 
 		# Initially, _registry_backup will be a copy of _registry at the time a
@@ -154,6 +230,14 @@ class DeviceRegistry():
 		# started, identified by the tid (transaction id).
 		# _registry_backup = { "t-001": {...}, "t-002"" {...}, ...}
 		self._registry_backup = {}  # Used by rollback. It has to be empty when not in transaction. 
+
+		# Callables notified with (running, new, deleted) lists of Devices
+		# every time a transaction is committed. See add_listener().
+		self._listeners = []
+		self._listeners_lock = Lock()
+
+		self._max_misses = max(max_misses, 1)
+		self._settle_time = settle_time
 		
 	def __del__(self):
 		#self._lw.libwacom_database_destroy(self._db)
@@ -164,35 +248,110 @@ class DeviceRegistry():
 	#
 	# Any concurrent thread trying to begin() a transaction on this Registry 
 	# will have to queue until the thread owning the lock has released it by 
-	# calling commit().
+	# calling commit() or rollback(), for "timeout" seconds at most (the 
+	# "lock_timeout" of the registry if None).
 	# Any concurrent thread trying to perform a transaction operation other
 	# than begin() or register() at this point will result in a GsNoTransaction exception.
 	# Note that "register()" is allowed out of transaction, but that has 
 	# implications. See class description above for more details.
-	def begin(self, checking_implicit = True):
-		# TODO: decide: calling begin(), if we already are in the middle of a 
-		# transaction, should rollback() and then begin() a new transaction?
-		# For now we just return doing nothing in case we already were in a 
-		# transaction.
-		if not self._transaction_status == TRANSACTION_STATUS_NONE:
-			return
-
-		self._tx_lock.acquire()
+	#
+	# Returns the id of the transaction.
+	# Raises GsRegistryLocked if the lock couldn't be acquired in time, and
+	# GsRegistryException if the calling thread is already in a transaction.
+	def begin(self, checking_implicit = True, timeout = None):
+		tid = self._acquire_transaction(self._lock_timeout if timeout is None else timeout)
 		self._transaction_status = TRANSACTION_STATUS_BEGIN
-		self._backup()
+		try:
+			self._backup()
+			if checking_implicit is True:
+				self.start_checking()
+		except:
+			self._registry_backup = {}
+			self._transaction_status = TRANSACTION_STATUS_NONE
+			self._release_transaction()
+			raise
+		return tid
+
+	# Same as begin(), but returns a RegistryTransaction to be used in a 
+	# "with" block.
+	def begin_transaction(self, checking_implicit = True, timeout = None):
+		return RegistryTransaction(self, checking_implicit, timeout)
+
+	# Returns the id of the transaction in progress, or None
+	def get_transaction_id(self):
+		return self._tx_id
+
+	# Returns a copy of the lock statistics: transactions begun, rollbacks,
+	# transactions that had to wait for the lock ("waits"), begin() calls 
+	# that timed out, and the total and maximum seconds waited for the lock
+	# and held.
+	def get_lock_stats(self):
+		self._tx_cond.acquire()
+		try:
+			return dict(self._lock_stats)
+		finally:
+			self._tx_cond.release()
 
-		if checking_implicit is True:
-			self.start_checking()
+	def _acquire_transaction(self, timeout):
+		me = current_thread()
+		start = time.time()
+		self._tx_cond.acquire()
+		try:
+			if self._tx_owner is me:
+				raise GsRegistryException("Already in transaction %s" % (self._tx_id))
+			waited = self._tx_owner is not None
+			while self._tx_owner is not None:
+				left = None
+				if timeout is not None:
+					left = start + timeout - time.time()
+					if left <= 0:
+						self._lock_stats['timeouts'] = self._lock_stats['timeouts'] + 1
+						raise GsRegistryLocked("Registry locked by transaction %s for more than %.2f seconds" % (self._tx_id, timeout))
+				self._tx_cond.wait(left)
+
+			now = time.time()
+			self._tx_owner = me
+			self._tx_count = self._tx_count + 1
+			self._tx_id = "t-%03d" % (self._tx_count)
+			self._tx_acquired = now
+
+			stats = self._lock_stats
+			stats['transactions'] = stats['transactions'] + 1
+			if waited:
+				stats['waits'] = stats['waits'] + 1
+				stats['wait_total'] = stats['wait_total'] + now - start
+				stats['wait_max'] = max(stats['wait_max'], now - start)
+			return self._tx_id
+		finally:
+			self._tx_cond.release()
+
+	def _release_transaction(self):
+		self._tx_cond.acquire()
+		held = time.time() - self._tx_acquired
+		stats = self._lock_stats
+		stats['hold_total'] = stats['hold_total'] + held
+		stats['hold_max'] = max(stats['hold_max'], held)
+		self._tx_owner = None
+		self._tx_id = None
+		self._tx_cond.notify()
+		self._tx_cond.release()
+
+	# Raises GsNoTransaction unless the calling thread is in a transaction
+	def _check_transaction(self, message):
+		if self._transaction_status < TRANSACTION_STATUS_BEGIN:
+			raise GsNoTransaction(message)
+		if self._tx_owner is not current_thread():
+			raise GsNoTransaction("%s (transaction %s belongs to another thread)" % (message, self._tx_id))
 
-		# TODO: functionality: 
-		# return here a transaction number or transaction-id.
+	def set_hysteresis(self, max_misses = 1, settle_time = 0):
+		self._max_misses = max(max_misses, 1)
+		self._settle_time = settle_time
 
 	# Sets all devices to CHECKING. 
 	# Raises GsNoTransaction if begin() has not been called previously.
 	def start_checking(self):
-		if self._transaction_status < TRANSACTION_STATUS_BEGIN:
-			raise GsNoTransaction("can't start checking if not in a transaction")
-		self._set_devices_status(self.STATUS_CHECKING)                              # was: _set_devices_status_to_checking()
+		self._check_transaction("can't start checking if not in a transaction")
+		self._set_devices_checking()                                               # was: _set_devices_status_to_checking()
 		self._transaction_status = TRANSACTION_STATUS_CHECKING
 
 	# In a transaction, registers a device as NEW if it wasn't existing in the
@@ -211,8 +370,7 @@ class DeviceRegistry():
 	# This can be seen as a first stage of "garbage collection".
 	# Raises GsNoTransaction if begin() has not been called previously.
 	def end_checking(self):
-		if self._transaction_status < TRANSACTION_STATUS_BEGIN:
-			raise GsNoTransaction("can't end checking if not in a transaction")
+		self._check_transaction("can't end checking if not in a transaction")
 		self._remove_devices_checking()                                                # was: _remove_devices_on_checking()
 		self._transaction_status = TRANSACTION_STATUS_CKECKED
 
@@ -222,40 +380,63 @@ class DeviceRegistry():
 	# begin() transactions in this registry.
 	# Raises GsNoTransaction if begin() has not been called previously.
 	def commit(self):
-		if self._transaction_status < TRANSACTION_STATUS_BEGIN:
-			raise GsNoTransaction("can't commit if not in a transaction")
+		self._check_transaction("can't commit if not in a transaction")
 		if self._transaction_status < TRANSACTION_STATUS_CKECKED:
 			self._remove_devices_checking()                                            # was: _remove_devices_on_checking()
 			self._transaction_status = TRANSACTION_STATUS_CKECKED
+		changes = (self.get_devices_running(), self.get_devices_new(), self.get_devices_deleted())
 		self._internal_commit()
 		self._registry_backup = {}
-		self._tx_lock.release()
 		self._transaction_status = TRANSACTION_STATUS_NONE
-
+		self._release_transaction()
+		self._notify_listeners(*changes)
+
+	# Adds a callable that is called as listener(running, new, deleted) after
+	# every commit(), once the transaction lock has been released.
+	# Listeners run in the thread that committed the transaction (typically
+	# the scanner thread) so they must not block nor touch the UI directly.
+	def add_listener(self, listener):
+		self._listeners_lock.acquire()
+		if not listener in self._listeners:
+			self._listeners.append(listener)
+		self._listeners_lock.release()
+
+	def remove_listener(self, listener):
+		self._listeners_lock.acquire()
+		if listener in self._listeners:
+			self._listeners.remove(listener)
+		self._listeners_lock.release()
+
+	def _notify_listeners(self, running, new, deleted):
+		self._listeners_lock.acquire()
+		listeners = list(self._listeners)
+		self._listeners_lock.release()
+		for listener in listeners:
+			listener(running, new, deleted)
+
+	# Puts the registry back as it was at begin() and releases the lock.
+	# Raises GsNoTransaction if begin() has not been called previously.
 	def rollback(self):
-		if self._transaction_status < TRANSACTION_STATUS_BEGIN:
-			raise GsNoTransaction("can't rollback if not in a transaction")
-		else:
-			self._restore()
-			self._registry_backup = {}
-			self._tx_lock.release()
-			self._transaction_status = TRANSACTION_STATUS_NONE
+		self._check_transaction("can't rollback if not in a transaction")
+		self._restore()
+		self._registry_backup = {}
+		self._transaction_status = TRANSACTION_STATUS_NONE
+		self._tx_cond.acquire()
+		self._lock_stats['rollbacks'] = self._lock_stats['rollbacks'] + 1
+		self._tx_cond.release()
+		self._release_transaction()
 
-	# Makes a "half-deep" copy of the registry (does not create copies of 
-	# the Device objects).
+	# Makes a "half-deep" copy of the registry (copies the records, but does
+	# not create copies of the Device objects).
 	def _backup(self):
-		#raise GsError("Badass")
-		self._registry_backup = {}
 		self._reg_lock.acquire()
-		for id in self._registry:
-			self._registry_backup[id] = { self._registry[id]['status'], self._registry[id]['device'] }
+		self._registry_backup = dict((id, dict(self._registry[id])) for id in self._registry)
 		self._reg_lock.release()
 	
 	def _restore(self):
-		self._registry = {}
 		self._reg_lock.acquire()
-		for id in self._registry_backup():
-			self._registry[id] = { self._registry_backup[id]['status'], self._registry_backup[id]['device'] }
+		self._registry = dict((id, dict(self._registry_backup[id])) for id in self._registry_backup)
+		self._reindex()
 		self._reg_lock.release()
 
 	# Interal adds or updates a device in the registry. 
@@ -289,17 +470,53 @@ class DeviceRegistry():
 
 		existing_device = self._get_device_by_id(id)
 		if not existing_device:
-			self._registry[id] = { 'status': self.STATUS_NEW, 'device': device }
+			now = time.time()
+			status = self.STATUS_PENDING if self._settle_time > 0 else self.STATUS_NEW
+			self._registry[id] = { 'status': status, 'device': device, 'misses': 0, 'since': now }
+			self._index_device(id, device)
+		elif self._registry[id].pop('restored', False):
+			# Restored from a snapshot, and now seen for real
+			record = self._registry[id]
+			record['misses'] = 0
+			existing_device.set_paths(device.get_paths())
+			if not existing_device.is_full_match(device):
+				record['device'] = device
+			record['status'] = self.STATUS_NEW
+		elif self._registry[id].get('previous', self._registry[id]['status']) == self.STATUS_PENDING:
+			# Still settling. It becomes NEW once it has been around long enough
+			record = self._registry[id]
+			record['device'] = device
+			record['misses'] = 0
+			if time.time() - record['since'] >= self._settle_time:
+				record['status'] = self.STATUS_NEW
+			else:
+				record['status'] = self.STATUS_PENDING
 		else:
+			self._registry[id]['misses'] = 0
+
+			# The nodes of a physical device may come and go (eg. touch is 
+			# switched off) without being a different device.
+			existing_device.set_paths(device.get_paths())
+
 			# Here is where we want to see if the existing record vs the device
 			# in the system are exactly the same or there are some changes like
 			# the device in the system has one more pen, or an airbrush is gone
 			# For now we assume that they are exactly the same (just match 'id')		
 			# Otherwise, if "id" matches but there were chardware changes we 
 			# mark the existing record as CHANGED
+			# Otherwise the record takes the device in the system, so the 
+			# registry always holds the current description.
+			# A DIRTY device found again is still DIRTY: only the application
+			# clears it (see clear_device_dirty()).
 			if existing_device.is_full_match(device):
-				self._set_device_status(id, self.STATUS_RUNNING)
+				if self._registry[id].get('previous', self._registry[id]['status']) == self.STATUS_DIRTY:
+					self._set_device_status(id, self.STATUS_DIRTY)
+				else:
+					self._set_device_status(id, self.STATUS_RUNNING)
 			else:
+				# Same physical device: what is known of it in X still holds
+				device.copy_state(existing_device)
+				self._registry[id]['device'] = device
 				self._set_device_status(id, self.STATUS_CHANGED)
 
 		self._reg_lock.release()
@@ -308,14 +525,36 @@ class DeviceRegistry():
 	def _internal_commit(self):
 		self._reg_lock.acquire()
 
-		for id in self._registry:
+		for id in list(self._registry):
 			if self._registry[id]['status'] == self.STATUS_NEW:
 				self._registry[id]['status'] = self.STATUS_RUNNING
 			elif self._registry[id]['status'] == self.STATUS_DELETED:
+				self._unindex_device(id, self._registry[id]['device'])
 				del self._registry[id]
 
 		self._reg_lock.release()
 
+	def _index_device(self, id, device):
+		identity = device.get_identity()
+		if identity is None:
+			return
+		if not identity in self._identities:
+			self._identities[identity] = set()
+		self._identities[identity].add(id)
+
+	def _unindex_device(self, id, device):
+		ids = self._identities.get(device.get_identity())
+		if ids is None:
+			return
+		ids.discard(id)
+		if len(ids) == 0:
+			del self._identities[device.get_identity()]
+
+	def _reindex(self):
+		self._identities = {}
+		for id in self._registry:
+			self._index_device(id, self._registry[id]['device'])
+
 	def _get_device_by_id(self, id):
 		record = self._registry.get(id)
 		if not record is None:
@@ -336,12 +575,64 @@ class DeviceRegistry():
 			self._registry[id]['status'] = status
 		self._reg_lock.release()
 
+	# Sets all devices to CHECKING, remembering their status so that a device
+	# that is missed, but not deleted yet, can go back to it.
+	def _set_devices_checking(self):
+		self._reg_lock.acquire()
+		for id in self._registry:
+			record = self._registry[id]
+			record['previous'] = record['status']
+			record['status'] = self.STATUS_CHECKING
+		self._reg_lock.release()
+
+	# Devices still CHECKING have been missed. They are set to DELETED after
+	# "max_misses" consecutive misses. Devices PENDING are just forgotten.
 	def _remove_devices_checking(self):
+		self._reg_lock.acquire()
+		for id in list(self._registry):
+			record = self._registry[id]
+			previous = record.pop('previous', None)
+			if record['status'] != self.STATUS_CHECKING:
+				continue
+			record['misses'] = record.get('misses', 0) + 1
+			if previous == self.STATUS_PENDING:
+				self._unindex_device(id, record['device'])
+				del self._registry[id]
+			elif record['misses'] >= self._max_misses or record.get('restored'):
+				record['status'] = self.STATUS_DELETED
+			elif previous == self.STATUS_DIRTY:
+				record['status'] = self.STATUS_DIRTY
+			else:
+				record['status'] = self.STATUS_RUNNING
+		self._reg_lock.release()
+
+	# Returns the seconds after which the registry should be checked again 
+	# to resolve devices that are PENDING or have been missed, or None if 
+	# there are none.
+	def get_recheck_delay(self):
+		delay = None
+		now = time.time()
 		self._reg_lock.acquire()
 		for id in self._registry:
-			if self._registry[id]['status'] == self.STATUS_CHECKING:
-				self._registry[id]['status'] = self.STATUS_DELETED
+			record = self._registry[id]
+			if record['status'] == self.STATUS_PENDING:
+				wait = max(record['since'] + self._settle_time - now, 0)
+			elif record.get('misses', 0) > 0 and record['status'] != self.STATUS_DELETED:
+				wait = self.MISS_RECHECK
+			else:
+				continue
+			delay = wait if delay is None else min(delay, wait)
 		self._reg_lock.release()
+		return delay
+
+	def get_devices_pending(self):
+		devices = []
+		self._reg_lock.acquire()
+		for id in self._registry:
+			if self._registry[id]['status'] == self.STATUS_PENDING:
+				devices.append(self._registry[id]['device'])
+		self._reg_lock.release()
+		return devices
 
 	def get_devices_running(self):
 		devices = []
@@ -370,6 +661,152 @@ class DeviceRegistry():
 		self._reg_lock.release()
 		return devices
 
+	# Returns {device id: status} for every device in the registry
+	def get_device_statuses(self):
+		self._reg_lock.acquire()
+		try:
+			return dict((id, self._registry[id]['status']) for id in self._registry)
+		finally:
+			self._reg_lock.release()
+
+	# Returns what is wrong with the records, as messages ([] if nothing):
+	# out of a check (see end_checking()) nothing is CHECKING nor DELETED,
+	# nothing keeps its status from a previous check, and the identity index
+	# matches the records. Meant for tests, with no check in progress.
+	def check_consistency(self):
+		problems = []
+		self._reg_lock.acquire()
+		try:
+			for id in self._registry:
+				record = self._registry[id]
+				if record['status'] in (self.STATUS_CHECKING, self.STATUS_DELETED):
+					problems.append("%s is %d out of a check" % (id, record['status']))
+				if 'previous' in record:
+					problems.append("%s keeps its status from a previous check" % (id))
+				if record['device'].get_id() != id:
+					problems.append("%s holds the device %s" % (id, record['device'].get_id()))
+				identity = record['device'].get_identity()
+				if identity is not None and id not in self._identities.get(identity, ()):
+					problems.append("%s is not indexed by its identity" % (id))
+			for identity in self._identities:
+				for id in self._identities[identity]:
+					if id not in self._registry:
+						problems.append("The identity %s indexes %s, which is not registered" % (identity, id))
+		finally:
+			self._reg_lock.release()
+		return problems
+
+	# Sets a RUNNING device to DIRTY, meaning that the application changed 
+	# its properties. Devices in any other status are left untouched.
+	def set_device_dirty(self, device):
+		self._reg_lock.acquire()
+		record = self._registry.get(device.get_id())
+		if record is not None and record['status'] in (self.STATUS_RUNNING, self.STATUS_DIRTY):
+			record['status'] = self.STATUS_DIRTY
+		self._reg_lock.release()
+
+	# Sets a DIRTY device back to RUNNING
+	def clear_device_dirty(self, device):
+		self._reg_lock.acquire()
+		record = self._registry.get(device.get_id())
+		if record is not None and record['status'] == self.STATUS_DIRTY:
+			record['status'] = self.STATUS_RUNNING
+		self._reg_lock.release()
+
+	def get_devices_dirty(self):
+		devices = []
+		self._reg_lock.acquire()
+		for id in self._registry:
+			if self._registry[id]['status'] == self.STATUS_DIRTY:
+				devices.append(self._registry[id]['device'])
+		self._reg_lock.release()
+		return devices
+
+	# Writes the committed devices (RUNNING, whatever their flags) to "path",
+	# atomically. Raises GsError if it can't be written.
+	def save_snapshot(self, path = None):
+		path = path or get_default_snapshot_path()
+		self._reg_lock.acquire()
+		try:
+			devices = [self._registry[id]['device'].as_dict() for id in sorted(self._registry)
+			           if self._registry[id]['status'] & self.STATUS_RUNNING]
+		finally:
+			self._reg_lock.release()
+
+		data = json.dumps({'snapshot': SNAPSHOT_VERSION, 'saved': time.time(), 'devices': devices}, separators = (',', ':'))
+		try:
+			directory = os.path.dirname(path)
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			fd, tmp_path = tempfile.mkstemp(prefix = '.registry-', dir = directory)
+			try:
+				with os.fdopen(fd, 'w') as f:
+					f.write(data)
+					f.flush()
+					os.fsync(f.fileno())
+				os.rename(tmp_path, path)
+			except:
+				os.unlink(tmp_path)
+				raise
+		except (IOError, OSError) as e:
+			raise GsError("Couldn't save the registry snapshot to %s" % (path), str(e))
+
+	# Adds the devices saved by save_snapshot() to "path" as RUNNING, but 
+	# restored (see the class description). Devices already in the registry
+	# are left as they are. Must be called out of a transaction.
+	# Returns the Devices restored, [] if there is no snapshot.
+	# Raises GsError if the snapshot can't be read.
+	def load_snapshot(self, path = None):
+		path = path or get_default_snapshot_path()
+		if not os.path.exists(path):
+			return []
+		try:
+			with open(path) as f:
+				snapshot = json.load(f)
+			if snapshot.get('snapshot') != SNAPSHOT_VERSION:
+				raise GsError("Couldn't load the registry snapshot %s" % (path), "Unknown snapshot version")
+			descriptions = {}       # (vendor, model, match): DeviceDescription
+			devices = []
+			for d in snapshot.get('devices', []):
+				key = (d['vendor'], d['model'], d['match'])
+				if not key in descriptions:
+					descriptions[key] = DeviceDescription.from_dict(d)
+				devices.append(Device.from_dict(d, descriptions[key]))
+		except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+			raise GsError("Couldn't load the registry snapshot %s" % (path), str(e))
+
+		restored = []
+		now = time.time()
+		self._reg_lock.acquire()
+		for device in devices:
+			id = device.get_id()
+			if id in self._registry:
+				continue
+			self._registry[id] = { 'status': self.STATUS_RUNNING, 'device': device, 'misses': 0, 'since': now, 'restored': True }
+			self._index_device(id, device)
+			restored.append(device)
+		self._reg_lock.release()
+		return restored
+
+	# Returns the identities of the physical devices in the registry
+	def get_identities(self):
+		self._reg_lock.acquire()
+		identities = list(self._identities)
+		self._reg_lock.release()
+		return identities
+
+	# Returns the Devices (not DELETED nor PENDING) that belong to the 
+	# physical device identified by "identity". See Device.get_identity().
+	def get_devices_by_identity(self, identity):
+		devices = []
+		self._reg_lock.acquire()
+		for id in self._identities.get(identity, ()):
+			if not self._registry[id]['status'] in (self.STATUS_DELETED, self.STATUS_PENDING):
+				devices.append(self._registry[id]['device'])
+		self._reg_lock.release()
+		return devices
+
+
 
 
 
@@ -379,6 +816,56 @@ class DeviceRegistry():
 
 
 
+class RegistryTransaction():
+
+	'''
+	A transaction of a DeviceRegistry, begun when created (see 
+	DeviceRegistry.begin_transaction()):
+
+		with registry.begin_transaction() as tx:
+			for device in devices:
+				registry.register(device)
+			registry.end_checking()
+			app.on_device_changes(...)
+
+	commits when the block ends, and rolls back if anything raises in it.
+	commit() and rollback() can also be called explicitly, eg. when the
+	transaction spans several calls; then the block does nothing else.
+	'''
+
+	def __init__(self, registry, checking_implicit = True, timeout = None):
+		self._registry = registry
+		self._id = registry.begin(checking_implicit, timeout)
+		self._open = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if not self._open:
+			return False
+		if exc_type is None:
+			self.commit()
+		else:
+			self.rollback()
+		return False
+
+	def get_id(self):
+		return self._id
+
+	def is_open(self):
+		return self._open
+
+	def commit(self):
+		if self._open:
+			self._open = False
+			self._registry.commit()
+
+	def rollback(self):
+		if self._open:
+			self._open = False
+			self._registry.rollback()
+
 
 class RegistrRubbish_Deleteme:
 
@@ -0,0 +1,293 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# replay.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Recording and replaying of what the scanners discover.
+
+A trace is a text file with one compact JSON object per line. The first
+line is a header, every other line one call to the broker:
+
+	{"trace": 1, "started": 1500000000.0}
+	{"t": 0.0, "call": "find_all", "args": [], "took": 0.012, "devices": [...]}
+	{"t": 5.013, "call": "find_all", "args": [], "took": 0.009, "error": "..."}
+
+"t" is when the call was made, in seconds from the start of the recording,
+"took" how long it took and "devices" what it returned (see
+Device.as_dict()). Descriptions are written in full for every device: traces
+compress very well, and this keeps every line self-contained.
+
+A discovery run in stages (see pipeline.py) is recorded stage by stage, with
+what each one found: the nodes enumerated, the ScanNodes worth probing and,
+for each of them, whether the probe found a device and which one.
+
+	{"t": 0.0, "call": "enumerate_nodes", "args": [], "took": 0.001, "paths": [...]}
+	{"t": 0.001, "call": "prefilter_nodes", "args": [[...]], "took": 0.002, "nodes": [...]}
+	{"t": 0.003, "call": "probe_node", "args": ["/dev/input/mouse0"], "took": 0.005, "found": true}
+	{"t": 0.008, "call": "describe_node", "args": ["/dev/input/mouse0"], "took": 0.001, "devices": [...]}
+
+When replayed, the stages of one scan (from "enumerate_nodes" to the next
+scan) count as one find_all() call.
+'''
+
+import json
+import time
+
+from threading import Lock
+
+from error import GsException, GsError
+from libwrapper import LibWrapperException
+from device import Device, DeviceDescription
+
+TRACE_VERSION = 1
+
+# The calls that make up one scan in stages, the first one starting it
+STAGE_CALLS = ('enumerate_nodes', 'prefilter_nodes', 'probe_node', 'describe_node')
+
+
+class TraceRecorder():
+
+	'''
+	Wraps a DeviceBroker and writes to a trace the result of every find_*()
+	call, and of every stage of a discovery (enumerate_nodes()...), which is
+	returned unchanged. Anything else is just forwarded to the broker.
+	'''
+
+	def __init__(self, broker, path):
+		self._broker = broker
+		self.STAGED = getattr(broker, 'STAGED', False)     # eg. not when recording a replay
+		self._path = path
+		self._lock = Lock()
+		self._started = time.time()
+		try:
+			self._file = open(path, 'w')
+			self._write({'trace': TRACE_VERSION, 'started': self._started})
+		except (IOError, OSError) as e:
+			raise GsError("Couldn't create the trace %s" % (path), str(e))
+
+	def __getattr__(self, name):
+		return getattr(self._broker, name)
+
+	def close(self):
+		self._lock.acquire()
+		try:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+		finally:
+			self._lock.release()
+
+	def find_by_path(self, path):
+		return self._record('find_by_path', [path])
+
+	def find_by_usbid(self, vendor, model):
+		return self._record('find_by_usbid', [vendor, model])
+
+	def find_all(self):
+		return self._record('find_all', [])
+
+	def enumerate_nodes(self):
+		return self._record('enumerate_nodes', [])
+
+	def prefilter_nodes(self, paths):
+		return self._record('prefilter_nodes', [list(paths)])
+
+	def probe_node(self, node):
+		return self._record('probe_node', [node.path], [node])
+
+	def describe_node(self, node, device_p):
+		return self._record('describe_node', [node.path], [node, device_p])
+
+	# "args" are written to the trace, "call_args" (if not the same)
+	# passed to the broker
+	def _record(self, call, args, call_args = None):
+		start = time.time()
+		entry = {'t': round(start - self._started, 6), 'call': call, 'args': args}
+		try:
+			result = getattr(self._broker, call)(*(args if call_args is None else call_args))
+		except (GsException, LibWrapperException) as e:
+			entry['took'] = round(time.time() - start, 6)
+			entry['error'] = str(e)
+			self._write(entry)
+			raise
+		entry['took'] = round(time.time() - start, 6)
+		if call == 'enumerate_nodes':
+			entry['paths'] = list(result)
+		elif call == 'prefilter_nodes':
+			entry['nodes'] = [self._node_as_dict(node) for node in result]
+		elif call == 'probe_node':
+			entry['found'] = bool(result)
+		elif call == 'find_all':
+			entry['devices'] = [device.as_dict() for device in result or []]
+		else:
+			entry['devices'] = [result.as_dict()] if result is not None else []
+		self._write(entry)
+		return result
+
+	def _node_as_dict(self, node):
+		return {
+			'path': node.path,
+			'paths': list(node.paths),
+			'identity': node.identity,
+			'usbid': list(node.usbid) if node.usbid is not None else None,
+			'candidates': [database.get_path() for database in node.candidates]
+		}
+
+	def _write(self, entry):
+		self._lock.acquire()
+		try:
+			if self._file is not None:
+				self._file.write(json.dumps(entry, separators = (',', ':')))
+				self._file.write('\n')
+				self._file.flush()
+		except (IOError, OSError):
+			# A broken trace must not break the scanner
+			pass
+		finally:
+			self._lock.release()
+
+
+class ReplayBroker():
+
+	'''
+	Stands for a DeviceBroker and answers the find_*() calls with the
+	results of a trace, in order, whatever the arguments. A scan recorded in
+	stages is answered as one find_all() with the devices it described.
+	Once the trace is over, the last result is repeated: the devices stay
+	connected.
+
+	"speed" is the factor applied to the timing of the trace: 1.0 replays it
+	at its original speed (calls are held until their time comes and take as
+	long as they took), 2.0 twice as fast, and 0 as fast as possible.
+
+	There are no real devices behind, so nothing about properties or styli
+	is available.
+	'''
+
+	def __init__(self, path, speed = 1.0):
+		self._speed = speed
+		self._entries = []
+		self._next = 0
+		self._started = None
+		self._lock = Lock()
+		self._descriptions = {}    # (vendor, model, match): DeviceDescription
+		self._load(path)
+
+	def _load(self, path):
+		try:
+			with open(path) as f:
+				header = json.loads(f.readline())
+				if header.get('trace') != TRACE_VERSION:
+					raise GsError("Couldn't load the trace %s" % (path), "Unknown trace version")
+				for line in f:
+					if line.strip():
+						self._add_entry(json.loads(line))
+		except (IOError, OSError, ValueError) as e:
+			raise GsError("Couldn't load the trace %s" % (path), str(e))
+
+	# Merges the stages of a scan into one find_all() entry, from the
+	# start of the first one to the end of the last one
+	def _add_entry(self, entry):
+		call = entry.get('call')
+		if call not in STAGE_CALLS:
+			self._entries.append(entry)
+			return
+		if call == STAGE_CALLS[0] or not self._entries or not self._entries[-1].get('stages'):
+			self._entries.append({'t': entry['t'], 'call': 'find_all', 'args': [], 'devices': [], 'stages': 0})
+		scan = self._entries[-1]
+		scan['stages'] = scan['stages'] + 1
+		scan['took'] = round(entry['t'] + entry.get('took', 0) - scan['t'], 6)
+		if 'error' in entry:
+			scan['error'] = entry['error']
+		elif call == 'describe_node':
+			scan['devices'].extend(entry['devices'])
+
+	# Returns the number of calls in the trace, a scan in stages being one
+	def get_length(self):
+		return len(self._entries)
+
+	# Returns True once every call of the trace has been replayed
+	def is_over(self):
+		return self._next >= len(self._entries)
+
+	def find_by_path(self, path):
+		devices = self._replay()
+		return devices[0] if devices else None
+
+	def find_by_usbid(self, vendor, model):
+		devices = self._replay()
+		return devices[0] if devices else None
+
+	def find_all(self):
+		return self._replay()
+
+	def _replay(self):
+		self._lock.acquire()
+		try:
+			if not self._entries:
+				return []
+			if self._started is None:
+				self._started = time.time()
+			if self._next < len(self._entries):
+				entry = self._entries[self._next]
+				self._next = self._next + 1
+				if self._speed > 0:
+					delay = self._started + entry['t'] / self._speed - time.time()
+					time.sleep(max(delay, 0) + entry.get('took', 0) / self._speed)
+			else:
+				entry = self._entries[-1]
+		finally:
+			self._lock.release()
+
+		if 'error' in entry:
+			raise GsError("Error replayed from the trace", entry['error'])
+		return [self._create_device(d) for d in entry['devices']]
+
+	# Descriptions are interned, as DeviceBroker does
+	def _create_device(self, d):
+		key = (d['vendor'], d['model'], d['match'])
+		description = self._descriptions.get(key)
+		if description is None:
+			description = DeviceDescription.from_dict(d)
+			self._descriptions[key] = description
+		return Device.from_dict(d, description)
+
+	def get_stylus(self, id):
+		return None
+
+	def get_styli(self):
+		return []
+
+	def get_device_styli(self, device):
+		return []
+
+	def get_database_paths(self):
+		return []
+
+	def watch_databases(self, listener = None):
+		pass
+
+	def stop_watching(self):
+		pass
+
+	def _no_properties(self, *args):
+		raise GsError("Device properties are not available", "Replaying a trace")
+
+	get_x_devices = _no_properties
+	get_x_device_names = _no_properties
+	get_properties = _no_properties
+	begin_properties = _no_properties
+	set_properties = _no_properties
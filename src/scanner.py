@@ -20,13 +20,14 @@ import subprocess
 import re
 import glob
 
-from threading import Thread
+from threading import Thread, Event
 from time      import sleep
 
 from ctypes import byref
 from libwrapper import LibWrapperException
 
 from error import GsError
+from pipeline import ScanPipeline, ScanBatch
 
 
 class DeviceScanner():
@@ -35,6 +36,8 @@ class DeviceScanner():
 		self._app = app
 		self._logger = app.get_logger()  # TODO: check that logger is not null, otherwise rise a custom InitException or so
 		self._keep_scanning = False
+		self._thread = None
+		self._wakeup = Event()           # interrupts the sleep between scans, see stop()
 		self._registry = registry        # Registry()
 		self._period = 1                 # seconds
 		self._iterations = 0             # Keeps track of times the scanner scanned
@@ -45,6 +48,7 @@ class DeviceScanner():
 		#self._device_simulation = False    # In simulation mode we simulate the Wacom device by 'vendor:model'
 
 		self._broker = broker
+		self._pipeline = ScanPipeline(app, registry, broker)
 		#self._lw = LibWacom()  # TODO: these two will not be used here but in interface classes (DeviceFinder, ...)
 		#self._db = None        # TODO: check the app argument 'args.device_database' and create the database based on that
 
@@ -104,18 +108,47 @@ class DeviceScanner():
 	#		else:
 			
 
-	def start(self):
+	# Makes the scanner apply the stored profile of every new device
+	def set_profile_store(self, store):
+		self._pipeline.set_profile_store(store)
+
+	# Returns the ScanPipeline, eg. to replace a stage or read its timings
+	def get_pipeline(self):
+		return self._pipeline
+
+	# With "scan_now" the first scan is made right away, in the scanner 
+	# thread, instead of after the first period (eg. when the caller didn't
+	# make a first scan()).
+	def start(self, scan_now = False):
 		# Start thread and loop 
-		thread = Thread(target = self._run)
-		thread.daemon = True
-		thread.start()
-		#self.thread.join()
+		self._keep_scanning = True
+		self._wakeup.clear()
+		self._thread = Thread(target = self._run, args = (scan_now,))
+		self._thread.daemon = True
+		self._thread.start()
+
+	# Stops the scanner thread and waits, at most "timeout" seconds, for the
+	# scan in progress to finish, so the registry is not in a transaction
+	# afterwards.
+	def stop(self, timeout = 5.0):
+		self._keep_scanning = False
+		self._wakeup.set()
+		if self._thread is not None:
+			self._thread.join(timeout)
+			if self._thread.is_alive():
+				self._logger.warning("The scanner thread didn't finish in %.1f seconds" % (timeout))
+			self._thread = None
 
 	# This function is called in a thread. Runs the scan process.
-	def _run(self):
-		self._keep_scanning = True
+	def _run(self, scan_now = False):
 		while self._keep_scanning:
-			sleep(self._period)
+			# Devices that are settling or have been missed are checked sooner
+			if not scan_now:
+				delay = self._registry.get_recheck_delay()
+				self._wakeup.wait(self._period if delay is None else min(self._period, delay))
+				if not self._keep_scanning:
+					break
+			scan_now = False
 			self._logger.debug("Scanning...")
 			self.scan()
 		self._logger.debug("Scanner thread finished!")
@@ -145,46 +178,11 @@ class DeviceScanner():
 		<nothing>             => Try to discover any Wacom device detected (randomly plugged / unplugged)
 		'''
 
-		try:
-			self._registry.begin()    # TODO: wrap try/except for GsRegistryException's
-
-			# find by path
-			if self._device_path:
-				self._logger.info("Finding device at " + self._device_path)
-				device = self._broker.find_by_path(self._device_path)                        # TODO: free internal LibWacom devices later, somehow
-				if device is None:
-					self._logger.info("Device not found at" + self._device_path)
-					return False
-				self._registry.register(device)
-				
-			# simulate vendor:model
-			elif self._device_model:
-				self._logger.info("Simulating " + hex(self._device_vendor) + ":" + hex(self._device_model))
-				device = self._broker.find_by_usbid(self._device_vendor, self._device_model)            # TODO: free internal LibWacom devices later
-				if device is None:
-					self._logger.warning("Can't simulate a device by vendor " + hex(self._device_vendor) + " and model " + hex(self._device_model))
-					return False
-				self._registry.register(device)
-
-			# discover
-			else:
-				self._logger.info("Discovering connected devices")
-				devices = self._broker.find_all()                                                        # TODO: free internal LibWacom devices later
-				for device in devices:
-					self._registry.register(device)
-
-			self._registry.end_checking()
-
-		except LibWrapperException as lwe:
-			self._logger.error(str(lwe))
+		batch = ScanBatch((self._device_path, self._device_vendor, self._device_model))
+		if not self._pipeline.run(batch):
+			self._logger.error(str(batch.error))
 			return False
-		
-		devices_running = self._registry.get_devices_running()
-		devices_new = self._registry.get_devices_new()
-		devices_deleted = self._registry.get_devices_deleted()
-		self._app.on_device_changes(devices_running, devices_new, devices_deleted)
-
-		self._registry.commit()
+		self._logger.debug("Scan: " + batch.format_timings())
 		return True
 		
 		
@@ -0,0 +1,361 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# service.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import socket
+import SocketServer
+
+from threading import Thread, Lock
+from Queue import Queue, Full
+
+from error import GsException
+from registry import DeviceRegistry
+
+# Names of the statuses published, see RegistryService
+STATUS_NAMES = {
+	DeviceRegistry.STATUS_DELETED:  'deleted',
+	DeviceRegistry.STATUS_NEW:      'new',
+	DeviceRegistry.STATUS_RUNNING:  'running',
+	DeviceRegistry.STATUS_CHANGED:  'changed',
+	DeviceRegistry.STATUS_DIRTY:    'dirty',
+	DeviceRegistry.STATUS_CHECKING: 'checking',
+	DeviceRegistry.STATUS_PENDING:  'pending',
+}
+
+
+def get_default_socket_path():
+	runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+	if not runtime_dir:
+		runtime_dir = '/tmp'
+	return os.path.join(runtime_dir, 'gsetwacom-%d.sock' % (os.getuid()))
+
+
+class GsServiceException(GsException):
+	pass
+
+
+class RegistryService():
+
+	'''
+	RegistryService publishes the state of a DeviceRegistry, and the changes
+	committed to it, on a Unix-domain socket.
+
+	This lets other processes (panel applets, scripts, another gsetwacom
+	instance...) share the scanner of the process running the service,
+	instead of loading their own libwacom database and probing every device
+	node by themselves.
+
+	The protocol is line based. Each request and each response is a JSON
+	object terminated by a new line:
+
+		-> {"cmd": "list"}
+		<- {"devices": [{"id": ..., "name": ..., ...}, ...]}
+
+		-> {"cmd": "subscribe"}
+		<- {"devices": [...]}                              # current state
+		<- {"event": "changes", "running": [...], "new": [...], "deleted": [...],
+		    "statuses": {"<id>": "running", "<id>": "dirty", ...}}
+		<- ...                                             # one per commit that changed something
+
+	Once subscribed, the connection only receives events until the client
+	closes it. Events are written by a thread of each subscriber, so a
+	client that stops reading never blocks the scanner: once it falls
+	_Subscriber.MAX_PENDING events behind, it is disconnected.
+	'''
+
+	def __init__(self, registry, path = None):
+		self._registry = registry
+		self._path = path or get_default_socket_path()
+		self._server = None
+		self._subscribers = []
+		self._subs_lock = Lock()
+		self._statuses = {}         # {id: status} last published
+
+	def get_path(self):
+		return self._path
+
+	# Binds the socket and starts serving in a daemon thread.
+	# Raises GsServiceException if the socket can't be created.
+	def start(self):
+		if self._server is not None:
+			return
+
+		# A socket file left behind by a crashed instance would make bind()
+		# fail. If nobody is listening on it, it is safe to remove it.
+		if os.path.exists(self._path):
+			if self._is_alive():
+				raise GsServiceException("A service is already running at %s" % (self._path))
+			os.unlink(self._path)
+
+		# The socket is created with the umask: make it private right away,
+		# rather than in a chmod() after bind().
+		umask = os.umask(0177)
+		try:
+			self._server = _UnixServer(self._path, _RequestHandler)
+		except (socket.error, OSError) as e:
+			raise GsServiceException("Couldn't create the service socket at %s: %s" % (self._path, e))
+		finally:
+			os.umask(umask)
+		self._server.service = self
+		os.chmod(self._path, 0600)
+
+		self._statuses = self._registry.get_device_statuses()
+		self._registry.add_listener(self._on_registry_changes)
+
+		thread = Thread(target = self._server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		if self._server is None:
+			return
+
+		self._registry.remove_listener(self._on_registry_changes)
+		self._server.shutdown()
+		self._server.server_close()
+		self._server = None
+
+		self._subs_lock.acquire()
+		for subscriber in self._subscribers:
+			subscriber.close()
+		self._subscribers = []
+		self._subs_lock.release()
+
+		if os.path.exists(self._path):
+			os.unlink(self._path)
+
+	def _is_alive(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self._path)
+			return True
+		except socket.error:
+			return False
+		finally:
+			sock.close()
+
+	def _get_devices(self):
+		return [device.as_dict() for device in self._registry.get_devices_running()]
+
+	# Queues the current state for a new subscriber and adds it to the list.
+	# Both happen under the lock so no event can get in between.
+	def _subscribe(self, sock, wfile):
+		subscriber = _Subscriber(sock, wfile)
+		self._subs_lock.acquire()
+		try:
+			subscriber.send(_encode({ 'devices': self._get_devices() }))
+			self._subscribers.append(subscriber)
+		finally:
+			self._subs_lock.release()
+		subscriber.start()
+		return subscriber
+
+	def _unsubscribe(self, subscriber):
+		self._subs_lock.acquire()
+		if subscriber in self._subscribers:
+			self._subscribers.remove(subscriber)
+		self._subs_lock.release()
+		subscriber.close()
+
+	# Registry listener. Runs in the thread that committed the transaction,
+	# so it only queues the event. Besides devices added and removed, any
+	# change of status (CHANGED, DIRTY, PENDING...) is published.
+	def _on_registry_changes(self, running, new, deleted):
+		self._subs_lock.acquire()
+		try:
+			statuses = self._registry.get_device_statuses()
+			if len(new) == 0 and len(deleted) == 0 and statuses == self._statuses:
+				return
+			self._statuses = statuses
+
+			line = _encode({
+				'event': 'changes',
+				'running': [device.as_dict() for device in running],
+				'new': [device.as_dict() for device in new],
+				'deleted': [device.as_dict() for device in deleted],
+				'statuses': dict((id, STATUS_NAMES.get(statuses[id], str(statuses[id]))) for id in statuses)
+			})
+
+			# Subscribers that went away, or are too slow, are dropped here
+			for subscriber in list(self._subscribers):
+				if not subscriber.send(line):
+					self._subscribers.remove(subscriber)
+					subscriber.close()
+		finally:
+			self._subs_lock.release()
+
+
+class _Subscriber():
+
+	'''
+	A subscribed connection of RegistryService. The lines sent to it are
+	queued and written by its own thread.
+	'''
+
+	MAX_PENDING = 64
+
+	def __init__(self, sock, wfile):
+		self._sock = sock
+		self._wfile = wfile
+		self._queue = Queue(self.MAX_PENDING)
+		self._closed = False
+
+	def start(self):
+		thread = Thread(target = self._run)
+		thread.daemon = True
+		thread.start()
+
+	# Queues "line". Returns False, without waiting, if the subscriber is
+	# closed or too far behind.
+	def send(self, line):
+		if self._closed:
+			return False
+		try:
+			self._queue.put_nowait(line)
+			return True
+		except Full:
+			return False
+
+	# Shutting the socket down wakes up both the writer, if it is blocked
+	# on a client that doesn't read, and the request handler.
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		try:
+			self._sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		try:
+			self._queue.put_nowait(None)
+		except Full:
+			pass        # the writer will see _closed after its current line
+
+	def _run(self):
+		while not self._closed:
+			line = self._queue.get()
+			if line is None:
+				break
+			try:
+				self._wfile.write(line)
+				self._wfile.flush()
+			except (socket.error, IOError, ValueError):
+				break
+		self.close()
+
+
+class RegistryClient():
+
+	'''
+	Client side of RegistryService.
+
+		client = RegistryClient()
+		devices = client.list_devices()
+		for event in client.subscribe():
+			print event['new'], event['deleted']
+	'''
+
+	def __init__(self, path = None):
+		self._path = path or get_default_socket_path()
+
+	def list_devices(self):
+		sock, rfile = self._connect()
+		try:
+			self._send(sock, { 'cmd': 'list' })
+			return self._receive(rfile)['devices']
+		finally:
+			rfile.close()
+			sock.close()
+
+	# Generator yielding one event dictionary per change in the registry.
+	# The first event is the current state, as returned by list_devices().
+	def subscribe(self):
+		sock, rfile = self._connect()
+		try:
+			self._send(sock, { 'cmd': 'subscribe' })
+			while True:
+				yield self._receive(rfile)
+		finally:
+			rfile.close()
+			sock.close()
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self._path)
+		except socket.error as e:
+			sock.close()
+			raise GsServiceException("Couldn't connect to the service at %s: %s" % (self._path, e))
+		return sock, sock.makefile('rb')
+
+	def _send(self, sock, message):
+		sock.sendall(_encode(message))
+
+	def _receive(self, rfile):
+		line = rfile.readline()
+		if not line:
+			raise GsServiceException("The service closed the connection")
+		return json.loads(line)
+
+
+def _encode(message):
+	return json.dumps(message, separators = (',', ':')) + '\n'
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+	def handle(self):
+		service = self.server.service
+		for line in iter(self.rfile.readline, ''):
+			try:
+				request = json.loads(line)
+			except ValueError:
+				self._reply({ 'error': 'malformed request' })
+				continue
+
+			cmd = request.get('cmd') if isinstance(request, dict) else None
+			if cmd == 'list':
+				self._reply({ 'devices': service._get_devices() })
+			elif cmd == 'subscribe':
+				subscriber = service._subscribe(self.request, self.wfile)
+				# Keep the connection open until the client goes away, or the
+				# service drops it. Events are written by the subscriber.
+				try:
+					while self.rfile.readline():
+						pass
+				except (socket.error, IOError):
+					pass
+				service._unsubscribe(subscriber)
+				return
+			else:
+				self._reply({ 'error': 'unknown command %s' % (cmd) })
+
+	def _reply(self, message):
+		self.wfile.write(_encode(message))
+		self.wfile.flush()
+
+	# A dropped subscriber may leave unsent data in wfile
+	def finish(self):
+		try:
+			SocketServer.StreamRequestHandler.finish(self)
+		except (socket.error, IOError):
+			pass
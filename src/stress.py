@@ -0,0 +1,332 @@
+#!/usr/bin/python
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# stress.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Concurrency stress test and benchmark for DeviceRegistry.
+
+Runs, all at once against one registry:
+~ scanners: transactions that register a random subset of a pool of fake
+  devices, like a scan does, and sometimes roll back on purpose.
+~ readers: what the UI, the service and the refresher do, ie. the
+  get_devices_*() calls and setting devices DIRTY.
+~ registrars: register() out of any transaction.
+
+Every operation waits a random time before it starts, and Python switches
+threads far more often than usual (see --switch), so every run tries
+different interleavings; --seed repeats the random choices, not the
+interleavings.
+
+While running, and once more at the end, the invariants of the registry
+are checked. Then the throughput and the latency of every operation are
+reported, with the lock statistics of the registry. The exit status is 1
+if any invariant was broken or any operation raised something unexpected.
+
+	./stress.py -t 10 --scanners 4 --readers 4 --registrars 2
+'''
+
+import sys
+import time
+import random
+import traceback
+
+from threading import Thread, Lock, Event
+from argparse import ArgumentParser
+
+from registry import DeviceRegistry, GsRegistryLocked
+from device import Device, DeviceDescription
+
+
+class Rollback(Exception):
+	pass
+
+
+class Stats():
+
+	'''
+	Latencies of every operation, by name.
+	'''
+
+	def __init__(self):
+		self._latencies = {}    # operation: [seconds]
+		self._lock = Lock()
+
+	def add(self, operation, seconds):
+		self._lock.acquire()
+		self._latencies.setdefault(operation, []).append(seconds)
+		self._lock.release()
+
+	def write(self, out, elapsed):
+		out.write("%-22s %9s %10s %10s %10s %10s %10s\n" % ("operation", "count", "ops/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "max (ms)"))
+		for operation in sorted(self._latencies):
+			latencies = sorted(self._latencies[operation])
+			out.write("%-22s %9d %10.0f %10.3f %10.3f %10.3f %10.3f\n" % (
+			          operation, len(latencies), len(latencies) / elapsed,
+			          1000.0 * _percentile(latencies, 0.50), 1000.0 * _percentile(latencies, 0.95),
+			          1000.0 * _percentile(latencies, 0.99), 1000.0 * latencies[-1]))
+
+
+def _percentile(values, fraction):
+	return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Harness():
+
+	'''
+	Runs the workers against "registry" and keeps the violations found.
+	'''
+
+	def __init__(self, registry, devices, args):
+		self._registry = registry
+		self._devices = devices
+		self._args = args
+		self._stats = Stats()
+		self._stop = Event()
+		self._violations = []
+		self._violations_lock = Lock()
+		self._inside = 0                # threads in a transaction, must be 0 or 1
+		self._inside_lock = Lock()
+		self._commits = 0
+		self._notified = 0              # commits seen by the listener
+		self._counts_lock = Lock()
+		registry.add_listener(self._on_commit)
+
+	def get_stats(self):
+		return self._stats
+
+	def get_violations(self):
+		return list(self._violations)
+
+	def violation(self, message):
+		self._violations_lock.acquire()
+		self._violations.append(message)
+		self._violations_lock.release()
+
+	def run(self, duration):
+		workers = []
+		for n in range(self._args.scanners):
+			workers.append(Thread(target = self._worker, args = (self._scan, random.Random(self._args.seed + n))))
+		for n in range(self._args.readers):
+			workers.append(Thread(target = self._worker, args = (self._read, random.Random(self._args.seed + 100 + n))))
+		for n in range(self._args.registrars):
+			workers.append(Thread(target = self._worker, args = (self._register, random.Random(self._args.seed + 200 + n))))
+		workers.append(Thread(target = self._worker, args = (self._check, random.Random(self._args.seed + 300))))
+
+		for worker in workers:
+			worker.daemon = True
+			worker.start()
+		self._stop.wait(duration)
+		self._stop.set()
+		for worker in workers:
+			worker.join(self._args.lock_timeout + 1)
+			if worker.is_alive():
+				self.violation("A worker is stuck, the registry is probably deadlocked")
+
+		self._check_all()
+		if self._commits != self._notified:
+			self.violation("%d commits but %d notifications" % (self._commits, self._notified))
+
+	def _worker(self, operation, rand):
+		while not self._stop.is_set():
+			time.sleep(rand.random() * self._args.jitter)
+			try:
+				operation(rand)
+			except GsRegistryLocked:
+				pass    # timed by _begin()
+			except Exception:
+				self.violation("Unexpected exception:\n" + traceback.format_exc())
+
+	def _timed(self, operation, function, *args):
+		start = time.time()
+		result = function(*args)
+		self._stats.add(operation, time.time() - start)
+		return result
+
+	# Begins a transaction, timing how long it took to get it or, if the
+	# registry stayed locked, how long it was waited for
+	def _begin(self, **kwargs):
+		start = time.time()
+		try:
+			tx = self._registry.begin_transaction(**kwargs)
+		except GsRegistryLocked:
+			self._stats.add('timeout', time.time() - start)
+			raise
+		self._stats.add('begin', time.time() - start)
+		return tx
+
+	def _on_commit(self, running, new, deleted):
+		self._counts_lock.acquire()
+		self._notified = self._notified + 1
+		self._counts_lock.release()
+
+	def _enter(self):
+		self._inside_lock.acquire()
+		self._inside = self._inside + 1
+		inside = self._inside
+		self._inside_lock.release()
+		if inside > 1:
+			self.violation("%d threads in a transaction at once" % (inside))
+
+	def _leave(self):
+		self._inside_lock.acquire()
+		self._inside = self._inside - 1
+		self._inside_lock.release()
+
+	# A scan: found devices are a random subset of the pool
+	def _scan(self, rand):
+		found = rand.sample(self._devices, rand.randint(0, len(self._devices)))
+		start = time.time()
+		tx = self._begin()
+		self._enter()
+		try:
+			with tx:
+				# Left before the lock is released, or the next one in would
+				# see two threads inside
+				try:
+					for device in found:
+						self._timed('register', self._registry.register, _copy(device))
+					self._timed('end_checking', self._registry.end_checking)
+					running = self._registry.get_devices_running()
+					new = self._registry.get_devices_new()
+					deleted = self._registry.get_devices_deleted()
+					self._check_changes(found, running, new, deleted)
+					if rand.random() < self._args.rollback_rate:
+						raise Rollback(time.time())
+				finally:
+					self._leave()
+				self._timed('commit', tx.commit)
+			self._count_commit()
+		except Rollback as r:
+			# From the raise, through __exit__(), to the registry restored
+			self._stats.add('rollback', time.time() - r.args[0])
+		self._stats.add('transaction', time.time() - start)
+
+	def _count_commit(self):
+		self._counts_lock.acquire()
+		self._commits = self._commits + 1
+		self._counts_lock.release()
+
+	# What the application does while scans are going on
+	def _read(self, rand):
+		operation = rand.choice(('get_devices_running', 'get_devices_new', 'get_devices_deleted',
+		                         'get_devices_dirty', 'get_devices_pending', 'get_identities',
+		                         'get_devices_by_identity', 'get_recheck_delay', 'set_device_dirty',
+		                         'clear_device_dirty'))
+		if operation == 'get_devices_by_identity':
+			result = self._timed(operation, self._registry.get_devices_by_identity, rand.choice(self._devices).get_identity())
+		elif operation in ('set_device_dirty', 'clear_device_dirty'):
+			result = self._timed(operation, getattr(self._registry, operation), rand.choice(self._devices))
+		else:
+			result = self._timed(operation, getattr(self._registry, operation))
+		if isinstance(result, list) and len(set(map(id, result))) != len(result):
+			self.violation("%s returned the same device twice" % (operation))
+
+	def _register(self, rand):
+		self._timed('register (no tx)', self._registry.register, _copy(rand.choice(self._devices)))
+
+	def _check(self, rand):
+		time.sleep(0.1)
+		self._check_all()
+
+	# Within a scan: every device found is NEW, PENDING or RUNNING, and
+	# every device reported belongs to the pool.
+	def _check_changes(self, found, running, new, deleted):
+		ids = set(device.get_id() for device in self._devices)
+		reported = set(device.get_id() for device in running + new + deleted)
+		if not reported <= ids:
+			self.violation("Unknown devices reported: %s" % (sorted(reported - ids)))
+		live = set(device.get_id() for device in running + new + self._registry.get_devices_pending())
+		missing = set(device.get_id() for device in found) - live
+		if missing:
+			self.violation("Devices found but not registered: %s" % (sorted(missing)))
+		both = set(device.get_id() for device in deleted) & set(device.get_id() for device in running + new)
+		if both:
+			self.violation("Devices both deleted and alive: %s" % (sorted(both)))
+
+	# Out of any scan the registry must be consistent (see
+	# DeviceRegistry.check_consistency())
+	def _check_all(self):
+		with self._begin(checking_implicit = False, timeout = self._args.lock_timeout):
+			self._enter()
+			try:
+				for problem in self._registry.check_consistency():
+					self.violation(problem)
+			finally:
+				self._leave()
+		self._count_commit()
+
+
+# Every scan finds new Device objects, not the ones in the registry
+def _copy(device):
+	return Device(device.get_description(), device.get_path(), device.get_identity())
+
+
+def get_devices(count):
+	descriptions = [DeviceDescription(0x056a, model, 1, name = "Wacom stress %04x" % (model)) for model in (0x0027, 0x033e, 0x0357)]
+	return [Device(descriptions[n % len(descriptions)], "/dev/input/mouse%d" % (n), "phys:stress/%d" % (n)) for n in range(count)]
+
+
+def get_arguments():
+	parser = ArgumentParser(description='Stresses DeviceRegistry with concurrent scans, readers and registrations')
+	parser.add_argument('-t', '--time', dest='time', type=float, default=5.0, help='Seconds to run (default 5)')
+	parser.add_argument('--scanners', dest='scanners', type=int, default=2, help='Threads running scan transactions (default 2)')
+	parser.add_argument('--readers', dest='readers', type=int, default=4, help='Threads reading the registry (default 4)')
+	parser.add_argument('--registrars', dest='registrars', type=int, default=1, help='Threads registering out of transactions (default 1)')
+	parser.add_argument('-n', '--devices', dest='devices', type=int, default=8, help='Size of the pool of fake devices (default 8)')
+	parser.add_argument('--misses', dest='max_misses', type=int, default=2, help='max_misses of the registry (default 2)')
+	parser.add_argument('--settle', dest='settle_time', type=float, default=0.01, help='settle_time of the registry (default 0.01)')
+	parser.add_argument('--lock-timeout', dest='lock_timeout', type=float, default=2.0, help='lock_timeout of the registry (default 2)')
+	parser.add_argument('--rollback-rate', dest='rollback_rate', type=float, default=0.1, help='Fraction of scans rolled back (default 0.1)')
+	parser.add_argument('--jitter', dest='jitter', type=float, default=0.001, help='Maximum seconds to wait before every operation (default 0.001)')
+	parser.add_argument('--switch', dest='switch', type=int, default=10, help='Bytecodes between thread switches (default 10, Python\'s is 100)')
+	parser.add_argument('--seed', dest='seed', type=int, default=None, help='Seed of the random choices')
+	return parser.parse_args()
+
+
+def main(argv):
+	args = get_arguments()
+	if args.seed is None:
+		args.seed = random.randint(0, 1 << 30)
+	sys.setcheckinterval(args.switch)
+
+	registry = DeviceRegistry(args.max_misses, args.settle_time, args.lock_timeout)
+	harness = Harness(registry, get_devices(args.devices), args)
+	start = time.time()
+	harness.run(args.time)
+	elapsed = time.time() - start
+
+	sys.stdout.write("seed %d, %.1f seconds\n\n" % (args.seed, elapsed))
+	harness.get_stats().write(sys.stdout, elapsed)
+	stats = registry.get_lock_stats()
+	sys.stdout.write("\ntransactions %d, rollbacks %d, waits %d, timeouts %d\n" % (
+	                 stats['transactions'], stats['rollbacks'], stats['waits'], stats['timeouts']))
+	sys.stdout.write("lock wait avg %.3fms max %.3fms, hold avg %.3fms max %.3fms\n" % (
+	                 1000.0 * stats['wait_total'] / max(stats['waits'], 1), 1000.0 * stats['wait_max'],
+	                 1000.0 * stats['hold_total'] / max(stats['transactions'], 1), 1000.0 * stats['hold_max']))
+
+	violations = harness.get_violations()
+	if violations:
+		sys.stdout.write("\n%d violation(s):\n" % (len(violations)))
+		for violation in violations[:20]:
+			sys.stdout.write("~ %s\n" % (violation))
+		return 1
+	sys.stdout.write("\nNo violations\n")
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,203 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# stylus.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Lock
+from ctypes import c_int, byref, set_errno
+
+
+class Stylus(object):
+
+	'''
+	Immutable description of a stylus (pen, eraser, airbrush, puck...) as
+	found in the libwacom stylus database. See WacomStylus in libwacom.py.
+	'''
+
+	__slots__ = ('_id', '_name', '_num_buttons', '_has_eraser', '_is_eraser',
+	             '_has_lens', '_has_wheel', '_type', '_axes')
+
+	def __init__(self, id, name, num_buttons = 0, has_eraser = False, is_eraser = False,
+	             has_lens = False, has_wheel = False, type = 0, axes = 0):
+		init = super(Stylus, self).__setattr__
+		init('_id', id)
+		init('_name', name)
+		init('_num_buttons', num_buttons)
+		init('_has_eraser', bool(has_eraser))
+		init('_is_eraser', bool(is_eraser))
+		init('_has_lens', bool(has_lens))
+		init('_has_wheel', bool(has_wheel))
+		init('_type', type)                  # WacomStylusType
+		init('_axes', axes)                  # WacomAxisTypeFlags
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Stylus is immutable")
+
+	def get_id(self):
+		return self._id
+
+	def get_name(self):
+		return self._name
+
+	def get_num_buttons(self):
+		return self._num_buttons
+
+	def get_has_eraser(self):
+		return self._has_eraser
+
+	def get_is_eraser(self):
+		return self._is_eraser
+
+	def get_has_lens(self):
+		return self._has_lens
+
+	def get_has_wheel(self):
+		return self._has_wheel
+
+	def get_type(self):
+		return self._type
+
+	def get_axes(self):
+		return self._axes
+
+	def as_dict(self):
+		return {
+			'id': self._id,
+			'name': self._name,
+			'num_buttons': self._num_buttons,
+			'has_eraser': self._has_eraser,
+			'is_eraser': self._is_eraser,
+			'has_lens': self._has_lens,
+			'has_wheel': self._has_wheel,
+			'type': self._type,
+			'axes': self._axes
+		}
+
+
+class StylusCatalog():
+
+	'''
+	Table of all the styli known by a libwacom database, indexed by tool id.
+
+	The catalog is loaded once per database and shared by the whole process
+	(see StylusCatalog.get()), so looking up a tool id while the user is
+	interacting with a pen is a dictionary lookup, not a ctypes call.
+
+	libwacom doesn't have a call to list its stylus database, so the catalog
+	is built from the styli supported by every tablet in the database.
+	'''
+
+	_catalogs = {}          # database key: StylusCatalog
+	_catalogs_lock = Lock()
+
+	def __init__(self, styli = None):
+		self._styli = {}    # id: Stylus
+		for stylus in styli or []:
+			self._styli[stylus.get_id()] = stylus
+
+	# Returns the catalog for the database "db" (a WacomDeviceDatabase *),
+	# loading it the first time. "key" identifies the database within the
+	# process, typically its path (None for the system database).
+	# Raises LibWrapperException if libwacom fails.
+	@classmethod
+	def get(cls, lw, db, key = None):
+		cls._catalogs_lock.acquire()
+		try:
+			catalog = cls._catalogs.get(key)
+			if catalog is None:
+				catalog = cls.load(lw, db)
+				cls._catalogs[key] = catalog
+			return catalog
+		finally:
+			cls._catalogs_lock.release()
+
+	# Forgets the catalog of a database, eg. because it has been reloaded.
+	@classmethod
+	def discard(cls, key = None):
+		cls._catalogs_lock.acquire()
+		cls._catalogs.pop(key, None)
+		cls._catalogs_lock.release()
+
+	# Makes "catalog" the shared one for "key", eg. after reloading its database
+	@classmethod
+	def replace(cls, key, catalog):
+		cls._catalogs_lock.acquire()
+		cls._catalogs[key] = catalog
+		cls._catalogs_lock.release()
+
+	# Returns one catalog with the styli of all "catalogs", given in priority
+	# order: a stylus in an earlier catalog hides the one with the same id in
+	# the later ones.
+	@classmethod
+	def merge(cls, catalogs):
+		if len(catalogs) == 1:
+			return catalogs[0]
+		styli = []
+		for catalog in reversed(catalogs):
+			styli.extend(catalog.get_styli())
+		return cls(styli)
+
+	# Loads a new catalog for "db", not shared (see get() and replace()).
+	# Raises LibWrapperException if libwacom fails.
+	@classmethod
+	def load(cls, lw, db):
+		error = lw.libwacom_error_new()
+		ids = set()
+		try:
+			for device_p in lw.iter_devices_from_database(db, error):
+				ids.update(get_supported_styli(lw, device_p))
+
+			styli = []
+			for id in sorted(ids):
+				# Checked through errno (see ctypes_errcheck), which may still
+				# hold the error of any previous call
+				set_errno(0)
+				stylus_p = lw.libwacom_stylus_get_for_id(db, id)
+				if bool(stylus_p):
+					set_errno(0)
+					type = lw.libwacom_stylus_get_type(stylus_p)
+					styli.append(Stylus(id,
+					                    lw.libwacom_stylus_get_name(stylus_p),
+					                    num_buttons = lw.libwacom_stylus_get_num_buttons(stylus_p),
+					                    has_eraser = lw.libwacom_stylus_has_eraser(stylus_p),
+					                    is_eraser = lw.libwacom_stylus_is_eraser(stylus_p),
+					                    has_lens = lw.libwacom_stylus_has_lens(stylus_p),
+					                    has_wheel = lw.libwacom_stylus_has_wheel(stylus_p),
+					                    type = type,
+					                    axes = lw.libwacom_stylus_get_axes(stylus_p)))
+			return cls(styli)
+		finally:
+			lw.libwacom_error_free(byref(error))
+
+	# Returns the Stylus with tool id "id", or None if it is unknown
+	def get_stylus(self, id):
+		return self._styli.get(id)
+
+	def get_styli(self):
+		return list(self._styli.values())
+
+	def __len__(self):
+		return len(self._styli)
+
+	def __contains__(self, id):
+		return id in self._styli
+
+
+# Returns a tuple with the ids of the styli supported by "device_p"
+def get_supported_styli(lw, device_p):
+	num_styli = c_int(0)
+	set_errno(0)        # see StylusCatalog.load()
+	styli = lw.libwacom_get_supported_styli(device_p, byref(num_styli))
+	return tuple(styli[n] for n in range(num_styli.value))
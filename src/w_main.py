@@ -15,6 +15,9 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from gi.repository import GLib, Gdk
+
+
 class WMain():
 
 	#UI_FILE = "/usr/local/share/gsetwacom/ui/w_main.ui"
@@ -23,6 +26,11 @@ class WMain():
 	def __init__(self, app):
 		self._app = app
 		self._window = self._app.get_window_from_file(self.UI_FILE, "w_main", self)
+		self._image = self._app.get_object("image-tablet")
+		self._images = self._app.get_layout_images()    # LayoutImageCache
+		self._device = None                             # Device shown
+		self._requested = None                          # (filename, width, height, scale) of the picture shown
+		self._window.connect("size-allocate", self.on_window_size_allocate)
 
 		#''' Instantiate the preferences dialog '''
 		#self.d_prefs = preferences.DlgPreferences(self.app)
@@ -37,3 +45,52 @@ class WMain():
 	def on_window_destroy(self, window):
 		self._app.quit()
 
+	# Shows the picture of the layout of "device" (None clears it).
+	# Can be called from any thread.
+	def show_device(self, device):
+		GLib.idle_add(self._show_device, device)
+
+	def _show_device(self, device):
+		self._device = device
+		self._update_layout()
+		return False
+
+	# Only a new size (see LayoutImageCache.get_render_size()) asks for
+	# another picture, and the cache renders it only once.
+	def on_window_size_allocate(self, window, allocation):
+		if self._device is not None:
+			self._update_layout()
+
+	# The picture takes a third of the window, so it never makes it grow
+	def _get_layout_size(self):
+		allocation = self._window.get_allocation()
+		return self._images.get_render_size(max(allocation.width // 3, 1), max(allocation.height // 3, 1))
+
+	def _update_layout(self):
+		layout = self._device.get_layout() if self._device is not None else None
+		filename = layout.get_layout_filename() if layout is not None else None
+		if filename is None:
+			self._requested = None
+			self._image.clear()
+			return
+
+		width, height = self._get_layout_size()
+		requested = (filename, width, height, self._window.get_scale_factor())
+		if requested == self._requested:
+			return
+		self._requested = requested
+		pixbuf = self._images.request(filename, width, height, requested[3], lambda pixbuf: self._on_layout(requested, pixbuf))
+		if pixbuf is not None:
+			self._set_layout(pixbuf, requested[3])
+
+	def _on_layout(self, requested, pixbuf):
+		# Something else may have been asked for in the meantime
+		if requested == self._requested and pixbuf is not None:
+			self._set_layout(pixbuf, requested[3])
+
+	def _set_layout(self, pixbuf, scale):
+		if scale > 1:
+			self._image.set_from_surface(Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, self._window.get_window()))
+		else:
+			self._image.set_from_pixbuf(pixbuf)
+
@@ -0,0 +1,348 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# worker.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Probing in a separate process.
+
+A misbehaving node can crash libwacom or block it in a read forever. The
+probe worker is a child process, with its own DeviceBroker and databases,
+that does the probing instead, so the application only sees a failed
+scan. The worker is started on the first probe and kept running, so its
+databases stay loaded from one scan to the next.
+
+The protocol is one compact JSON object per line on the pipes of the
+worker. Once its databases are loaded, the worker says:
+
+	{"ready": true, "pid": 1234}
+
+and then answers every request, in order:
+
+	-> {"id": 1, "call": "find_nodes", "args": [["/dev/input/mouse0"]]}
+	<- {"id": 1, "devices": [...]}
+	<- {"id": 1, "error": "..."}
+
+"devices" are as Device.as_dict(). {"call": "quit"} ends the worker.
+'''
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import subprocess
+
+from threading import Lock
+from argparse import ArgumentParser
+
+from error import GsException, GsError
+from device import Device, DeviceDescription
+
+# The calls of DeviceBroker the worker answers
+WORKER_CALLS = ('find_nodes', 'find_by_path', 'find_by_usbid')
+
+WORKER_SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+class ProbeWorker():
+
+	'''
+	Runs and supervises the probe worker, and makes the find_*() calls of a
+	DeviceBroker through it (see ScanPipeline.set_probe_worker()).
+
+	A call that takes more than "timeout" seconds gets the worker killed.
+	A worker that is killed or dies is started again on the next call,
+	unless it has failed more than "max_restarts" times in the last
+	"restart_window" seconds: then calls fail right away until that window
+	has passed. Either way the call raises GsError, the scan fails and the
+	registry is left as it was.
+	'''
+
+	STARTUP_TIMEOUT = 30    # seconds to load the databases
+
+	def __init__(self, databases = None, timeout = 5.0, max_restarts = 3, restart_window = 60.0):
+		if databases is None:
+			self._databases = []
+		elif isinstance(databases, basestring):
+			self._databases = [databases]
+		else:
+			self._databases = [path for path in databases if path is not None]
+		self._timeout = timeout
+		self._max_restarts = max_restarts
+		self._restart_window = restart_window
+		self._process = None
+		self._buffer = ''
+		self._next_id = 1
+		self._failures = []         # times the worker failed, see _check_failures()
+		self._starts = 0
+		self._lock = Lock()
+		self._descriptions = {}     # (vendor, model, match): DeviceDescription
+
+	def __del__(self):
+		self.stop()
+
+	# Starts the worker, if it is not running yet. Raises GsError if it
+	# can't be started or doesn't get ready.
+	def start(self):
+		self._lock.acquire()
+		try:
+			self._start()
+		finally:
+			self._lock.release()
+
+	# Asks the worker to quit, and kills it if it doesn't
+	def stop(self):
+		self._lock.acquire()
+		try:
+			self._stop()
+		finally:
+			self._lock.release()
+
+	# Stops the worker so the next call starts a new one, eg. after the
+	# databases have changed.
+	def reload(self):
+		self.stop()
+
+	def is_running(self):
+		return self._process is not None and self._process.poll() is None
+
+	def get_pid(self):
+		return self._process.pid if self._process is not None else None
+
+	# Returns how many times the worker has been started
+	def get_starts(self):
+		return self._starts
+
+	def find_nodes(self, paths):
+		return self._call('find_nodes', [list(paths)])
+
+	def find_by_path(self, path):
+		devices = self._call('find_by_path', [path])
+		return devices[0] if devices else None
+
+	def find_by_usbid(self, vendor, model):
+		devices = self._call('find_by_usbid', [vendor, model])
+		return devices[0] if devices else None
+
+	def _call(self, call, args):
+		self._lock.acquire()
+		try:
+			self._start()
+			request_id = self._next_id
+			self._next_id = self._next_id + 1
+			self._send({'id': request_id, 'call': call, 'args': args})
+			response = self._receive(self._timeout)
+			if response.get('id') != request_id:
+				self._fail()
+				raise GsError("The probe worker got out of step", "Expected answer %d, got %s" % (request_id, response.get('id')))
+		finally:
+			self._lock.release()
+
+		if 'error' in response:
+			raise GsError("The probe worker failed", response['error'])
+		return [self._create_device(d) for d in response.get('devices', [])]
+
+	def _start(self):
+		if self.is_running():
+			return
+		self._reap()
+		self._check_failures()
+		command = [sys.executable, WORKER_SCRIPT]
+		for path in self._databases:
+			command.extend(['-b', path])
+		try:
+			self._process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, close_fds = True)
+		except (OSError, ValueError) as e:
+			self._failures.append(time.time())
+			raise GsError("Couldn't start the probe worker", str(e))
+		self._starts = self._starts + 1
+		self._buffer = ''
+		response = self._receive(self.STARTUP_TIMEOUT)
+		if not response.get('ready'):
+			self._fail()
+			raise GsError("The probe worker couldn't start", response.get('error', "Not ready"))
+
+	def _stop(self):
+		if self._process is None:
+			return
+		if self._process.poll() is None:
+			try:
+				self._process.stdin.write('{"call":"quit"}\n')
+				self._process.stdin.close()
+			except (IOError, OSError):
+				pass
+			deadline = time.time() + 1.0
+			while self._process.poll() is None and time.time() < deadline:
+				time.sleep(0.01)
+		self._kill()
+
+	# Too many failures in a row mean that something is really wrong (eg.
+	# a node that crashes libwacom every time): stop trying for a while.
+	def _check_failures(self):
+		now = time.time()
+		self._failures = [t for t in self._failures if now - t < self._restart_window]
+		if len(self._failures) > self._max_restarts:
+			raise GsError("The probe worker keeps failing",
+			              "%d failures in %d seconds, not restarting it yet" % (len(self._failures), self._restart_window))
+
+	def _fail(self):
+		self._failures.append(time.time())
+		self._kill()
+
+	def _kill(self):
+		if self._process is None:
+			return
+		if self._process.poll() is None:
+			try:
+				self._process.kill()
+			except OSError:
+				pass
+		self._reap()
+
+	def _reap(self):
+		if self._process is None:
+			return
+		self._process.wait()
+		for f in (self._process.stdin, self._process.stdout):
+			try:
+				f.close()
+			except (IOError, OSError):
+				pass
+		self._process = None
+
+	def _send(self, request):
+		try:
+			self._process.stdin.write(json.dumps(request, separators = (',', ':')) + '\n')
+			self._process.stdin.flush()
+		except (IOError, OSError) as e:
+			self._fail()
+			raise GsError("The probe worker died", str(e))
+
+	# Reads one response, waiting at most "timeout" seconds
+	def _receive(self, timeout):
+		fd = self._process.stdout.fileno()
+		deadline = time.time() + timeout
+		while '\n' not in self._buffer:
+			left = deadline - time.time()
+			if left <= 0:
+				self._fail()
+				raise GsError("The probe worker didn't answer", "Killed after %.1f seconds" % (timeout))
+			try:
+				ready, _, _ = select.select([fd], [], [], left)
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			if not ready:
+				continue
+			data = os.read(fd, 65536)
+			if not data:
+				returncode = self._process.wait()
+				self._fail()
+				raise GsError("The probe worker died", _format_returncode(returncode))
+			self._buffer = self._buffer + data
+
+		line, self._buffer = self._buffer.split('\n', 1)
+		try:
+			return json.loads(line)
+		except ValueError as e:
+			self._fail()
+			raise GsError("The probe worker answered nonsense", str(e))
+
+	# Descriptions are interned, as DeviceBroker does
+	def _create_device(self, d):
+		key = (d['vendor'], d['model'], d['match'])
+		description = self._descriptions.get(key)
+		if description is None:
+			description = DeviceDescription.from_dict(d)
+			self._descriptions[key] = description
+		return Device.from_dict(d, description)
+
+
+def _format_returncode(returncode):
+	if returncode < 0:
+		return "Killed by signal %d" % (-returncode)
+	return "Exited with status %d" % (returncode)
+
+
+# The worker itself. Answers the requests read from "fin" on "fout" until
+# told to quit or "fin" is closed.
+def serve(databases, fin, fout):
+	def write(response):
+		fout.write(json.dumps(response, separators = (',', ':')) + '\n')
+		fout.flush()
+
+	# Imported here: the application only needs ProbeWorker
+	from device import DeviceBroker
+	try:
+		broker = DeviceBroker(databases)
+	except GsException as ge:
+		write({'ready': False, 'error': str(ge)})
+		return 1
+	write({'ready': True, 'pid': os.getpid()})
+
+	for line in iter(fin.readline, ''):
+		try:
+			request = json.loads(line)
+		except ValueError as e:
+			write({'id': None, 'error': str(e)})
+			continue
+		call = request.get('call')
+		if call == 'quit':
+			break
+		response = {'id': request.get('id')}
+		if call not in WORKER_CALLS:
+			response['error'] = "Unknown call %s" % (call)
+		else:
+			try:
+				result = getattr(broker, call)(*_get_args(call, request.get('args', [])))
+				if call == 'find_nodes':
+					response['devices'] = [device.as_dict() for device in result]
+				else:
+					response['devices'] = [result.as_dict()] if result is not None else []
+			except GsException as ge:
+				response['error'] = str(ge)
+		write(response)
+	return 0
+
+
+# JSON strings are unicode; libwacom wants byte strings
+def _get_args(call, args):
+	if call == 'find_nodes':
+		return [[str(path) for path in args[0]]]
+	elif call == 'find_by_path':
+		return [str(args[0])]
+	return args
+
+
+def main(argv):
+	parser = ArgumentParser(description='Probe worker of gsetwacom, not meant to be run by hand')
+	parser.add_argument('-b', '--database', dest='databases', action='append', help='LibWacom database path, can be repeated')
+	args = parser.parse_args(argv[1:])
+
+	# Only this process reads the requests, and only the responses go to
+	# stdout: anything else printing there (libwacom warnings...) goes to
+	# stderr instead.
+	fout = os.fdopen(os.dup(1), 'w')
+	os.dup2(2, 1)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	return serve(args.databases, sys.stdin, fout)
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,774 @@
+# -*- Mode: Python; indent-tabs-mode: t; c-basic-offset: 4; tab-width: 4 -*- #
+# xinput.py
+# Copyright (C) 2017 Juan Carlos Muro <murojc@gmail.com>
+#
+# gsetwacom is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gsetwacom is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Wrapper for the parts of Xlib.h and XInput2.h needed to read and write input
+device properties, the same way xsetwacom does, but in-process.
+
+Properties set by the xf86-input-wacom driver are listed in WacomProperties
+(from wacom-properties.h of the "xf86-input-wacom" project).
+
+Xlib is not made thread safe here (XInitThreads() would have to be called
+before Gtk opens its own display): every thread that accesses properties
+must have its own XiPropertyBackend, ie. its own connection.
+
+This code is based on LibraryWrapper from "base.py" from the Evemu project at
+https://www.freedesktop.org/wiki/Evemu/
+'''
+
+import ctypes
+
+from threading import Lock
+
+from libwrapper import *
+
+from ctypes import c_char_p, c_int, c_uint, c_long, c_ulong, c_short, c_ubyte, c_float, c_void_p, POINTER, Structure, byref, cast, create_string_buffer, CFUNCTYPE
+
+
+Atom = c_ulong
+Bool = c_int
+Status = c_int
+
+XA_ATOM    = 4
+XA_INTEGER = 19
+XA_STRING  = 31
+AnyPropertyType = 0
+
+PropModeReplace = 0
+
+GenericEvent = 35
+
+XI_PropertyEvent = 12
+XI_LASTEVENT     = 26
+
+XIPropertyDeleted  = 0      # XIPropertyEvent.what
+XIPropertyCreated  = 1
+XIPropertyModified = 2
+
+XIAllDevices       = 0
+XIAllMasterDevices = 1
+
+
+class XIDeviceUse:      # XIDeviceInfo.use
+	XIMasterPointer  = 1
+	XIMasterKeyboard = 2
+	XISlavePointer   = 3
+	XISlaveKeyboard  = 4
+	XIFloatingSlave  = 5
+
+
+class WacomProperties:
+	'''
+	Input device properties of the xf86-input-wacom driver, as defined in
+	wacom-properties.h, plus the generic ones set by the X server.
+	'''
+	WACOM_PROP_TABLET_AREA            = "Wacom Tablet Area"               # 32 bit, 4 values: top x, top y, bottom x, bottom y
+	WACOM_PROP_PRESSURECURVE          = "Wacom Pressurecurve"             # 32 bit, 4 values: x1, y1, x2, y2
+	WACOM_PROP_SERIALIDS              = "Wacom Serial IDs"                # 32 bit, 5 values, read-only
+	WACOM_PROP_SERIAL_BIND            = "Wacom Serial ID binding"         # 32 bit, 1 value
+	WACOM_PROP_STRIPBUTTONS           = "Wacom Strip Buttons"             # Atom, 4 values
+	WACOM_PROP_WHEELBUTTONS           = "Wacom Wheel Buttons"             # Atom, 6 values
+	WACOM_PROP_ROTATION               = "Wacom Rotation"                  # 8 bit, 1 value: none, cw, ccw, half
+	WACOM_PROP_PROXIMITY_THRESHOLD    = "Wacom Proximity Threshold"       # 32 bit, 1 value
+	WACOM_PROP_PRESSURE_THRESHOLD     = "Wacom Pressure Threshold"        # 32 bit, 1 value
+	WACOM_PROP_SAMPLE                 = "Wacom Sample and Suppress"       # 32 bit, 2 values
+	WACOM_PROP_TOUCH                  = "Wacom Enable Touch"              # 8 bit, 1 value
+	WACOM_PROP_HARDWARE_TOUCH         = "Wacom Hardware Touch Switch"     # 8 bit, 1 value, read-only
+	WACOM_PROP_ENABLE_GESTURE         = "Wacom Enable Touch Gesture"      # 8 bit, 1 value
+	WACOM_PROP_GESTURE_PARAMETERS     = "Wacom Touch Gesture Parameters"  # 32 bit, 3 values
+	WACOM_PROP_TOOL_TYPE              = "Wacom Tool Type"                 # Atom, 1 value, read-only
+	WACOM_PROP_BUTTON_ACTIONS         = "Wacom Button Actions"            # Atom, one per button
+	WACOM_PROP_DEBUGLEVELS            = "Wacom Debug Levels"              # 8 bit, 2 values
+	WACOM_PROP_PRESSURE_RECALIBRATION = "Wacom Pressure Recalibration"    # 8 bit, 1 value
+	WACOM_PROP_PANSCROLL_THRESHOLD    = "Wacom Panscroll Threshold"       # 32 bit, 1 value
+	WACOM_PROP_HOVER_CLICK            = "Wacom Hover Click"               # 8 bit, 1 value
+
+	XI_PROP_ENABLED                   = "Device Enabled"                  # 8 bit, 1 value
+	XI_PROP_PRODUCT_ID                = "Device Product ID"               # 32 bit, 2 values: vendor, product
+	XI_PROP_DEVICE_NODE               = "Device Node"                     # string
+	XI_PROP_TRANSFORM                 = "Coordinate Transformation Matrix"  # FLOAT, 9 values
+
+
+class XIDeviceInfo(Structure):
+	'''
+	typedef struct {
+		int                 deviceid;
+		char                *name;
+		int                 use;
+		int                 attachment;
+		Bool                enabled;
+		int                 num_classes;
+		XIAnyClassInfo      **classes;
+	} XIDeviceInfo;
+	'''
+	_fields_ = [
+	    ("deviceid", c_int),
+	    ("name", c_char_p),
+	    ("use", c_int),
+	    ("attachment", c_int),
+	    ("enabled", Bool),
+	    ("num_classes", c_int),
+	    ("classes", c_void_p)       # XIAnyClassInfo **
+	]
+
+
+class XIEventMask(Structure):
+	'''
+	typedef struct {
+		int                 deviceid;
+		int                 mask_len;
+		unsigned char*      mask;
+	} XIEventMask;
+	'''
+	_fields_ = [
+	    ("deviceid", c_int),
+	    ("mask_len", c_int),
+	    ("mask", POINTER(c_ubyte))
+	]
+
+
+class XGenericEventCookie(Structure):
+	'''
+	typedef struct {
+		int            type;
+		unsigned long  serial;
+		Bool           send_event;
+		Display        *display;
+		int            extension;
+		int            evtype;
+		unsigned int   cookie;
+		void           *data;
+	} XGenericEventCookie;
+	'''
+	_fields_ = [
+	    ("type", c_int),
+	    ("serial", c_ulong),
+	    ("send_event", Bool),
+	    ("display", c_void_p),
+	    ("extension", c_int),
+	    ("evtype", c_int),
+	    ("cookie", c_uint),
+	    ("data", c_void_p)
+	]
+
+
+class XEvent(ctypes.Union):
+	'''
+	union _XEvent { int type; ... XGenericEventCookie xcookie; long pad[24]; }
+
+	Only the members we use are declared, "pad" gives the union its size.
+	'''
+	_fields_ = [
+	    ("type", c_int),
+	    ("xcookie", XGenericEventCookie),
+	    ("pad", c_long * 24)
+	]
+
+
+class XIPropertyEvent(Structure):
+	'''
+	typedef struct {
+		int           type;
+		unsigned long serial;
+		Bool          send_event;
+		Display       *display;
+		int           extension;
+		int           evtype;
+		Time          time;
+		int           deviceid;
+		Atom          property;
+		int           what;
+	} XIPropertyEvent;
+	'''
+	_fields_ = [
+	    ("type", c_int),
+	    ("serial", c_ulong),
+	    ("send_event", Bool),
+	    ("display", c_void_p),
+	    ("extension", c_int),
+	    ("evtype", c_int),
+	    ("time", c_ulong),
+	    ("deviceid", c_int),
+	    ("property", Atom),
+	    ("what", c_int)
+	]
+
+
+class XErrorEvent(Structure):
+	'''
+	typedef struct {
+		int           type;
+		Display       *display;
+		XID           resourceid;
+		unsigned long serial;
+		unsigned char error_code;
+		unsigned char request_code;
+		unsigned char minor_code;
+	} XErrorEvent;
+	'''
+	_fields_ = [
+	    ("type", c_int),
+	    ("display", c_void_p),
+	    ("resourceid", c_ulong),
+	    ("serial", c_ulong),
+	    ("error_code", c_ubyte),
+	    ("request_code", c_ubyte),
+	    ("minor_code", c_ubyte)
+	]
+
+
+# int (*XErrorHandler)(Display *display, XErrorEvent *event)
+XErrorHandler = CFUNCTYPE(c_int, c_void_p, POINTER(XErrorEvent))
+
+
+class LibX11(LibraryWrapper):
+
+	@staticmethod
+	def _cdll():
+		return ctypes.CDLL("libX11.so.6", use_errno=True)
+
+	_api_prototypes = {
+
+		# Display *XOpenDisplay(char *display_name)
+		"XOpenDisplay": {
+			"argtypes": (c_char_p,),
+			"restype": c_void_p
+		},
+
+		# int XCloseDisplay(Display *display)
+		"XCloseDisplay": {
+			"argtypes": (c_void_p,),
+			"restype": c_int
+		},
+
+		# Status XInternAtoms(Display *display, char **names, int count, Bool only_if_exists, Atom *atoms_return)
+		#
+		# Interns "count" atoms in a single round trip to the server.
+		"XInternAtoms": {
+			"argtypes": (c_void_p, POINTER(c_char_p), c_int, Bool, POINTER(Atom)),
+			"restype": Status
+		},
+
+		# Status XGetAtomNames(Display *display, Atom *atoms, int count, char **names_return)
+		#
+		# Each of the returned names must be freed with XFree()
+		"XGetAtomNames": {
+			"argtypes": (c_void_p, POINTER(Atom), c_int, POINTER(c_void_p)),
+			"restype": Status
+		},
+
+		# XErrorHandler XSetErrorHandler(XErrorHandler handler)
+		#
+		# Returns the previous handler
+		"XSetErrorHandler": {
+			"argtypes": (XErrorHandler,),
+			"restype": XErrorHandler
+		},
+
+		# int XGetErrorText(Display *display, int code, char *buffer_return, int length)
+		"XGetErrorText": {
+			"argtypes": (c_void_p, c_int, c_char_p, c_int),
+			"restype": c_int
+		},
+
+		# int XFree(void *data)
+		"XFree": {
+			"argtypes": (c_void_p,),
+			"restype": c_int
+		},
+
+		# int XFlush(Display *display)
+		"XFlush": {
+			"argtypes": (c_void_p,),
+			"restype": c_int
+		},
+
+		# int XSync(Display *display, Bool discard)
+		"XSync": {
+			"argtypes": (c_void_p, Bool),
+			"restype": c_int
+		},
+
+		# Bool XQueryExtension(Display *display, char *name, int *major_opcode_return, int *first_event_return, int *first_error_return)
+		"XQueryExtension": {
+			"argtypes": (c_void_p, c_char_p, POINTER(c_int), POINTER(c_int), POINTER(c_int)),
+			"restype": Bool
+		},
+
+		# Window XDefaultRootWindow(Display *display)
+		"XDefaultRootWindow": {
+			"argtypes": (c_void_p,),
+			"restype": c_ulong
+		},
+
+		# int XConnectionNumber(Display *display)
+		#
+		# File descriptor of the connection, to wait for events with select()
+		"XConnectionNumber": {
+			"argtypes": (c_void_p,),
+			"restype": c_int
+		},
+
+		# int XPending(Display *display)
+		"XPending": {
+			"argtypes": (c_void_p,),
+			"restype": c_int
+		},
+
+		# int XNextEvent(Display *display, XEvent *event_return)
+		"XNextEvent": {
+			"argtypes": (c_void_p, POINTER(XEvent)),
+			"restype": c_int
+		},
+
+		# Bool XGetEventData(Display *display, XGenericEventCookie *cookie)
+		"XGetEventData": {
+			"argtypes": (c_void_p, POINTER(XGenericEventCookie)),
+			"restype": Bool
+		},
+
+		# void XFreeEventData(Display *display, XGenericEventCookie *cookie)
+		"XFreeEventData": {
+			"argtypes": (c_void_p, POINTER(XGenericEventCookie)),
+			"restype": None
+		},
+	}
+
+
+class LibXi(LibraryWrapper):
+
+	@staticmethod
+	def _cdll():
+		return ctypes.CDLL("libXi.so.6", use_errno=True)
+
+	_api_prototypes = {
+
+		# XIDeviceInfo *XIQueryDevice(Display *display, int deviceid, int *ndevices_return)
+		"XIQueryDevice": {
+			"argtypes": (c_void_p, c_int, POINTER(c_int)),
+			"restype": POINTER(XIDeviceInfo)
+		},
+
+		# void XIFreeDeviceInfo(XIDeviceInfo *info)
+		"XIFreeDeviceInfo": {
+			"argtypes": (POINTER(XIDeviceInfo),),
+			"restype": None
+		},
+
+		# Atom *XIListProperties(Display *display, int deviceid, int *num_props_return)
+		"XIListProperties": {
+			"argtypes": (c_void_p, c_int, POINTER(c_int)),
+			"restype": POINTER(Atom)
+		},
+
+		# Status XIGetProperty(Display *display, int deviceid, Atom property, long offset, long length,
+		#                      Bool delete_property, Atom type, Atom *type_return, int *format_return,
+		#                      unsigned long *num_items_return, unsigned long *bytes_after_return,
+		#                      unsigned char **data)
+		#
+		# Returns Success (0) if the request was sent. If the property doesn't
+		# exist, "type_return" is None (0).
+		"XIGetProperty": {
+			"argtypes": (c_void_p, c_int, Atom, c_long, c_long, Bool, Atom, POINTER(Atom),
+			             POINTER(c_int), POINTER(c_ulong), POINTER(c_ulong), POINTER(POINTER(c_ubyte))),
+			"restype": Status
+		},
+
+		# Status XISelectEvents(Display *display, Window win, XIEventMask *masks, int num_masks)
+		"XISelectEvents": {
+			"argtypes": (c_void_p, c_ulong, POINTER(XIEventMask), c_int),
+			"restype": Status
+		},
+
+		# void XIChangeProperty(Display *display, int deviceid, Atom property, Atom type, int format,
+		#                       int mode, unsigned char *data, int num_items)
+		#
+		# The request is only queued in the output buffer of the display, it
+		# is sent by the next XFlush() or XSync().
+		"XIChangeProperty": {
+			"argtypes": (c_void_p, c_int, Atom, Atom, c_int, c_int, c_void_p, c_int),
+			"restype": None
+		},
+	}
+
+
+# Xlib reports errors to one handler for the whole process, and the default
+# one exits. The displays of XiPropertyBackend are trapped here: their errors
+# are kept, to be raised by the backend, instead. Errors of other displays
+# (eg. the one of Gtk) go to the handler that was installed before.
+_trap_lock = Lock()
+_trapped = {}               # Display: [XErrorEvent values]
+_trap_handler = None        # XErrorHandler, kept so it is not collected
+_trap_previous = None       # XErrorHandler replaced by _trap_handler
+
+def _on_x_error(display, event):
+	_trap_lock.acquire()
+	try:
+		errors = _trapped.get(display)
+		if errors is not None:
+			errors.append((event.contents.error_code, event.contents.request_code, event.contents.minor_code))
+			return 0
+	finally:
+		_trap_lock.release()
+	if _trap_previous:
+		return _trap_previous(display, event)
+	return 0
+
+def _trap_errors(x11, display):
+	global _trap_handler, _trap_previous
+	_trap_lock.acquire()
+	try:
+		if _trap_handler is None:
+			_trap_handler = XErrorHandler(_on_x_error)
+			_trap_previous = x11.XSetErrorHandler(_trap_handler)
+		_trapped[display] = []
+	finally:
+		_trap_lock.release()
+
+def _untrap_errors(display):
+	_trap_lock.acquire()
+	_trapped.pop(display, None)
+	_trap_lock.release()
+
+# Returns, and forgets, the errors of "display" received so far
+def _pop_errors(display):
+	_trap_lock.acquire()
+	try:
+		errors = _trapped.get(display, [])
+		if errors:
+			_trapped[display] = []
+		return errors
+	finally:
+		_trap_lock.release()
+
+
+class XProperty(object):
+
+	'''
+	Value of an input device property: its name, X type atom, format (8, 16 or
+	32) and the list of values. Values of type FLOAT are floats, values of
+	type ATOM are atom names (str) and the rest are integers.
+	'''
+
+	__slots__ = ('name', 'type', 'format', 'values')
+
+	def __init__(self, name, type, format, values):
+		self.name = name
+		self.type = type
+		self.format = format
+		self.values = list(values)
+
+	def __eq__(self, other):
+		return isinstance(other, XProperty) and self.values == other.values and self.type == other.type
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __repr__(self):
+		return "XProperty(%r, %r)" % (self.name, self.values)
+
+
+class XiPropertyBackend():
+
+	'''
+	Reads and writes input device properties through XInput2, in-process.
+
+	This replaces spawning "xsetwacom" once per property:
+	~ Atoms are interned in batches with XInternAtoms() and cached.
+	~ set_properties() queues one XIChangeProperty() per property and device
+	  and sends them all with a single XSync(), ie. one round trip.
+	~ get_properties() still needs one XIGetProperty() per property (Xlib
+	  has no way to pipeline them), but no process is spawned.
+
+	The libraries can be passed to the constructor, so the backend can be
+	tested against stub LibX11/LibXi subclasses or a local Xvfb server.
+
+	Raises LibWrapperException on any Xlib error (eg. BadDevice, when the
+	tablet has just been unplugged). A backend must only be used by one
+	thread at a time.
+	'''
+
+	def __init__(self, display_name = None, x11 = None, xi = None):
+		self._dpy = None
+		self._x11 = x11 or LibX11()
+		self._xi = xi or LibXi()
+		self._dpy = self._x11.XOpenDisplay(display_name)
+		if not self._dpy:
+			raise LibWrapperException("Can't open display %s" % (display_name or "(default)"))
+		_trap_errors(self._x11, self._dpy)
+		self._atoms = {}       # name: Atom
+		self._names = {}       # Atom: name
+		self._formats = {}     # (deviceid, name): (type, format) learned from get_properties()
+		self._xi_opcode = None # set by select_property_events()
+
+		self._float_atom = self.intern_atoms(["FLOAT"])["FLOAT"]
+
+	def close(self):
+		if self._dpy:
+			self._x11.XCloseDisplay(self._dpy)
+			_untrap_errors(self._dpy)
+			self._dpy = None
+
+	def __del__(self):
+		self.close()
+
+	def get_display(self):
+		return self._dpy
+
+	# Raises LibWrapperException if the server has answered any of the
+	# requests sent so far with an error. Errors come asynchronously: only
+	# those of requests with a reply, or sent before an XSync(), are sure to
+	# have arrived.
+	def _check_errors(self, doing):
+		errors = _pop_errors(self._dpy)
+		if not errors:
+			return
+		error_code, request_code, minor_code = errors[0]
+		text = create_string_buffer(256)
+		self._x11.XGetErrorText(self._dpy, error_code, text, len(text))
+		raise LibWrapperException("X error while %s: %s (request %d.%d)%s" % (doing, text.value or error_code, request_code, minor_code,
+		                          ", and %d more" % (len(errors) - 1) if len(errors) > 1 else ""))
+
+	# Returns a {name: Atom} dictionary, interning the names not cached yet in
+	# one single request.
+	def intern_atoms(self, names, only_if_exists = False):
+		missing = [name for name in names if not name in self._atoms]
+		if missing:
+			c_names = (c_char_p * len(missing))(*missing)
+			atoms = (Atom * len(missing))()
+			self._x11.XInternAtoms(self._dpy, c_names, len(missing), only_if_exists, atoms)
+			self._check_errors("interning atoms")
+			for (name, atom) in zip(missing, atoms):
+				if atom:
+					self._atoms[name] = atom
+					self._names[atom] = name
+		return dict((name, self._atoms.get(name, 0)) for name in names)
+
+	# Returns a {Atom: name} dictionary, fetching the names not cached yet in
+	# one single request.
+	def get_atom_names(self, atoms):
+		missing = list(set(atom for atom in atoms if atom and not atom in self._names))
+		if missing:
+			c_atoms = (Atom * len(missing))(*missing)
+			c_names = (c_void_p * len(missing))()
+			status = self._x11.XGetAtomNames(self._dpy, c_atoms, len(missing), c_names)
+			self._check_errors("getting atom names")
+			if status:
+				for (atom, name_p) in zip(missing, c_names):
+					name = ctypes.string_at(name_p)
+					self._x11.XFree(name_p)
+					self._atoms[name] = atom
+					self._names[atom] = name
+		return dict((atom, self._names.get(atom)) for atom in atoms)
+
+	# Subscribes to XI_PropertyEvent for all the devices. Once called, 
+	# read_property_events() returns the properties changed by anyone.
+	# Returns False if the server doesn't support XInput2.
+	def select_property_events(self):
+		opcode = c_int(0)
+		event = c_int(0)
+		error = c_int(0)
+		if not self._x11.XQueryExtension(self._dpy, "XInputExtension", byref(opcode), byref(event), byref(error)):
+			return False
+		self._xi_opcode = opcode.value
+
+		mask = (c_ubyte * ((XI_LASTEVENT >> 3) + 1))()
+		mask[XI_PropertyEvent >> 3] |= 1 << (XI_PropertyEvent & 7)
+		event_mask = XIEventMask(XIAllDevices, len(mask), cast(mask, POINTER(c_ubyte)))
+		self._xi.XISelectEvents(self._dpy, self._x11.XDefaultRootWindow(self._dpy), byref(event_mask), 1)
+		self._x11.XSync(self._dpy, False)
+		self._check_errors("selecting property events")
+		return True
+
+	# File descriptor to wait for events on with select()
+	def get_connection_number(self):
+		return self._x11.XConnectionNumber(self._dpy)
+
+	# Returns a list of (deviceid, property_name, what) for the property events
+	# already received, without blocking. "what" is XIPropertyModified, 
+	# XIPropertyCreated or XIPropertyDeleted.
+	def read_property_events(self):
+		events = []
+		event = XEvent()
+		while self._x11.XPending(self._dpy) > 0:
+			self._x11.XNextEvent(self._dpy, byref(event))
+			cookie = event.xcookie
+			if cookie.type != GenericEvent or cookie.extension != self._xi_opcode:
+				continue
+			if not self._x11.XGetEventData(self._dpy, byref(cookie)):
+				continue
+			try:
+				if cookie.evtype == XI_PropertyEvent:
+					prop = cast(cookie.data, POINTER(XIPropertyEvent)).contents
+					events.append((prop.deviceid, prop.property, prop.what))
+			finally:
+				self._x11.XFreeEventData(self._dpy, byref(cookie))
+		self._check_errors("reading property events")
+
+		names = self.get_atom_names([atom for (deviceid, atom, what) in events])
+		return [(deviceid, names[atom], what) for (deviceid, atom, what) in events]
+
+	# Returns a list of (deviceid, name, use) for all the input devices
+	def list_devices(self):
+		ndevices = c_int(0)
+		info = self._xi.XIQueryDevice(self._dpy, XIAllDevices, byref(ndevices))
+		self._check_errors("listing the input devices")
+		if not bool(info):
+			return []
+		try:
+			return [(info[n].deviceid, info[n].name, info[n].use) for n in range(ndevices.value)]
+		finally:
+			self._xi.XIFreeDeviceInfo(info)
+
+	# Returns the names of the properties of a device
+	def list_properties(self, deviceid):
+		num_props = c_int(0)
+		atoms_p = self._xi.XIListProperties(self._dpy, deviceid, byref(num_props))
+		self._check_errors("listing the properties of device %d" % (deviceid))
+		if not bool(atoms_p):
+			return []
+		try:
+			atoms = [atoms_p[n] for n in range(num_props.value)]
+		finally:
+			self._x11.XFree(atoms_p)
+		names = self.get_atom_names(atoms)
+		return [names[atom] for atom in atoms]
+
+	# Returns the ids of the slave devices whose "Device Product ID" is
+	# vendor:model, ie. the stylus, eraser, touch, pad... of one tablet model.
+	def find_devices(self, vendor, model):
+		ids = []
+		for (deviceid, name, use) in self.list_devices():
+			if use != XIDeviceUse.XISlavePointer and use != XIDeviceUse.XIFloatingSlave:
+				continue
+			prop = self.get_properties(deviceid, [WacomProperties.XI_PROP_PRODUCT_ID]).get(WacomProperties.XI_PROP_PRODUCT_ID)
+			if prop is not None and prop.values[:2] == [vendor, model]:
+				ids.append(deviceid)
+		return ids
+
+	# Returns a {name: XProperty} dictionary with the properties "names" of
+	# the device "deviceid". Properties that the device doesn't have are not
+	# in the dictionary.
+	def get_properties(self, deviceid, names):
+		atoms = self.intern_atoms(names, only_if_exists = True)
+		properties = {}
+		for name in names:
+			if not atoms[name]:
+				continue
+			prop = self._get_property(deviceid, name, atoms[name])
+			if prop is not None:
+				properties[name] = prop
+		return properties
+
+	def _get_property(self, deviceid, name, atom):
+		type_return = Atom(0)
+		format_return = c_int(0)
+		num_items = c_ulong(0)
+		bytes_after = c_ulong(0)
+		data = POINTER(c_ubyte)()
+
+		# length is in 32 bit units, 1024 is way more than any wacom property
+		status = self._xi.XIGetProperty(self._dpy, deviceid, atom, 0, 1024, False, AnyPropertyType,
+		                                byref(type_return), byref(format_return), byref(num_items),
+		                                byref(bytes_after), byref(data))
+		self._check_errors("reading \"%s\" of device %d" % (name, deviceid))
+		if status != 0:
+			return None
+		try:
+			if not type_return.value:
+				return None
+			values = self._decode(type_return.value, format_return.value, data, num_items.value)
+		finally:
+			if bool(data):
+				self._x11.XFree(data)
+
+		self._formats[(deviceid, name)] = (type_return.value, format_return.value)
+		return XProperty(name, type_return.value, format_return.value, values)
+
+	# Changes the properties of several devices in one go.
+	# "changes" is a list of (deviceid, name, values) tuples. The type and the
+	# format of each property are the ones last read by get_properties(),
+	# which is called (once per device) for the properties not read yet.
+	# All the requests are sent with a single XSync().
+	def set_properties(self, changes):
+		missing = {}
+		for (deviceid, name, values) in changes:
+			if not (deviceid, name) in self._formats:
+				missing.setdefault(deviceid, []).append(name)
+		for deviceid in missing:
+			self.get_properties(deviceid, missing[deviceid])
+
+		atom_names = set()
+		for (deviceid, name, values) in changes:
+			atom_names.add(name)
+			if self._formats.get((deviceid, name), (None,))[0] == XA_ATOM:
+				atom_names.update(value for value in values if value)
+		atoms = self.intern_atoms(list(atom_names))
+
+		for (deviceid, name, values) in changes:
+			if not (deviceid, name) in self._formats:
+				raise LibWrapperException("Device %d has no property \"%s\"" % (deviceid, name))
+			type, format = self._formats[(deviceid, name)]
+			data, num_items = self._encode(type, format, values, atoms)
+			self._xi.XIChangeProperty(self._dpy, deviceid, atoms[name], type, format,
+			                          PropModeReplace, data, num_items)
+
+		self._x11.XSync(self._dpy, False)
+		self._check_errors("writing device properties")
+
+	# Converts the data returned by XIGetProperty() to a list of values.
+	# Note that Xlib returns 32 bit items as C longs.
+	def _decode(self, type, format, data, num_items):
+		if format == 8:
+			if type == XA_STRING:
+				return [ctypes.string_at(data, num_items).rstrip('\0')]
+			return [data[n] for n in range(num_items)]
+		elif format == 16:
+			items = cast(data, POINTER(c_short))
+			return [items[n] for n in range(num_items)]
+		elif format == 32:
+			if type == self._float_atom:
+				items = cast(data, POINTER(c_long))
+				return [c_float.from_buffer_copy(c_long(items[n]), 0).value for n in range(num_items)]
+			items = cast(data, POINTER(c_long))
+			values = [items[n] for n in range(num_items)]
+			if type == XA_ATOM:
+				names = self.get_atom_names(values)
+				return [names.get(value) for value in values]
+			return values
+		raise LibWrapperException("Unexpected property format %d" % (format))
+
+	# Converts a list of values to the buffer expected by XIChangeProperty().
+	# Returns (buffer, number of items). A STRING is one value, but as many
+	# 8 bit items as characters (without the NUL, as the X server sets them).
+	def _encode(self, type, format, values, atoms):
+		if format == 8:
+			if type == XA_STRING:
+				return (create_string_buffer(values[0]), len(values[0]))
+			return ((c_ubyte * len(values))(*values), len(values))
+		elif format == 16:
+			return ((c_short * len(values))(*values), len(values))
+		elif format == 32:
+			if type == self._float_atom:
+				buffer = (c_long * len(values))()
+				for (n, value) in enumerate(values):
+					ctypes.memmove(ctypes.addressof(buffer) + n * ctypes.sizeof(c_long), byref(c_float(value)), ctypes.sizeof(c_float))
+				return (buffer, len(values))
+			if type == XA_ATOM:
+				values = [atoms.get(value, 0) if value else 0 for value in values]
+			return ((c_long * len(values))(*values), len(values))
+		raise LibWrapperException("Unexpected property format %d" % (format))